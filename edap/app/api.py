@@ -2,7 +2,7 @@ from functools import wraps
 from flask import Flask, jsonify, make_response, request, abort
 from api_backend import *
 from flask_cors import CORS
-import edap, traceback
+import bulk, edap, traceback
 
 API_VERSION = "3.0"
 
@@ -96,6 +96,21 @@ def dev_area(f):
 		return f(*args, **kwargs)
 	return decorated
 
+@app.before_request
+def open_request_cache():
+	"""
+		Cache profiles for the duration of a request, so verify_request()
+		and the endpoint share what they read (see profile_cache()).
+	"""
+	open_profile_cache()
+
+@app.teardown_request
+def close_request_cache(exc):
+	"""
+		Write the profile items set during the request, unless it failed.
+	"""
+	close_profile_cache(save=exc is None)
+
 @app.errorhandler(404)
 def e404(_):
 	"""
@@ -204,24 +219,30 @@ def dev_memory_usage():
 def dev_db_optimize():
 	"""
 		DEV: Rewrite the AOF file. Can be supplied with argument 'heavy'
-		which will also delete any excess class IDs (non-zero).
+		which will also delete any excess class IDs (non-zero). The heavy
+		optimization is a resumable job (see run_bulk_job()), which can be
+		started over with argument 'restart'.
 	"""
 	heavy_opt = request.args.get('heavy', type=bool)
 	pre_size = convert_size(get_db_size())
 	if heavy_opt:
-		for token in get_tokens():
-			tdata = get_data(token)
-			for i in tdata['data']['classes'][1:]:
-				try:
-					del i['subjects']
-					del i['tests']
-					del i['absences']
-					del i['info']
-					del i['full']
-					del i['complete_avg']
-				except KeyError:
-					pass
-			save_data(token, tdata)
+		def strip_classes(profiles):
+			for tdata in profiles.values():
+				for i in tdata['data']['classes'][1:]:
+					try:
+						del i['subjects']
+						del i['tests']
+						del i['absences']
+						del i['info']
+						del i['full']
+						del i['complete_avg']
+					except KeyError:
+						pass
+			return profiles
+		try:
+			update_profiles('optimize', strip_classes, request.args.get('restart', type=bool))
+		except bulk.JobRunning:
+			return make_response(jsonify({'error':'E_JOB_RUNNING'}), 409)
 	optimize_db_aof()
 	sleep(2)
 	post_size = convert_size(get_db_size())
@@ -251,6 +272,42 @@ def dev_db_info():
 		'vault': vault_info
 	}))
 
+@app.route('/dev/pages', methods=["GET"])
+@dev_area
+def dev_page_stats():
+	"""
+		DEV: Show how many synced pages were unchanged (hits) or changed
+		(misses).
+	"""
+	return make_response(jsonify(get_page_stats()), 200)
+
+@app.route('/dev/breaker', methods=["GET"])
+@dev_area
+def dev_breaker_state():
+	"""
+		DEV: Show the state of the upstream circuit breaker (whether syncs
+		are paused because e-Dnevnik is unavailable).
+	"""
+	return make_response(jsonify(get_breaker_state()), 200)
+
+@app.route('/dev/ratelimit', methods=["GET"])
+@dev_area
+def dev_rate_limit_stats():
+	"""
+		DEV: Show how many upstream requests were sent and throttled, and
+		how long they waited, for each lane of the rate limiter.
+	"""
+	return make_response(jsonify(get_rate_limit_stats()), 200)
+
+@app.route('/dev/cache', methods=["GET"])
+@dev_area
+def dev_hash_cache_stats():
+	"""
+		DEV: Show the size and hit ratio of the profile cache of the
+		worker handling the request (every worker has its own).
+	"""
+	return make_response(jsonify(get_hash_cache_stats()), 200)
+
 @app.route('/dev/log', methods=["GET"])
 @dev_area
 def dev_log():
@@ -266,7 +323,10 @@ def dev_firebase_filter():
 		DEV: Check for inactive users, and delete if specified.
 	"""
 	auto_delete = request.args.get('delete', type=bool)
-	out = check_inactive_fb_tokens(auto_delete)
+	try:
+		out = check_inactive_fb_tokens(auto_delete, request.args.get('restart', type=bool))
+	except bulk.JobRunning:
+		return make_response(jsonify({'error':'E_JOB_RUNNING'}), 409)
 	return make_response(jsonify(out), 200)
 
 @app.route('/dev/users', methods=["GET"])
@@ -276,7 +336,7 @@ def dev_users():
 		DEV: Get usernames and tokens.
 	"""
 	tklist = []
-	for token in get_tokens():
+	for token in iter_tokens():
 		creds = get_credentials(token)
 		tklist.append({'token': token, 'name': creds['username']})
 	return make_response(jsonify({'users':tklist}), 200)
@@ -331,24 +391,42 @@ def dev_thread_list():
 @dev_area
 def dev_reload_info():
 	"""
-		DEV: Re-fetches the 'data' key for all tokens in the database.
+		DEV: Re-fetches the 'data' key for all tokens in the database,
+		using the batch scraper (see batch.py). This is a resumable job
+		(see run_bulk_job()), which can be started over with argument
+		'restart'.
 	"""
-	tokens = get_tokens()
 	failed = []
-	log.info("DEV OPERATION => RECREATING DATA OBJECTS FOR %i TOKENS", len(tokens))
-	for token in tokens:
-		try:
-			o = get_data(token)
-			creds = get_credentials(token)
-			userObj = edap.edap(creds['username'], creds['password'])
-			o['data'] = populate_data(userObj)
-			o['generated_with'] = API_VERSION
-			save_data(token, o)
-		except Exception as e:
-			failed.append({'token':token, 'reason':str(e)})
-			log.error('DEV OPERATION => Update FAILED for token %s, reason %s', token, e)
-			continue
-	return make_response(jsonify({'sample': len(tokens), 'fails': failed}))
+	log.info("DEV OPERATION => RECREATING DATA OBJECTS")
+	scraper = get_batch_scraper()
+	def recreate(token):
+		return with_upstream_session(token, populate_data, **scraper.edap_options())
+	def recreate_batch(tokens):
+		errors = 0
+		for result in scraper.map(recreate, tokens):
+			if result.error:
+				errors += 1
+				failed.append({'token':result.key, 'reason':str(result.error)})
+				log.error('DEV OPERATION => Update FAILED for token %s, reason %s', result.key, result.error)
+				continue
+			# Only the classes are replaced, so changes made to the rest
+			# of the profile while scraping aren't lost
+			save_classes(result.key, result.data['classes'], generated_with=API_VERSION)
+		return errors
+	try:
+		progress = run_bulk_job('recreate', recreate_batch, request.args.get('restart', type=bool))
+	except bulk.JobRunning:
+		return make_response(jsonify({'error':'E_JOB_RUNNING'}), 409)
+	return make_response(jsonify({'sample': progress['done'], 'fails': failed}))
+
+@app.route('/dev/bulk', methods=["GET"])
+@dev_area
+def dev_bulk_jobs():
+	"""
+		DEV: Get the progress of bulk jobs (/dev/recreate,
+		/dev/dboptimize?heavy=1 and /dev/firebase).
+	"""
+	return make_response(jsonify(get_bulk_jobs()), 200)
 
 @app.route('/dev/users/<string:token>/testdiff', methods=["POST"])
 @dev_pw_area
@@ -429,7 +507,7 @@ def login():
 		return make_response(jsonify({'token':token}), 200)
 	log.debug("Starting login for %s", username)
 	try:
-		obj = edap.edap(username, password, debug=True, hidepriv=False)
+		obj = edap_login(username, password, debug=True, hidepriv=False)
 	except edap.WrongCredentials:
 		log.warning("Failed logging %s in: invalid credentials", username)
 		return make_response(jsonify({'error':'E_INVALID_CREDENTIALS'}), 401)
@@ -443,12 +521,16 @@ def login():
 		abort(500)
 	except edap.NetworkError as e:
 		log.error("Failed logging %s in: eDAP library error - NetworkError: %s", username, e)
-		notify_error('CONNECTION FAIL', 'login', additional_info={'Token': token, 'Username': username, 'IP': dev_ip})
+		# Outages are notified about by the upstream circuit breaker
+		if not upstream_failed(repr(e)):
+			notify_error('CONNECTION FAIL', 'login', additional_info={'Token': token, 'Username': username, 'IP': dev_ip})
 		abort(500)
 	except edap.ServerInMaintenance as e:
 		log.error("Failed logging %s in: upstream server maintenance in progress", username)
-		notify_error('SERVER MAINTENANCE', 'login', additional_info={'Token': token, 'Username': username, 'IP': dev_ip})
+		if not upstream_failed(repr(e)):
+			notify_error('SERVER MAINTENANCE', 'login', additional_info={'Token': token, 'Username': username, 'IP': dev_ip})
 		return make_response(jsonify({'error':'E_UPSTREAM_MAINTENANCE'}), 500)
+	upstream_succeeded()
 	log.info("SLOW => SUCCESS => %s (%s)", username, token)
 	dataObj = {
 		'data': populate_data(obj),
@@ -463,7 +545,9 @@ def login():
 		},
 		'messages': []
 	}
+	obj.close()
 	set_credentials(token, username, password)
+	save_upstream_session(token, obj)
 	save_data(token, dataObj)
 	log.debug("Starting sync for %s", username)
 	start_sync(token)
@@ -472,14 +556,22 @@ def login():
 @app.route('/user/<string:token>/fetchclass', methods=["POST"])
 def fill_class(token):
 	"""
-		Expand a class object by class ID (specified in POST JSON).
+		Expand a class object by class ID (specified in POST JSON). A list
+		of class IDs can also be given, in which case the classes are
+		expanded at the same time.
 	"""
 	if not verify_request(token):
 		abort(401)
 	if not request.json or not "class_id" in request.json:
 		abort(400)
-	log.info("%s: Fetching class ID %s", token, request.json["class_id"])
-	fetch_new_class(token, request.json["class_id"])
+	class_ids = request.json["class_id"]
+	if not isinstance(class_ids, list):
+		class_ids = [class_ids]
+	class_count = get_class_count(token)
+	if not class_ids or not all(isinstance(class_id, int) and 0 <= class_id < class_count for class_id in class_ids):
+		abort(400)
+	log.info("%s: Fetching class ID(s) %s", token, class_ids)
+	fetch_new_class(token, class_ids)
 	return make_response('', 200)
 
 @app.route('/user/<string:token>/settings/<string:action>', methods=["POST", "GET"])
@@ -516,7 +608,7 @@ def generate_message(token):
 		abort(401)
 	log.info(token)
 	rsp = {'messages':[]}
-	o = get_data(token)
+	o = get_profile_fields(token, 'messages')
 	# TEMP CODE
 	if not 'messages' in o:
 		o['messages'] = []
@@ -532,10 +624,7 @@ def get_new(token):
 	if not verify_request(token):
 		abort(401)
 	log.info(token)
-	o = get_data(token)
-	new = o['new']
-	o['new'] = []
-	save_data(token, o)
+	new = take_profile_field(token, 'new', [])
 	return make_response(jsonify({'new':new}), 200)
 
 @app.route('/user/<string:token>/logout', methods=["GET"])
@@ -557,16 +646,8 @@ def get_classes(token):
 	if not verify_request(token):
 		abort(401)
 	log.info(token)
-	o = get_data(token)['data']
-	for i in o['classes']:
-		try:
-			del i['subjects']
-			del i['tests']
-			del i['absences']
-			del i['info']
-		except KeyError:
-			pass
-	return make_response(jsonify(o), 200)
+	# Only the "meta" part of the classes, without subjects, tests, absences and info
+	return make_response(jsonify({'classes': get_class_list(token)}), 200)
 
 @app.route('/user/<string:token>/classes/<int:class_id>/history', methods=["GET"])
 def get_history(token, class_id):
@@ -581,13 +662,14 @@ def get_history(token, class_id):
 		output_format = request.args.get('output', default='complete') # complete or graph
 		if output_format not in ['graph', 'complete']:
 			return make_response(jsonify({'error': 'E_INVALID_OUTPUT_FORMAT'}), 400)
-		subjs = get_data(token)['data']['classes'][class_id]['subjects']
+		subjs = get_class_subjects(token, class_id)
 		# Compile a list of all grades
 		grade_list = []
 		for subject in subjs:
 			for grade in subject['grades']:
-				grade['subject'] = subject['subject']
-				grade_list.append(grade)
+				# Cached subjects are shared with other requests, so
+				# they're copied instead of changed
+				grade_list.append(dict(grade, subject=subject['subject']))
 		if output_format == 'complete':
 			# Sort by date, newest first, output everything
 			return make_response(jsonify(sorted(grade_list, key=lambda k: k['date'], reverse=True)), 200)
@@ -605,7 +687,7 @@ def get_user_info(token, class_id):
 	if not verify_request(token, class_id):
 		abort(401)
 	log.info(token)
-	return make_response(jsonify(get_data(token)['data']['classes'][class_id]['info']), 200)
+	return make_response(jsonify(get_class_part(token, class_id, 'info')), 200)
 
 @app.route('/user/<string:token>/classes/<int:class_id>/absences', methods=["GET"])
 def get_absences(token, class_id):
@@ -615,7 +697,7 @@ def get_absences(token, class_id):
 	if not verify_request(token, class_id):
 		abort(401)
 	log.info("%s: List absences for class %s", token, class_id)
-	return make_response(jsonify(get_data(token)['data']['classes'][class_id]['absences']), 200)
+	return make_response(jsonify(get_class_part(token, class_id, 'absences')), 200)
 
 @app.route('/user/<string:token>/classes/<int:class_id>/subjects', methods=["GET"])
 def get_subjects(token, class_id):
@@ -625,8 +707,8 @@ def get_subjects(token, class_id):
 	if not verify_request(token, class_id):
 		abort(401)
 	log.info("%s: List subjects for class %s", token, class_id)
-	o = get_data(token)['data']['classes'][class_id]
-	return make_response(jsonify({'subjects': o['subjects'], 'class_avg':o['complete_avg']}), 200)
+	meta = get_class_part(token, class_id, 'meta')
+	return make_response(jsonify({'subjects': get_class_subjects(token, class_id), 'class_avg':meta['complete_avg']}), 200)
 
 @app.route('/user/<string:token>/classes/<int:class_id>/tests', methods=["GET"])
 def get_tests(token, class_id):
@@ -636,7 +718,7 @@ def get_tests(token, class_id):
 	if not verify_request(token, class_id):
 		abort(401)
 	log.info("%s: List tests for class %s", token, class_id)
-	o = get_data(token)['data']['classes'][class_id]['tests']
+	o = get_class_part(token, class_id, 'tests')
 	return make_response(jsonify({'tests': o}), 200)
 
 @app.route('/user/<string:token>/classes/<int:class_id>/subjects/<int:subject_id>', methods=["GET"])
@@ -647,7 +729,7 @@ def get_subject(token, class_id, subject_id):
 	if not verify_request(token, class_id, subject_id):
 		abort(401)
 	log.info("%s: Get subject data for class %s, subject %s", token, class_id, subject_id)
-	o = get_data(token)['data']['classes'][class_id]['subjects'][subject_id]
+	o = get_class_subject(token, class_id, subject_id)
 	return make_response(jsonify(o), 200)
 
 @app.route('/user/<string:token>/device', methods=["POST"])
@@ -670,12 +752,19 @@ def log_stats(token):
 		request.json["platform"],
 		request.json["device"]
 	)
-	dataObj = get_data(token)
-	dataObj['devices'][uuid]['last_ip'] = request.remote_addr
-	dataObj['devices'][uuid]['platform'] = request.json["platform"]
-	dataObj['devices'][uuid]['model'] = request.json["device"]
-	dataObj['devices'][uuid]['firebase'] = request.json["firebase"]
-	save_data(token, dataObj)
+	def save_device(dataObj):
+		devices = dataObj.get('devices', [])
+		device = next((i for i in devices if i.get('uuid') == request.json["uuid"]), None)
+		if device is None:
+			device = {'uuid': request.json["uuid"]}
+			devices.append(device)
+		device['last_ip'] = request.remote_addr
+		device['platform'] = request.json["platform"]
+		device['model'] = request.json["device"]
+		device['firebase'] = request.json["firebase"]
+		# Notifications are sent to the device which reported last
+		return {'devices': devices, 'firebase_device_token': request.json["firebase"]}
+	update_profile_fields(token, save_device, 'devices')
 	return make_response('', 200)
 
 if __name__ == '__main__':
@@ -6,38 +6,77 @@ This module contains various functions which interact with the backend
 of the eDAP-API system.
 """
 
-import logging, redis, edap, requests, setproctitle, gc
+import logging, redis, edap, batch, breaker, bulk, codec, hashcache, profiles, ratelimit, requests, setproctitle, gc
 from hashlib import md5 as _MD5HASH
 from hashlib import sha256 as _SHA256HASH
 from json import loads as _json_load
-from json import dumps as _json_convert
-from copy import deepcopy
+from json import dumps as _json_dumps
 from random import randint
 from random import choice as _random_choice
 from sys import exit as _sys_exit
 from math import floor as _math_floor
-from math import ceil as _math_ceil
 from math import log as _math_log
 from math import pow as _math_pow
 from os import environ
 from os.path import join as _join_path
 from os.path import getsize as _get_file_size
-from threading import Thread, currentThread
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from threading import Thread, currentThread, local
+from time import sleep, time
 from string import ascii_letters
 from typing import List
 from api_backend_config import Config
+from profiles import _round
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
+from cryptography.fernet import Fernet, InvalidToken
 
 log = logging.getLogger(__name__)
 _redis = None
+_codec = None
+_hash_cache = None
+_batch = None
+_breaker = None
+_limiter = None
 
 _threads = {}
 
+# Profile cache of the current thread, see profile_cache()
+_local = local()
+
+# Parts of a class stored as separate fields of its hash, see _encode_class()
+_CLASS_PARTS = ('tests', 'absences', 'info')
+
+# Redis sets of all tokens and dev tokens, see iter_tokens()
+_TOKEN_INDEX = 'tokens'
+_DEV_TOKEN_INDEX = 'dev-tokens'
+
+# Bulk jobs run from the /dev/ endpoints, see run_bulk_job()
+BULK_JOBS = ('optimize', 'recreate', 'firebase')
+
 class NonExistentSetting(Exception):
 	"""Specified setting ID is non-existent."""
 
+def _json_convert(obj) -> str:
+	"""
+		Serialize an object to JSON, including eDAP's record types (which
+		are serialized as dicts).
+	"""
+	return _json_dumps(obj, default=edap.json_default)
+
+def _encode(obj) -> bytes:
+	"""
+		Encode an item of a profile for Redis, see codec.py.
+	"""
+	return _codec.dumps(obj)
+
+def _decode(value: bytes):
+	"""
+		Decode an item of a profile stored in any format, see codec.py.
+	"""
+	return _codec.loads(value)
+
 def _get_month_start_timestamp(input_date: int) -> int:
 	return int(datetime.fromtimestamp(input_date).replace(hour=0, minute=0, day=1).timestamp())
 
@@ -193,17 +232,6 @@ def get_vault_info() -> dict:
 	returnable['write_token_ttl'] = write_token_status['data']['ttl']
 	return returnable
 
-def _round(n, decimals=0):
-	"""
-		Improved round function. Rounds .5 upwards instead of builtin
-		round()'s downwards rounding.
-		Taken from this StackOverflow answer: https://stackoverflow.com/a/52617883
-	"""
-	expoN = n * 10 ** decimals
-	if abs(expoN) - abs(_math_floor(expoN)) < 0.5:
-		return _math_floor(expoN) / 10 ** decimals
-	return _math_ceil(expoN) / 10 ** decimals
-
 def _send_telegram_notification(message: str, parse_mode: str = "Markdown"):
 	"""
 		Send a notification through Telegram. Refer to https://core.telegram.org/bots/api#sendMessage
@@ -316,8 +344,12 @@ def _set_credentials_vault(token: str, username: str, password: str):
 
 def rm_credentials(token: str):
 	"""
-		Call Vault to remove a credential pair for a token.
+		Remove a credential pair for a token, from Vault or Redis
+		depending on config.
 	"""
+	if not config.vault.enabled:
+		_redis.delete('creds:%s' % token)
+		return
 	data = requests.delete(
 		'%s/v1/secret/data/%s' % (config.vault.server, token),
 		headers={'X-Vault-Token': config.vault.write_token}
@@ -360,7 +392,7 @@ def get_setting(token: str, action: str):
 	"""
 		Get action data/value for token.
 	"""
-	o = get_data(token)
+	o = get_profile_fields(token, 'settings')
 	if 'settings' not in o:
 		o['settings'] = {'notif':{'disable': False, 'ignore':[]}}
 	if action == 'notif.disable':
@@ -382,22 +414,23 @@ def process_setting(token: str, action: str, val):
 
 		Notification types can be: grade, note, test, absence.
 	"""
-	o = get_data(token)
-	if 'settings' not in o:
-		o['settings'] = {'notif':{'disable': False, 'ignore':[]}}
-	if action == 'notif.disable':
-		o['settings']['notif']['disable'] = val
-	elif action == 'notif.ignore.add':
-		if val not in o['settings']['notif']['ignore']:
-			o['settings']['notif']['ignore'].append(val)
-	elif action == 'notif.ignore.del':
-		if val in o['settings']['notif']['ignore']:
-			del o['settings']['notif']['ignore'][o['settings']['notif']['ignore'].index(val)]
+	def apply(o):
+		if 'settings' not in o:
+			o['settings'] = {'notif':{'disable': False, 'ignore':[]}}
+		if action == 'notif.disable':
+			o['settings']['notif']['disable'] = val
+		elif action == 'notif.ignore.add':
+			if val not in o['settings']['notif']['ignore']:
+				o['settings']['notif']['ignore'].append(val)
+		elif action == 'notif.ignore.del':
+			if val in o['settings']['notif']['ignore']:
+				del o['settings']['notif']['ignore'][o['settings']['notif']['ignore'].index(val)]
+			else:
+				raise NonExistentSetting
 		else:
 			raise NonExistentSetting
-	else:
-		raise NonExistentSetting
-	save_data(token, o)
+		return {'settings': o['settings']}
+	update_profile_fields(token, apply, 'settings')
 
 def purge_token(token: str):
 	"""
@@ -405,7 +438,17 @@ def purge_token(token: str):
 	"""
 	log.info("LOGOUT => %s", token)
 	_stop_sync(token)
-	_redis.delete('token:' + token)
+	cache = _get_profile_cache()
+	if cache:
+		cache.pending.pop(token, None)
+		cache.forget('token:' + token, *[_class_key(token, class_id) for class_id in range(get_class_count(token))])
+	keys = ['token:' + token] + [_class_key(token, class_id) for class_id in range(get_class_count(token))]
+	_redis.delete(*keys)
+	_redis.srem(_TOKEN_INDEX, token)
+	_profile_changed(*keys)
+	_redis.delete('session:' + token)
+	_redis.delete('class-sessions:' + token)
+	_redis.delete('digests:' + token)
 	rm_credentials(token)
 
 def _formatAndSendNotification(token: str, notifData):
@@ -413,44 +456,46 @@ def _formatAndSendNotification(token: str, notifData):
 		Format a notification for the user based on data gotten from
 		profileDifference() in sync().
 	"""
-	gradeNotif = []
-	testNotif = []
-	noteNotif = []
-	absenceNotif = False
-	toSendQueue = [] # List of notifications to send
-	exceptions = get_data(token)['settings']['notif']['ignore']
-	for x in notifData:
-		# TODO: Fix test notifications
-		#if x['type'] == 'test' and 'test' not in exceptions:
-		#	testNotif.append("%s: %s" % (x['data']['subject'], x['data']['test']))
-		if x['type'] == 'grade' and 'grade' not in exceptions:
-			gradeNotif.append("%s: %s (%s)" % (_subj_id_to_name(token, x['classId'], x['subjectId']), x['data']['grade'], x['data']['note']))
-		elif x['type'] == 'note' and 'note' not in exceptions:
-			noteNotif.append("%s: %s" % (_subj_id_to_name(token, x['classId'], x['subjectId']), x['data']['note']))
-		#elif x['type'] == 'absence' and 'absence' not in exceptions:
-		#	absenceNotif = True
-	if gradeNotif:
-		toSendQueue.append({
-			'head': localize(token, 'grade'),
-			'content': ", ".join(gradeNotif)
-		})
-	if testNotif:
-		toSendQueue.append({
-			'head': localize(token, 'test'),
-			'content': ", ".join(testNotif)
-		})
-	if noteNotif:
-		toSendQueue.append({
-			'head': localize(token, 'note'),
-			'content': ", ".join(noteNotif)
-		})
-	if absenceNotif:
-		toSendQueue.append({
-			'head': localize(token, 'absence'),
-			'content': None
-		})
-	for i in toSendQueue:
-		sendNotification(token, i['head'], i['content'])
+	# Subject names, settings and devices are read from the cache
+	with profile_cache():
+		gradeNotif = []
+		testNotif = []
+		noteNotif = []
+		absenceNotif = False
+		toSendQueue = [] # List of notifications to send
+		exceptions = get_profile_fields(token, 'settings')['settings']['notif']['ignore']
+		for x in notifData:
+			# TODO: Fix test notifications
+			#if x['type'] == 'test' and 'test' not in exceptions:
+			#	testNotif.append("%s: %s" % (x['data']['subject'], x['data']['test']))
+			if x['type'] == 'grade' and 'grade' not in exceptions:
+				gradeNotif.append("%s: %s (%s)" % (_subj_id_to_name(token, x['classId'], x['subjectId']), x['data']['grade'], x['data']['note']))
+			elif x['type'] == 'note' and 'note' not in exceptions:
+				noteNotif.append("%s: %s" % (_subj_id_to_name(token, x['classId'], x['subjectId']), x['data']['note']))
+			#elif x['type'] == 'absence' and 'absence' not in exceptions:
+			#	absenceNotif = True
+		if gradeNotif:
+			toSendQueue.append({
+				'head': localize(token, 'grade'),
+				'content': ", ".join(gradeNotif)
+			})
+		if testNotif:
+			toSendQueue.append({
+				'head': localize(token, 'test'),
+				'content': ", ".join(testNotif)
+			})
+		if noteNotif:
+			toSendQueue.append({
+				'head': localize(token, 'note'),
+				'content': ", ".join(noteNotif)
+			})
+		if absenceNotif:
+			toSendQueue.append({
+				'head': localize(token, 'absence'),
+				'content': None
+			})
+		for i in toSendQueue:
+			sendNotification(token, i['head'], i['content'])
 
 def _subj_id_to_name(token: str, class_id: int, subject_id: int) -> str:
 	"""
@@ -458,7 +503,7 @@ def _subj_id_to_name(token: str, class_id: int, subject_id: int) -> str:
 	"""
 	if not verify_request(token, class_id, subject_id):
 		raise Exception('Bad auth data')
-	return get_data(token)['data']['classes'][class_id]['subjects'][subject_id]['subject']
+	return get_class_subject(token, class_id, subject_id)['subject']
 
 def _stop_sync(token: str):
 	"""
@@ -487,12 +532,37 @@ def start_sync(token: str):
 def restore_syncs():
 	"""
 		Restore all sync threads (this is run on startup).
-	"""
-	tokens = get_tokens()
-	log.info('Starting sync threads for %s tokens', len(tokens))
-	for token in tokens:
-		if not 'ignore_updating' in get_data(token):
-			start_sync(token)
+
+		The syncs missed while the API was down are first caught up in the
+		background using the batch scraper (with bounded concurrency), and
+		the sync thread of each token is started as soon as its first sync
+		is done, so the threads don't all start syncing at the same time.
+	"""
+	log.info('Starting sync threads for %s tokens', _redis.scard(_TOKEN_INDEX))
+	Thread(target=_restore_syncs).start()
+
+def _tokens_to_sync():
+	"""
+		Yield all tokens which aren't marked with `ignore_updating`,
+		checking a batch of them at once.
+	"""
+	for _, tokens in bulk.scan_batches(_redis, _TOKEN_INDEX, config.bulk.batch_size):
+		pipe = _redis.pipeline(transaction=False)
+		for token in tokens:
+			pipe.hexists('token:' + token, 'ignore_updating')
+		for token, ignored in zip(tokens, pipe.execute()):
+			if not ignored:
+				yield token
+
+def _restore_syncs():
+	setproctitle.setproctitle('eDAP sync restore thread')
+	for result in _batch.map(_guarded_sync, _tokens_to_sync()):
+		if result.error:
+			log.error('Catch-up sync for %s failed: %s', result.key, result.error)
+		# Tokens can be purged while syncing (e.g. inactive Firebase tokens)
+		if _user_in_database(result.key):
+			start_sync(result.key)
+	log.info('Sync threads restored, batch stats: %s', _batch.stats())
 
 def sync_dev(data2, token: str):
 	"""
@@ -503,8 +573,7 @@ def sync_dev(data2, token: str):
 	diff = _profile_difference(o["data"], data2)
 	if diff:
 		log.info("Difference detected: %s", diff)
-		o["new"] = diff
-		save_data(token, o)
+		set_profile_fields(token, new=diff)
 		_formatAndSendNotification(token, diff)
 	else:
 		log.warning("No difference detected (??) This should not happen :P")
@@ -512,6 +581,8 @@ def sync_dev(data2, token: str):
 def sync(token: str):
 	"""
 		Pull remote data, compare with current and replace if needed.
+		Upstream requests of all syncs share the connection pool and
+		request budget of the batch scraper.
 	"""
 	log.debug("Syncing %s", token)
 	fData = get_data(token)
@@ -523,31 +594,76 @@ def sync(token: str):
 			purge_token(token)
 			return
 	data = fData["data"] # Old data
-	credentials = get_credentials(token)
-	nData = populate_data(edap.edap(credentials["username"], credentials["password"])) # New data
+	def scrape(edap_object):
+		return populate_data(edap_object, data), edap_object.page_digests, edap_object.getPageStats()
+	nData, digests, page_stats = with_upstream_session(token, scrape, digests=_get_page_digests(token), **_batch.edap_options()) # New data
+	_record_page_stats(page_stats)
+	if not page_stats['misses']:
+		# Nothing changed since the last sync, so there's nothing to compare
+		log.debug("No changed pages for %s", token)
+		gc.collect()
+		return
 	diff = _profile_difference(data, nData)
 	if diff:
-		# Overwrite everything if new class
+		# Overwrite all classes if new class
 		if diff[0]['type'] == 'class':
-			fData["data"] = nData
+			saved = save_classes(token, nData["classes"], new=diff)
 		else:
-			fData["data"]["classes"][0] = nData["classes"][0]
-		fData["new"] = diff
-		save_data(token, fData)
-		if not fData["settings"]["notif"]["disable"]:
+			saved = save_class(token, 0, nData["classes"][0], new=diff)
+		if saved and not fData["settings"]["notif"]["disable"]:
 			_formatAndSendNotification(token, diff)
+	else:
+		# Pages changed without anything new (e.g. a removed grade), store
+		# the new data so it matches the stored page digests
+		saved = save_class(token, 0, nData["classes"][0])
+	if not saved:
+		log.info("Token %s was removed while syncing", token)
+		gc.collect()
+		return
+	_redis.set('digests:' + token, _json_convert(digests))
 	# Free memory
 	gc.collect()
 
+def _get_page_digests(token: str) -> dict:
+	"""
+		Get the page digests stored by the previous sync of a token.
+	"""
+	digests = _redis.get('digests:' + token)
+	return _json_load(digests) if digests else {}
+
+def _record_page_stats(page_stats: dict):
+	"""
+		Add the unchanged (hits) and changed (misses) page counts from a sync
+		to the global counters.
+	"""
+	pipe = _redis.pipeline()
+	pipe.hincrby('stats:pages', 'hits', page_stats['hits'])
+	pipe.hincrby('stats:pages', 'misses', page_stats['misses'])
+	pipe.execute()
+
+def get_page_stats() -> dict:
+	"""
+		Get the global counters of unchanged (hits) and changed (misses)
+		pages seen while syncing.
+	"""
+	stats = {k.decode('utf-8'): int(v) for k, v in _redis.hgetall('stats:pages').items()}
+	return {'hits': stats.get('hits', 0), 'misses': stats.get('misses', 0)}
+
+def _new_items(old: list, new: list) -> list:
+	"""
+		Return the items of `new` (records or dicts with hashable values)
+		which aren't in `old`, in order.
+	"""
+	known = {tuple(sorted(x.items())) for x in old}
+	return [x for x in new if tuple(sorted(x.items())) not in known]
+
 def _profile_difference(dObj1, dObj2) -> List[dict]:
 	"""
 		Return the difference between two student data dicts.
 	"""
 	_finalReturn = []
 	## CLASS DIFFERENCE ##
-	t1 = deepcopy(dObj1['classes'])
-	t2 = deepcopy(dObj2['classes'])
-	difflist = len(t1) != len(t2)
+	difflist = len(dObj1['classes']) != len(dObj2['classes'])
 	if difflist:
 		log.info("Found difference in classes")
 		_finalReturn.append({'type':'class'})
@@ -556,16 +672,14 @@ def _profile_difference(dObj1, dObj2) -> List[dict]:
 		# we'll just return.
 		return _finalReturn
 	## TEST DIFFERENCE (FIRST CLASS ONLY) ##
-	t1 = deepcopy(dObj1['classes'][0]['tests'])
-	t2 = deepcopy(dObj2['classes'][0]['tests'])
-	difflist = [x for x in t2 if x not in t1]
+	difflist = _new_items(dObj1['classes'][0]['tests'], dObj2['classes'][0]['tests'])
 	if difflist:
 		log.info("Found difference in tests")
 		for i in difflist:
 			_finalReturn.append({'type':'test', 'classId':0, 'data':i})
 	## ABSENCE DIFFERENCE (FIRST CLASS ONLY) ##
-	t1 = deepcopy(dObj1['classes'][0]['absences']['full'])
-	t2 = deepcopy(dObj2['classes'][0]['absences']['full'])
+	t1 = dObj1['classes'][0]['absences']['full']
+	t2 = dObj2['classes'][0]['absences']['full']
 	difflist = [x for x in t2 if x not in t1]
 	if difflist:
 		log.info("Found difference in absences")
@@ -577,9 +691,7 @@ def _profile_difference(dObj1, dObj2) -> List[dict]:
 		if "grades" in j:
 			if j["grades"] is None:
 				continue
-			t1 = deepcopy(i['grades'])
-			t2 = deepcopy(j['grades'])
-			difflist = [x for x in t2 if x not in t1]
+			difflist = _new_items(i['grades'], j['grades'])
 			if difflist:
 				log.info("Found difference in grades")
 				for x in difflist:
@@ -587,9 +699,7 @@ def _profile_difference(dObj1, dObj2) -> List[dict]:
 		if "notes" in j:
 			if j["notes"] is None:
 				continue
-			t1 = deepcopy(i['notes'])
-			t2 = deepcopy(j['notes'])
-			difflist = [x for x in t2 if x not in t1]
+			difflist = _new_items(i['notes'], j['notes'])
 			if difflist:
 				log.info("Found difference in notes")
 				for x in difflist:
@@ -599,9 +709,474 @@ def _profile_difference(dObj1, dObj2) -> List[dict]:
 
 def save_data(token: str, dataObj):
 	"""
-		Save data for a token.
+		Save data for a token, replacing the whole profile. Use
+		set_profile_fields() and save_class() to save only a part of it.
+	"""
+	_write_profile(token, dataObj, get_class_count(token))
+
+def _class_key(token: str, class_id: int) -> str:
+	return 'class:%s:%i' % (token, class_id)
+
+class _ProfileCache:
+	"""
+		Profile hashes read and items written during one API request (or
+		while sending notifications), see profile_cache().
+	"""
+	def __init__(self):
+		self.hashes = {} # Redis key => {field: raw value}
+		self.decoded = {} # (Redis key, field) => decoded value
+		self.pending = {} # token => {item: encoded value}
+
+	def get_hash(self, key: str) -> dict:
+		# Hashes may be shared with other requests through the hash
+		# cache, so they're replaced instead of changed
+		if key not in self.hashes:
+			load = lambda: {field.decode('utf-8'): value for field, value in _redis.hgetall(key).items()}
+			self.hashes[key] = _hash_cache.load(key, load) if _hash_cache else load()
+		return self.hashes[key]
+
+	def get(self, key: str, field: str):
+		if (key, field) not in self.decoded:
+			value = self.get_hash(key).get(field)
+			if value is None:
+				self.decoded[key, field] = None
+			elif _hash_cache:
+				self.decoded[key, field] = _hash_cache.decode(key, field, value, _decode)
+			else:
+				self.decoded[key, field] = _decode(value)
+		return self.decoded[key, field]
+
+	def forget(self, *keys):
+		for key in keys:
+			self.hashes.pop(key, None)
+		self.decoded = {cached: value for cached, value in self.decoded.items() if cached[0] not in keys}
+
+	def flush(self, token: str = None):
+		"""
+			Write the pending items of a token (or of all tokens) to Redis.
+		"""
+		tokens = [token] if token else list(self.pending)
+		pipe = _redis.pipeline(transaction=False)
+		changed = []
+		for pending_token in tokens:
+			fields = self.pending.pop(pending_token, None)
+			if fields:
+				pipe.hset('token:' + pending_token, mapping=fields)
+				changed.append('token:' + pending_token)
+		pipe.execute()
+		_profile_changed(*changed)
+
+def _get_profile_cache():
+	return getattr(_local, 'profiles', None)
+
+def _profile_changed(*keys):
+	"""
+		Drop changed profile hashes from the hash cache of every worker,
+		see hashcache.py. Call this after writing them.
+	"""
+	if _hash_cache:
+		_hash_cache.invalidate(*keys)
+
+def get_hash_cache_stats() -> dict:
+	"""
+		Get the size and hit ratio of this worker's hash cache, see
+		hashcache.py.
+	"""
+	if not _hash_cache:
+		return {'enabled': False}
+	return dict(_hash_cache.stats(), enabled=True)
+
+def open_profile_cache():
+	"""
+		Start caching profiles in the current thread, see profile_cache().
+	"""
+	_local.profiles = _ProfileCache()
+
+def close_profile_cache(save: bool = True):
+	"""
+		Stop caching profiles in the current thread, writing the items set
+		with set_profile_fields() to Redis unless `save` is False.
 	"""
-	_redis.set('token:' + token, _json_convert(dataObj))
+	cache = _get_profile_cache()
+	_local.profiles = None
+	if cache and save:
+		cache.flush()
+
+@contextmanager
+def profile_cache():
+	"""
+		Cache profiles in the current thread while in the `with` block, so
+		every Redis hash of a profile is read (and every item decoded) at
+		most once, no matter how many times verify_request() and the get_*
+		functions use it. Items set with set_profile_fields() are written
+		once, at the end of the block; save_data() and save_class() write
+		immediately. API requests are wrapped in one automatically (see
+		api.py). Nested blocks use the outer cache.
+	"""
+	if _get_profile_cache():
+		yield
+		return
+	open_profile_cache()
+	saved = False
+	try:
+		yield
+		saved = True
+	finally:
+		close_profile_cache(saved)
+
+def _encode_class(class_obj: dict) -> dict:
+	"""
+		Convert a class to the fields of its hash: every part in
+		_CLASS_PARTS and every subject ("s:<subject ID>") is stored as
+		a separate field, `subjects` holds the number of subjects, and
+		everything else is stored in `meta`.
+	"""
+	fields = {}
+	meta = {}
+	for key, value in class_obj.items():
+		if key in _CLASS_PARTS:
+			fields[key] = _encode(value)
+		elif key == 'subjects':
+			fields['subjects'] = _encode(len(value) if value is not None else None)
+			for subject_id, subject in enumerate(value or []):
+				fields['s:%i' % subject_id] = _encode(subject)
+		else:
+			meta[key] = value
+	fields['meta'] = _encode(meta)
+	return fields
+
+def _decode_class(fields: dict) -> dict:
+	"""
+		Convert the fields of a class hash back to a class, see
+		_encode_class().
+	"""
+	fields = {key.decode('utf-8'): value for key, value in fields.items()}
+	class_obj = _decode(fields['meta'])
+	for part in _CLASS_PARTS:
+		if part in fields:
+			class_obj[part] = _decode(fields[part])
+	if 'subjects' in fields:
+		subject_count = _decode(fields['subjects'])
+		class_obj['subjects'] = None if subject_count is None else [_decode(fields['s:%i' % i]) for i in range(subject_count)]
+	return class_obj
+
+def _write_profile(token: str, dataObj, old_class_count: int, pipe=None):
+	"""
+		Store a whole profile: `token:<token>` is a hash with a field for
+		every item of the profile except `data` (see _encode()), and
+		`class_count`; every class is stored in its own hash
+		(`class:<token>:<class ID>`, see _encode_class()). If a pipeline
+		is given, the commands are only added to it, and the caller calls
+		_profile_changed() with the returned keys after executing it.
+		RETURNS: the changed keys
+	"""
+	fields = {key: _encode(value) for key, value in dataObj.items() if key != 'data'}
+	classes = dataObj['data']['classes']
+	fields['class_count'] = _encode(len(classes))
+	cache = _get_profile_cache()
+	if cache:
+		# The given profile replaces any items set before
+		cache.pending.pop(token, None)
+		cache.forget('token:' + token, *[_class_key(token, class_id) for class_id in range(max(len(classes), old_class_count))])
+	execute = pipe is None
+	if execute:
+		pipe = _redis.pipeline()
+	pipe.delete('token:' + token)
+	pipe.hset('token:' + token, mapping=fields)
+	pipe.sadd(_TOKEN_INDEX, token)
+	_write_classes(pipe, token, classes, old_class_count)
+	keys = ['token:' + token] + [_class_key(token, class_id) for class_id in range(max(len(classes), old_class_count))]
+	if execute:
+		pipe.execute()
+		_profile_changed(*keys)
+	return keys
+
+def _write_classes(pipe, token: str, classes: list, old_class_count: int):
+	for class_id, class_obj in enumerate(classes):
+		pipe.delete(_class_key(token, class_id))
+		pipe.hset(_class_key(token, class_id), mapping=_encode_class(class_obj))
+	for class_id in range(len(classes), old_class_count):
+		pipe.delete(_class_key(token, class_id))
+
+def get_class_count(token: str) -> int:
+	"""
+		Get the number of classes in a profile.
+	"""
+	cache = _get_profile_cache()
+	if cache:
+		return cache.get('token:' + token, 'class_count') or 0
+	value = _redis.hget('token:' + token, 'class_count')
+	return _decode(value) if value is not None else 0
+
+def get_profile_fields(token: str, *fields) -> dict:
+	"""
+		Get some items of a profile (e.g. "settings"), without the rest of
+		it. Items which aren't in the profile aren't in the returned dict.
+	"""
+	cache = _get_profile_cache()
+	if cache:
+		profile = cache.get_hash('token:' + token)
+		return {field: cache.get('token:' + token, field) for field in fields if field in profile}
+	values = _redis.hmget('token:' + token, fields)
+	return {field: _decode(value) for field, value in zip(fields, values) if value is not None}
+
+def set_profile_fields(token: str, **fields):
+	"""
+		Set some items of a profile (e.g. `new=[]`), without rewriting the
+		rest of it. Inside profile_cache(), the items are written at the
+		end of the block.
+	"""
+	encoded = {field: _encode(value) for field, value in fields.items()}
+	cache = _get_profile_cache()
+	if not cache:
+		_redis.hset('token:' + token, mapping=encoded)
+		_profile_changed('token:' + token)
+		return
+	cache.pending.setdefault(token, {}).update(encoded)
+	cache.hashes['token:' + token] = dict(cache.get_hash('token:' + token), **encoded)
+	for field, value in fields.items():
+		cache.decoded['token:' + token, field] = value
+
+def update_profile_fields(token: str, update, *fields) -> dict:
+	"""
+		Atomically change some items of a profile. `update` is called with
+		the current items (a dict, see get_profile_fields()) and returns a
+		dict of the items to set. If the profile is changed by someone else
+		before they're set, `update` is called again with the new items
+		(optimistic locking using WATCH/MULTI), so no change is lost. The
+		items are written immediately, even inside profile_cache(), and
+		nothing is written if the profile doesn't exist (e.g. if the user
+		logged out in the meantime).
+		RETURNS: the items before the change, or None if the profile doesn't exist
+	"""
+	key = 'token:' + token
+	cache = _get_profile_cache()
+	if cache:
+		cache.flush(token)
+	changed = {}
+	def transaction(pipe):
+		if not pipe.exists(key):
+			return None
+		values = pipe.hmget(key, fields) if fields else []
+		current = {field: _decode(value) for field, value in zip(fields, values) if value is not None}
+		previous = {field: _decode(value) for field, value in zip(fields, values) if value is not None}
+		changed.clear()
+		changed.update(update(current) or {})
+		pipe.multi()
+		if changed:
+			pipe.hset(key, mapping={field: _encode(value) for field, value in changed.items()})
+		return previous
+	previous = _redis.transaction(transaction, key, value_from_callable=True)
+	if changed:
+		_profile_changed(key)
+		if cache:
+			cache.forget(key)
+	return previous
+
+def take_profile_field(token: str, field: str, empty=None):
+	"""
+		Atomically get an item of a profile and replace it with `empty`
+		(e.g. get the new grades and mark them as seen), see
+		update_profile_fields(). Returns `empty` if the profile doesn't
+		have the item.
+	"""
+	previous = update_profile_fields(token, lambda _: {field: empty}, field)
+	return (previous or {}).get(field, empty)
+
+def get_class(token: str, class_id: int) -> dict:
+	"""
+		Get a single class of a profile.
+	"""
+	cache = _get_profile_cache()
+	if cache:
+		return _decode_class({field.encode('utf-8'): value for field, value in cache.get_hash(_class_key(token, class_id)).items()})
+	return _decode_class(_redis.hgetall(_class_key(token, class_id)))
+
+def get_class_part(token: str, class_id: int, part: str):
+	"""
+		Get a part of a class: "tests", "absences", "info", "meta"
+		(everything except the other parts and subjects) or "subjects"
+		(the number of subjects). Returns None if the class doesn't have
+		the part.
+	"""
+	cache = _get_profile_cache()
+	if cache:
+		return cache.get(_class_key(token, class_id), part)
+	value = _redis.hget(_class_key(token, class_id), part)
+	return _decode(value) if value is not None else None
+
+def get_class_subjects(token: str, class_id: int) -> list:
+	"""
+		Get the subjects of a class, or None if there are none.
+	"""
+	subject_count = get_class_part(token, class_id, 'subjects')
+	if subject_count is None:
+		return None
+	cache = _get_profile_cache()
+	if cache:
+		return [cache.get(_class_key(token, class_id), 's:%i' % i) for i in range(subject_count)]
+	values = _redis.hmget(_class_key(token, class_id), ['s:%i' % i for i in range(subject_count)])
+	return [_decode(value) for value in values]
+
+def get_class_subject(token: str, class_id: int, subject_id: int) -> dict:
+	"""
+		Get a single subject of a class.
+	"""
+	return get_class_part(token, class_id, 's:%i' % subject_id)
+
+def get_class_list(token: str) -> list:
+	"""
+		Get all classes of a profile without their parts and subjects
+		(only the "meta" part of each class).
+	"""
+	cache = _get_profile_cache()
+	if cache:
+		# Read the whole classes, which are usually needed next
+		return [cache.get(_class_key(token, class_id), 'meta') for class_id in range(get_class_count(token))]
+	pipe = _redis.pipeline(transaction=False)
+	for class_id in range(get_class_count(token)):
+		pipe.hget(_class_key(token, class_id), 'meta')
+	return [_decode(value) for value in pipe.execute()]
+
+def _write_existing_profile(token: str, write):
+	"""
+		Call `write` with a pipeline in a MULTI transaction and execute
+		it, but only if the profile exists. The profile is WATCHed, so if
+		it's purged in the meantime (e.g. by a logout during a sync),
+		nothing is written and no orphaned keys are left behind.
+		`write` may read from the pipeline before calling pipe.multi().
+		RETURNS: whether the profile existed and was written
+	"""
+	key = 'token:' + token
+	def transaction(pipe):
+		if not pipe.exists(key):
+			return False
+		write(pipe)
+		return True
+	return _redis.transaction(transaction, key, value_from_callable=True)
+
+def save_class(token: str, class_id: int, class_obj: dict, **fields) -> bool:
+	"""
+		Replace a single class of a profile and set some items (see
+		set_profile_fields()) in one transaction. Nothing is written if
+		the profile doesn't exist.
+		RETURNS: whether the class was saved
+	"""
+	cache = _get_profile_cache()
+	if cache:
+		cache.flush(token)
+		cache.forget('token:' + token, _class_key(token, class_id))
+	def write(pipe):
+		pipe.multi()
+		pipe.delete(_class_key(token, class_id))
+		pipe.hset(_class_key(token, class_id), mapping=_encode_class(class_obj))
+		if fields:
+			pipe.hset('token:' + token, mapping={field: _encode(value) for field, value in fields.items()})
+	if not _write_existing_profile(token, write):
+		return False
+	_profile_changed('token:' + token, _class_key(token, class_id))
+	return True
+
+def save_classes(token: str, classes: list, **fields) -> bool:
+	"""
+		Replace all classes of a profile and set some items (see
+		set_profile_fields()) in one transaction, without rewriting the
+		other items (e.g. settings changed in the meantime). Nothing is
+		written if the profile doesn't exist.
+		RETURNS: whether the classes were saved
+	"""
+	cache = _get_profile_cache()
+	if cache:
+		cache.flush(token)
+	fields['class_count'] = len(classes)
+	old_class_count = 0
+	def write(pipe):
+		nonlocal old_class_count
+		value = pipe.hget('token:' + token, 'class_count')
+		old_class_count = _decode(value) if value is not None else 0
+		pipe.multi()
+		pipe.hset('token:' + token, mapping={field: _encode(value) for field, value in fields.items()})
+		_write_classes(pipe, token, classes, old_class_count)
+	written = _write_existing_profile(token, write)
+	keys = ['token:' + token] + [_class_key(token, class_id) for class_id in range(max(len(classes), old_class_count))]
+	if cache:
+		cache.forget(*keys)
+	if written:
+		_profile_changed(*keys)
+	return written
+
+def migrate_profiles() -> int:
+	"""
+		Convert profiles stored in the previous format (a JSON string for
+		every token) to hashes, see _write_profile(). Returns the number
+		of converted profiles.
+	"""
+	migrated = 0
+	for key in _redis.scan_iter('token:*'):
+		if _redis.type(key) != b'string':
+			continue
+		value = _redis.get(key)
+		if value is None:
+			continue
+		_write_profile(key.decode('utf-8')[len('token:'):], _json_load(value), 0)
+		migrated += 1
+	return migrated
+
+# Replaces fields of a hash which still have the given values.
+# KEYS: hash; ARGV: field, old value, new value, ...
+_REWRITE_FIELDS = """
+local rewritten = 0
+for i = 1, #ARGV, 3 do
+	if redis.call('HGET', KEYS[1], ARGV[i]) == ARGV[i + 1] then
+		redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 2])
+		rewritten = rewritten + 1
+	end
+end
+return rewritten
+"""
+
+def _profile_format_id() -> str:
+	return '%s:%s:%i' % (_codec.serializer, _codec.compression, _codec.min_size)
+
+def migrate_profile_format() -> int:
+	"""
+		Rewrite the items of all profiles which aren't stored in the
+		configured format (see codec.py), e.g. after changing
+		PROFILE_SERIALIZER. Items changed while being rewritten are left
+		alone. Only one worker runs this at a time, and profiles aren't
+		checked again once all of them are in the configured format.
+		Returns the number of rewritten items.
+	"""
+	if _redis.get('profile-format') == _profile_format_id().encode('utf-8'):
+		return 0
+	if not _redis.set('profile-format:lock', 'LOCKED', nx=True, ex=3600):
+		return 0
+	log.info('Rewriting profiles in format %s', _profile_format_id())
+	rewritten = 0
+	try:
+		rewrite = _redis.register_script(_REWRITE_FIELDS)
+		for token in iter_tokens():
+			keys = ['token:' + token] + [_class_key(token, class_id) for class_id in range(get_class_count(token))]
+			for key in keys:
+				args = []
+				for field, value in _redis.hgetall(key).items():
+					if not _codec.is_current(value):
+						args += [field, value, _encode(_decode(value))]
+				if args:
+					rewritten += rewrite(keys=[key], args=args)
+					_profile_changed(key)
+		_redis.set('profile-format', _profile_format_id())
+	finally:
+		_redis.delete('profile-format:lock')
+	log.info('Rewrote %i profile items in format %s', rewritten, _profile_format_id())
+	return rewritten
+
+def _migrate_profile_format():
+	setproctitle.setproctitle('eDAP profile format migration thread')
+	try:
+		migrate_profile_format()
+	except Exception as e:
+		log.error('Rewriting profiles failed: %s', e)
 
 def get_db_size() -> int:
 	"""
@@ -609,26 +1184,32 @@ def get_db_size() -> int:
 	"""
 	return _get_file_size(_join_path(config.storage, "appendonly.aof"))
 
-def check_inactive_fb_tokens(auto_delete: bool = False) -> dict:
+def check_inactive_fb_tokens(auto_delete: bool = False, restart: bool = False) -> dict:
 	"""
 		Check for inactive Firebase tokens in DB and delete associated
-		user if specified.
+		user if specified. This is a resumable job (see run_bulk_job());
+		if it continues an interrupted run, tokens found by that run aren't
+		returned.
 	"""
-	tokens = get_tokens()
-	log.info('Verifying %i Firebase tokens', len(tokens))
+	log.info('Verifying Firebase tokens')
 	returnable = {'inactive_tokens': [], 'deleted_tokens': []}
-	for token in tokens:
-		fb_token = get_data(token)['firebase_device_token']
-		if fb_token:
-			out = get_firebase_info(fb_token)
-			if not out['status']:
+	def check_batch(tokens):
+		pipe = _redis.pipeline(transaction=False)
+		for token in tokens:
+			pipe.hget('token:' + token, 'firebase_device_token')
+		for token, fb_token in zip(tokens, pipe.execute()):
+			fb_token = _decode(fb_token) if fb_token is not None else None
+			if fb_token:
+				out = get_firebase_info(fb_token)
+				if not out['status']:
+					returnable['inactive_tokens'].append(token)
+					if auto_delete:
+						purge_token(token)
+						returnable['deleted_tokens'].append(token)
+			else:
+				log.info('FB token is null value for %s', token)
 				returnable['inactive_tokens'].append(token)
-				if auto_delete:
-					purge_token(token)
-					returnable['deleted_tokens'].append(token)
-		else:
-			log.info('FB token is null value for %s', token)
-			returnable['inactive_tokens'].append(token)
+	run_bulk_job('firebase', check_batch, restart)
 	log.info('Verification returned %i inactive Firebase tokens', len(returnable['inactive_tokens']))
 	return returnable
 
@@ -657,7 +1238,7 @@ def sendNotification(token: str, title: str, content: str, data=None):
 	if not verify_request(token):
 		raise Exception("Bad token")
 	log.info("Sending notification to %s", token)
-	firebase_token = get_data(token)["firebase_device_token"]
+	firebase_token = get_profile_fields(token, 'firebase_device_token')["firebase_device_token"]
 
 	out_json = {
 		"to": firebase_token,
@@ -685,19 +1266,94 @@ def sendNotification(token: str, title: str, content: str, data=None):
 		log.error('Non-200 code (Firebase Cloud Messaging) => %s', str(e))
 		raise e
 
+def _guarded_sync(token: str) -> bool:
+	"""
+		Sync a token unless the upstream circuit breaker is open, and
+		record the outcome in the breaker. Returns whether the sync was
+		done.
+	"""
+	if not _breaker.allow():
+		log.debug("Upstream circuit breaker is open, skipping sync for %s", token)
+		return False
+	try:
+		sync(token)
+	except (edap.NetworkError, edap.ServerInMaintenance) as e:
+		log.warning("Upstream failure while syncing %s: %s", token, repr(e))
+		_breaker.record_failure(repr(e))
+		return False
+	_breaker.record_success()
+	return True
+
 def _sync(token: str):
 	"""
-		Wrapper around sync, for bg execution (random timeout).
+		Wrapper around sync, for bg execution (random timeout). While the
+		upstream circuit breaker is open, the thread waits for the next
+		probe (plus a random delay) instead.
 	"""
 	setproctitle.setproctitle('eDAP sync thread [%s]' % token)
 	t = currentThread()
+	val = randint(config.sync.min_delay, config.sync.max_delay)
 	while getattr(t, 'do_run', True):
-		val = randint(config.sync.min_delay, config.sync.max_delay)
 		log.debug("Waiting %i s for %s", val, token)
 		sleep(val)
-		sync(token)
+		_guarded_sync(token)
+		val = _breaker.retry_delay() or randint(config.sync.min_delay, config.sync.max_delay)
 	log.info('Sync thread %s ending', token)
 
+def _probe_upstream() -> bool:
+	"""
+		Check whether e-Dnevnik is available (and not in maintenance),
+		used by the upstream circuit breaker.
+	"""
+	r = requests.get(config.upstream.url + '/login', timeout=(config.upstream.connect_timeout, config.upstream.read_timeout))
+	return r.status_code == 200 and 'u nadogradnji' not in r.text
+
+def _breaker_changed(state: str, info: dict):
+	"""
+		Log and send a notification when the upstream circuit breaker
+		opens or closes.
+	"""
+	if state == 'open':
+		log.error('Upstream circuit breaker OPEN after %i failures (%s), pausing syncs', info['failures'], info['reason'])
+		if config.error_notifications.enabled:
+			notify_error('UPSTREAM UNAVAILABLE', 'sync', additional_info={'Failures': info['failures'], 'Last error': info['reason']})
+	else:
+		log.warning('Upstream circuit breaker CLOSED after %i s, resuming syncs', time() - info['since'])
+		if config.error_notifications.enabled:
+			notify_error('UPSTREAM RECOVERED', 'sync', additional_info={'Outage length (s)': int(time() - info['since'])})
+
+def get_rate_limit_stats() -> dict:
+	"""
+		Get the request, throttling and waiting counters of the upstream
+		rate limiter, see ratelimit.py.
+	"""
+	if not _limiter:
+		return {'enabled': False}
+	return dict(_limiter.stats(), enabled=True, rate=_limiter.rate, burst=_limiter.burst)
+
+def get_breaker_state() -> dict:
+	"""
+		Get the state of the upstream circuit breaker, see breaker.py.
+	"""
+	return _breaker.state()
+
+def upstream_failed(reason: str) -> bool:
+	"""
+		Record an upstream failure outside of syncs (e.g. when logging in)
+		in the circuit breaker. Returns whether the failure is part of an
+		outage the breaker already knows about, so there's no need to
+		notify about it again.
+	"""
+	known = _breaker.is_open()
+	_breaker.record_failure(reason)
+	return known or _breaker.is_open()
+
+def upstream_succeeded():
+	"""
+		Record a successful upstream request outside of syncs.
+	"""
+	_breaker.record_success()
+
 def _get_var(varname: str, _bool: bool = False, default=None):
 	"""
 		Get environment variable and return it if it exists. If _bool is True,
@@ -762,6 +1418,55 @@ def _read_config() -> Config:
 			print("[eDAP] [WARN] Administrative notifications have been disabled; both the bot token and target UID need to be specified!")
 			cfg_obj.error_notifications.enabled = False
 
+	cfg_obj.upstream.url = _get_var("UPSTREAM_URL", default="https://ocjene.skole.hr")
+	cfg_obj.upstream.persistent = _get_var("UPSTREAM_KEEPALIVE", _bool=True, default=True)
+	cfg_obj.upstream.pool_size = int(_get_var("UPSTREAM_POOL_SIZE", default=10))
+	cfg_obj.upstream.connect_timeout = float(_get_var("UPSTREAM_CONNECT_TIMEOUT", default=10))
+	cfg_obj.upstream.read_timeout = float(_get_var("UPSTREAM_READ_TIMEOUT", default=30))
+	cfg_obj.upstream.subject_workers = int(_get_var("UPSTREAM_SUBJECT_WORKERS", default=4))
+	cfg_obj.upstream.cache_size = int(_get_var("UPSTREAM_CACHE_SIZE", default=2097152))
+	cfg_obj.upstream.cache_compress = _get_var("UPSTREAM_CACHE_COMPRESS", _bool=True)
+	cfg_obj.upstream.batch_workers = int(_get_var("UPSTREAM_BATCH_WORKERS", default=8))
+
+	cfg_obj.ratelimit.rate = float(_get_var("RATE_LIMIT", default=0))
+	cfg_obj.ratelimit.burst = int(_get_var("RATE_LIMIT_BURST", default=0))
+	cfg_obj.ratelimit.reserve = float(_get_var("RATE_LIMIT_RESERVE", default=0.2))
+
+	cfg_obj.breaker.threshold = int(_get_var("BREAKER_THRESHOLD", default=5))
+	cfg_obj.breaker.probe_delay = int(_get_var("BREAKER_PROBE_DELAY", default=60))
+	cfg_obj.breaker.max_probe_delay = int(_get_var("BREAKER_MAX_PROBE_DELAY", default=3600))
+	cfg_obj.breaker.resume_spread = int(_get_var("BREAKER_RESUME_SPREAD", default=600))
+
+	cfg_obj.profile_format.serializer = _get_var("PROFILE_SERIALIZER", default='json')
+	cfg_obj.profile_format.compression = _get_var("PROFILE_COMPRESSION", default='none')
+	cfg_obj.profile_format.compress_min_size = int(_get_var("PROFILE_COMPRESS_MIN_SIZE", default=512))
+	cfg_obj.profile_format.migrate = _get_var("PROFILE_MIGRATE", _bool=True, default=True)
+	if cfg_obj.profile_format.serializer not in codec.SERIALIZERS:
+		print("[eDAP] [ERROR] Unknown profile serializer %s!" % cfg_obj.profile_format.serializer)
+		_exit(1)
+	if cfg_obj.profile_format.compression not in codec.COMPRESSIONS:
+		print("[eDAP] [ERROR] Unknown profile compression %s!" % cfg_obj.profile_format.compression)
+		_exit(1)
+	if cfg_obj.profile_format.serializer == 'msgpack' and not codec.msgpack:
+		print("[eDAP] [WARN] Storing profiles as JSON; the msgpack package isn't installed!")
+		cfg_obj.profile_format.serializer = 'json'
+	if cfg_obj.profile_format.compression == 'zstd' and not codec.zstandard:
+		print("[eDAP] [WARN] Compressing profiles with zlib; the zstandard package isn't installed!")
+		cfg_obj.profile_format.compression = 'zlib'
+
+	cfg_obj.bulk.batch_size = int(_get_var("BULK_BATCH_SIZE", default=100))
+
+	cfg_obj.hash_cache.size = int(_get_var("PROFILE_CACHE_SIZE", default=33554432))
+	cfg_obj.hash_cache.ttl = float(_get_var("PROFILE_CACHE_TTL", default=300))
+
+	cfg_obj.sessions.enabled = _get_var("SESSION_REUSE", _bool=True)
+	cfg_obj.sessions.ttl = int(_get_var("SESSION_TTL", default=21600))
+	if cfg_obj.sessions.enabled:
+		cfg_obj.sessions.key = _get_var("SESSION_KEY")
+		if not cfg_obj.sessions.key:
+			print("[eDAP] [WARN] Session reuse has been DISABLED; no encryption key was specified!")
+			cfg_obj.sessions.enabled = False
+
 	cfg_obj.redis.connection_type = _get_var("REDIS_CONN_TYPE", default='tcp')
 	cfg_obj.redis.address = _get_var("REDIS_ADDR", default='127.0.0.1')
 	cfg_obj.redis.port = int(_get_var("REDIS_PORT", default=6379))
@@ -771,6 +1476,15 @@ def _read_config() -> Config:
 	print("[eDAP] [INFO] Send administrative notifications: %s" % cfg_obj.error_notifications.enabled)
 	print("[eDAP] [INFO] Waiting between %s and %s seconds before syncing for each user" % (cfg_obj.sync.min_delay, cfg_obj.sync.max_delay))
 	print("[eDAP] [INFO] Automatically adjusting sync times: %s" % cfg_obj.sync.auto_adjust)
+	print("[eDAP] [INFO] Keeping upstream connections alive: %s (pool size %s)" % (cfg_obj.upstream.persistent, cfg_obj.upstream.pool_size))
+	print("[eDAP] [INFO] Upstream timeouts: %s s (connect), %s s (read)" % (cfg_obj.upstream.connect_timeout, cfg_obj.upstream.read_timeout))
+	print("[eDAP] [INFO] Fetching up to %s subjects at the same time" % cfg_obj.upstream.subject_workers)
+	print("[eDAP] [INFO] Syncing up to %s users at the same time" % cfg_obj.upstream.batch_workers)
+	print("[eDAP] [INFO] Upstream request limit: %s/s" % (cfg_obj.ratelimit.rate or 'none'))
+	print("[eDAP] [INFO] Pausing syncs after %s upstream failures in a row" % cfg_obj.breaker.threshold)
+	print("[eDAP] [INFO] Storing profiles as %s (compression: %s)" % (cfg_obj.profile_format.serializer, cfg_obj.profile_format.compression))
+	print("[eDAP] [INFO] Profile cache size per worker: %s" % (convert_size(cfg_obj.hash_cache.size) if cfg_obj.hash_cache.size else 'disabled'))
+	print("[eDAP] [INFO] Reusing upstream sessions: %s" % cfg_obj.sessions.enabled)
 	print("[eDAP] [INFO] Redis connection type: %s" % ('TCP' if cfg_obj.redis.connection_type == 'tcp' else 'UNIX socket'))
 	print("[eDAP] [INFO] Redis address/path: %s" % cfg_obj.redis.address)
 	if cfg_obj.redis.connection_type == 'tcp':
@@ -832,184 +1546,387 @@ def _init_db(host: str = "localhost", port: int = 6379, db: int = 0, unix_socket
 
 def get_data(token: str):
 	"""
-		Retreive JSON from Redis by token, format it from bytes to string,
-		and return it as a dict.
+		Retreive the whole profile of a token from Redis and return it as
+		a dict. Use get_profile_fields() and the get_class*() functions to
+		get only a part of it.
 	"""
-	try:
-		return _json_load(_redis.get("token:" + token).decode("utf-8"))
-	except AttributeError:
+	cache = _get_profile_cache()
+	if cache:
+		cache.flush(token)
+	profile = get_profiles([token]).get(token)
+	if profile is None:
 		notify_error('DATA GET ERROR', 'get_data', additional_info={'token':token})
+	return profile
+
+def get_profiles(tokens: List[str]) -> dict:
+	"""
+		Get the whole profiles of many tokens at once (with two pipelines),
+		see get_data(). Tokens without a profile are left out.
+		RETURNS: dict formatted {token: profile}
+	"""
+	pipe = _redis.pipeline(transaction=False)
+	for token in tokens:
+		pipe.hgetall('token:' + token)
+	profiles = {}
+	for token, fields in zip(tokens, pipe.execute()):
+		if fields:
+			profiles[token] = {key.decode('utf-8'): _decode(value) for key, value in fields.items()}
+	pipe = _redis.pipeline(transaction=False)
+	for token, profile in profiles.items():
+		for class_id in range(profile['class_count']):
+			pipe.hgetall(_class_key(token, class_id))
+	class_hashes = iter(pipe.execute())
+	for profile in profiles.values():
+		profile['data'] = {'classes': [_decode_class(next(class_hashes)) for _ in range(profile.pop('class_count'))]}
+	return profiles
+
+def save_profiles(profiles: dict):
+	"""
+		Save the whole profiles of many tokens at once (with two
+		pipelines), see save_data().
+
+		== ARGUMENTS
+		profiles - dict formatted {token: profile}
+	"""
+	tokens = list(profiles)
+	pipe = _redis.pipeline(transaction=False)
+	for token in tokens:
+		pipe.hget('token:' + token, 'class_count')
+	class_counts = [_decode(value) if value is not None else 0 for value in pipe.execute()]
+	pipe = _redis.pipeline()
+	changed = []
+	for token, class_count in zip(tokens, class_counts):
+		changed += _write_profile(token, profiles[token], class_count, pipe)
+	pipe.execute()
+	_profile_changed(*changed)
+
+def run_bulk_job(name: str, func, restart: bool = False) -> dict:
+	"""
+		Run `func` on batches of all tokens as a resumable job, see
+		bulk.BulkJob.run(). Raises bulk.JobRunning if the job is already
+		running.
+	"""
+	return bulk.BulkJob(_redis, name, _TOKEN_INDEX, config.bulk.batch_size).run(func, restart)
+
+def update_profiles(name: str, transform, restart: bool = False) -> dict:
+	"""
+		Update all profiles as a resumable job (see run_bulk_job()): the
+		profiles of every batch of tokens are read at once and passed to
+		`transform` as a dict formatted {token: profile}, and the profiles
+		it returns (in the same format) are saved at once.
+	"""
+	def update_batch(tokens):
+		changed = transform(get_profiles(tokens))
+		if changed:
+			save_profiles(changed)
+	return run_bulk_job(name, update_batch, restart)
+
+def get_bulk_jobs() -> dict:
+	"""
+		RETURNS: dict formatted {<job name>: progress}, see bulk.BulkJob.progress()
+	"""
+	return {name: bulk.BulkJob(_redis, name, _TOKEN_INDEX).progress() for name in BULK_JOBS}
+
+def iter_tokens():
+	"""
+		Iterate over all tokens in the DB, without blocking Redis (uses
+		SSCAN on the token index). Tokens added or removed while iterating
+		may or may not be returned.
+	"""
+	for token in _redis.sscan_iter(_TOKEN_INDEX, count=500):
+		yield token.decode('utf-8')
 
 def get_tokens() -> List[str]:
 	"""
 		Return a list of all tokens in the DB.
 	"""
-	return [i.decode('utf-8').replace("token:", "") for i in _redis.keys('token:*')]
+	return list(iter_tokens())
 
 def _user_in_database(token: str) -> bool:
 	"""
 		Check if a given token exists in the DB.
 	"""
-	return "token:" + token in [i.decode('utf-8') for i in _redis.keys('token:*')]
+	cache = _get_profile_cache()
+	if cache:
+		return bool(cache.get_hash('token:' + token))
+	return _redis.exists('token:' + token) > 0
+
+def index_tokens() -> int:
+	"""
+		Bring the token and dev token indexes (Redis sets of all tokens,
+		see iter_tokens()) up to date with the stored keys, using SCAN.
+		Needed when upgrading from a version without the indexes; once
+		it's done, the indexes are kept up to date when saving and purging
+		profiles, so it isn't run again. Returns the number of tokens added.
+	"""
+	if _redis.exists('token-index'):
+		return 0
+	added = 0
+	for index, prefix in ((_TOKEN_INDEX, 'token:'), (_DEV_TOKEN_INDEX, 'dev-token:')):
+		pipe = _redis.pipeline(transaction=False)
+		for key in _redis.scan_iter(prefix + '*', count=500):
+			pipe.sadd(index, key.decode('utf-8')[len(prefix):])
+		added += sum(pipe.execute())
+		# Remove tokens whose keys are gone
+		for _, tokens in bulk.scan_batches(_redis, index, config.bulk.batch_size):
+			pipe = _redis.pipeline(transaction=False)
+			for token in tokens:
+				pipe.exists(prefix + token)
+			missing = [token for token, exists in zip(tokens, pipe.execute()) if not exists]
+			if missing:
+				_redis.srem(index, *missing)
+	_redis.set('token-index', 1)
+	return added
 
 def _class_id_exists(token: str, cid: int) -> bool:
 	"""
 		Check if a given class ID exists in the DB. Assumes that userInDatabase()
 		was already called and returned True.
 	"""
-	data = get_data(token)['data']['classes']
-	if cid <= len(data) and cid > 0:
-		return 'full' in data[cid]
+	if cid <= get_class_count(token) and cid > 0:
+		meta = get_class_part(token, cid, 'meta')
+		return meta is not None and 'full' in meta
 
 def _subject_id_exists(token: str, cid: int, sid: int) -> bool:
 	"""
 		Check if a given subject ID exists in the DB. Assumes that userInDatabase()
 		and classIDExists() were both already called and returned True.
 	"""
-	return sid in range(len(get_data(token)['data']['classes'][cid]['subjects']))
+	cache = _get_profile_cache()
+	if cache:
+		return 's:%i' % sid in cache.get_hash(_class_key(token, cid))
+	return _redis.hexists(_class_key(token, cid), 's:%i' % sid)
+
+def _edap_options() -> dict:
+	"""
+		Return the upstream connection parameters from the config, as
+		arguments for eDAP. Requests are rate limited using the
+		interactive lane, unless `throttle` is overridden (as by syncs).
+	"""
+	return {
+		'edurl': config.upstream.url,
+		'persistent': config.upstream.persistent,
+		'pool_size': config.upstream.pool_size,
+		'timeout': (config.upstream.connect_timeout, config.upstream.read_timeout),
+		'cache_size': config.upstream.cache_size,
+		'cache_compress': config.upstream.cache_compress,
+		'throttle': _limiter.lane('interactive') if _limiter else None
+	}
 
-def fetch_new_class(token: str, class_id: int):
+def _init_batch_scraper() -> batch.BatchScraper:
 	"""
-		Fetch a new class. Handles all the background credential collection
-		and other things.
+		Create the batch scraper used for syncs and bulk operations, with
+		the upstream connection parameters from the config.
 	"""
-	full_data = get_data(token)
-	# If not already pulled
-	if not 'full' in full_data['data']['classes'][class_id]:
-		credentials = get_credentials(token)
-		edap_object = edap.edap(credentials['username'], credentials['password'])
-		# Get the classes so they're saved in the object
-		edap_object.getClasses()
-		# Overwrite existing "bare" class profile with new complete profile
-		full_data['data']['classes'][class_id] = get_class_profile(
-			edap_object,
-			class_id,
-			full_data['data']['classes'][class_id]
-		)
-		save_data(token, full_data)
+	options = _edap_options()
+	# The batch scraper has its own shared connection pool, and uses the
+	# background lane of the rate limiter
+	del options['persistent'], options['pool_size'], options['throttle']
+	return batch.BatchScraper(
+		workers=config.upstream.batch_workers,
+		subject_workers=config.upstream.subject_workers,
+		throttle=_limiter.lane('background') if _limiter else None,
+		**options
+	)
 
-def populate_data(obj) -> dict:
+def get_batch_scraper() -> batch.BatchScraper:
 	"""
-		Call get_class_profile() to initialize the data object in
-		a newly-created profile.
+		Return the batch scraper shared by syncs and bulk operations
+		(e.g. /dev/recreate), see batch.py.
 	"""
-	# TODO: Should probably be merged with `get_class_profile()`.
-	data_dict = {'classes':None}
-	try:
-		output = obj.getClasses()
-	except Exception as e:
-		log.error("Error getting classes: %s", e)
-		raise e
+	return _batch
 
-	output[0] = get_class_profile(obj, 0, output[0])
-	data_dict['classes'] = output
-	return data_dict
-
-def get_class_profile(obj, class_id: int, class_obj) -> dict:
+def edap_login(username: str, password: str, **kwargs) -> edap.edap:
 	"""
-		Add/modify a list of classes from eDAP. `class_id` is the
-		class ID that will be "expanded" (add grades, exams, etc.)
-		and class_obj is the class object to which the data will
-		be assigned to.
+		Log in to e-Dnevnik, using the upstream connection parameters
+		from the config (unless overridden by `kwargs`).
 	"""
-	# TODO: Rewrite a lot of this and the invoking code, makes very little sense right now; handle exceptions properly.
-	obj.switchActiveClass(class_id)
-	try:
-		# Get a list of current tests and all tests
-		tests = obj.getTests()
-		# Init a testId var so we can assign an ID to the tests
-		testId = 0
-		for x in tests:
-			x['id'] = testId
-			testId += 1
-		# Create a new 'tests' item in the dictionary
-		class_obj['tests'] = tests
-	except Exception as e:
-		log.error("Error getting tests for class: %s", e)
-		class_obj['tests'] = None
+	return edap.edap(username, password, **dict(_edap_options(), **kwargs))
 
+def save_upstream_session(token: str, edap_object: edap.edap, class_id: int = None):
 	"""
-	try:
-		# Get an overview of absences (counters)
-		absences_overview = obj.getAbsenceOverview(class_id)
-		class_obj['absences'] = {'overview':absences_overview, 'full': []}
-	except Exception as e:
-		log.error("Error getting absence overview for class: %s", e)
-		class_obj['absences'] = {'overview': None, 'full': []}
+		Encrypt and store the e-Dnevnik session of an eDAP object, so that
+		the next sync can resume it instead of logging in.
+
+		If `class_id` is given, the session is stored as the session of
+		that class (see fetch_new_class()) instead.
 	"""
-	try:
-		# If we have an overview, we can continue with making a full
-		# list of absences, sorted by day.
-		if class_obj['absences']['overview']:
-			absences_full = obj.getAbsenceList()
-			class_obj['absences']['full'] = absences_full
-	except Exception as e:
-		log.error("Error getting absence full list for class: %s", e)
+	if not config.sessions.enabled:
+		return
+	state = Fernet(config.sessions.key).encrypt(_json_convert(edap_object.exportSession()).encode('utf-8'))
+	if class_id is None:
+		_redis.set('session:' + token, state, ex=config.sessions.ttl)
+		return
+	pipe = _redis.pipeline()
+	pipe.hset('class-sessions:' + token, str(class_id), state)
+	pipe.expire('class-sessions:' + token, config.sessions.ttl)
+	pipe.execute()
 
+def _discard_upstream_session(token: str, class_id: int = None):
+	if class_id is None:
+		_redis.delete('session:' + token)
+	else:
+		_redis.hdel('class-sessions:' + token, str(class_id))
+
+def _load_upstream_session(token: str, class_id: int = None):
+	"""
+		Get and decrypt the stored e-Dnevnik session for a token (or for
+		one of its classes). Returns None if there is no (valid) stored
+		session.
+	"""
+	if not config.sessions.enabled:
+		return None
+	if class_id is None:
+		state = _redis.get('session:' + token)
+	else:
+		state = _redis.hget('class-sessions:' + token, str(class_id))
+	if not state:
+		return None
 	try:
-		# Get a list of subjects
-		class_obj['subjects'] = obj.getSubjects()
-	except Exception as e:
-		log.error("Error getting subjects for class: %s", e)
-		class_obj['subjects'] = None
-	# Init a list of average grades for all subjects (for calculating
-	# the general average)
-	allSubjAverageGrades = []
-	for z in range(len(class_obj['subjects'])):
-		class_obj['subjects'][z]['id'] = z
+		return _json_load(Fernet(config.sessions.key).decrypt(state))
+	except InvalidToken:
+		log.warning('Failed to decrypt stored session for %s, discarding it', token)
+		_discard_upstream_session(token, class_id)
+		return None
+
+def with_upstream_session(token: str, scrape, **kwargs):
+	"""
+		Call `scrape` with an eDAP object for a token and return its result.
+		`kwargs` are passed on to eDAP, overriding the upstream connection
+		parameters from the config.
+
+		The stored e-Dnevnik session is resumed if possible, which skips
+		logging in (and getting the credentials). If there is no stored
+		session, or e-Dnevnik redirects to the login page, we log in using
+		the stored credentials and call `scrape` again. The session is then
+		stored for the next call.
+	"""
+	state = _load_upstream_session(token)
+	if state:
 		try:
-			# Get a list of all grades
-			class_obj['subjects'][z]['grades'], class_obj['subjects'][z]['notes'] = obj.getGrades(z)
-			# Check if we have a concluded grade
-			isconcl, concluded = obj.getConcludedGrade(z)
-			# Store the boolean for use in the UI
-			class_obj['subjects'][z]['concluded'] = isconcl
-			if isconcl:
-				# Skip calculating grade if it's already concluded
-				class_obj['subjects'][z]['average'] = concluded
-				allSubjAverageGrades.append(concluded)
-			elif class_obj['subjects'][z]['grades']:
-				# Otherwise do the standard calculating (sum(grades)/len(grades))
-				lgrades = []
-				for i in class_obj['subjects'][z]['grades']:
-					lgrades.append(i['grade'])
-				class_obj['subjects'][z]['average'] = _round(sum(lgrades)/len(lgrades), 2)
-				allSubjAverageGrades.append(_round(sum(lgrades)/len(lgrades), 0))
-			else:
-				log.debug('No grades for sID %s', z)
-		except Exception as e:
-			log.error("Error getting grades for subject %s: %s", z, e)
-			class_obj['subjects'][z]['grades'] = []
+			with edap.edap.resume(state, **dict(_edap_options(), **kwargs)) as edap_object:
+				result = scrape(edap_object)
+			log.debug("Upstream connections for %s: %s", token, edap_object.getConnectionStats())
+			log.debug("Page cache for %s: %s", token, edap_object.getCacheStats())
+			save_upstream_session(token, edap_object)
+			return result
+		except edap.SessionExpired:
+			log.debug('Stored session for %s has expired, logging in', token)
+			_discard_upstream_session(token)
+	credentials = get_credentials(token)
+	with edap_login(credentials['username'], credentials['password'], **kwargs) as edap_object:
+		result = scrape(edap_object)
+	log.debug("Upstream connections for %s: %s", token, edap_object.getConnectionStats())
+	log.debug("Page cache for %s: %s", token, edap_object.getCacheStats())
+	save_upstream_session(token, edap_object)
+	return result
+
+def _resume_class_session(token: str, class_id: int):
+	"""
+		Resume the stored e-Dnevnik session of a class, returning None if
+		there is none or it has expired.
+	"""
+	state = _load_upstream_session(token, class_id)
+	if not state:
+		return None
+	edap_object = edap.edap.resume(state, **_edap_options())
 	try:
-		# Calculate the general average
-		class_obj['complete_avg'] = _round(sum(allSubjAverageGrades)/len(allSubjAverageGrades), 2)
-	except ZeroDivisionError:
-		# Avoid division by zero/no grades
-		class_obj['complete_avg'] = 0
-	"""
+		# Get the classes so they're saved in the object
+		edap_object.getClasses()
+		return edap_object
+	except edap.SessionExpired:
+		log.debug('Stored session of class %s for %s has expired', class_id, token)
+		edap_object.close()
+		_discard_upstream_session(token, class_id)
+		return None
+
+def _open_class_sessions(token: str, class_ids: List[int]) -> dict:
+	"""
+		Return an eDAP object with its own e-Dnevnik session for every
+		class, formatted {class_id: edap}. Stored class sessions are
+		resumed; for the other classes, we log in once and open the
+		remaining sessions from that one (see edap.openSession()), all
+		at the same time.
+	"""
+	sessions = {}
 	try:
-		# Finally, get user information
-		class_obj['info'] = obj.getInfo(0)
-	except Exception as e:
-		log.error("Error getting info: %s", str(e))
-		class_obj['info'] = None
+		with ThreadPoolExecutor(max_workers=len(class_ids)) as executor:
+			for class_id, edap_object in zip(class_ids, executor.map(lambda class_id: _resume_class_session(token, class_id), class_ids)):
+				if edap_object:
+					sessions[class_id] = edap_object
+			missing = [class_id for class_id in class_ids if class_id not in sessions]
+			if missing:
+				credentials = get_credentials(token)
+				first = edap_login(credentials['username'], credentials['password'])
+				sessions[missing[0]] = first
+				first.getClasses()
+				for class_id, edap_object in zip(missing[1:], executor.map(lambda _: first.openSession(credentials['password']), missing[1:])):
+					sessions[class_id] = edap_object
+	except Exception:
+		_close_class_sessions(sessions)
+		raise
+	return sessions
+
+def _close_class_sessions(sessions: dict):
+	# Sessions opened from another one share its connections, so those are closed last
+	for edap_object in sorted(sessions.values(), key=lambda edap_object: edap_object.owns_adapter):
+		edap_object.close()
+
+def fetch_new_class(token: str, class_ids):
+	"""
+		Fetch (expand) one or more classes, given as a class ID or a list
+		of them. Handles all the background credential collection and
+		other things.
+
+		The classes are expanded at the same time, each using its own
+		e-Dnevnik session. The sessions are stored for each class, so
+		fetching classes again resumes them instead of logging in.
+	"""
+	if isinstance(class_ids, int):
+		class_ids = [class_ids]
+	classes = {class_id: get_class(token, class_id) for class_id in dict.fromkeys(class_ids)}
+	# Only classes which aren't already pulled
+	classes = {class_id: class_obj for class_id, class_obj in classes.items() if not 'full' in class_obj}
+	if not classes:
+		return
+	sessions = _open_class_sessions(token, list(classes))
+	try:
+		# Overwrite existing "bare" class profiles with new complete profiles
+		profiles.expand_classes(sessions, classes, subject_workers=config.upstream.subject_workers)
+		for class_id, edap_object in sessions.items():
+			save_upstream_session(token, edap_object, class_id)
+	finally:
+		_close_class_sessions(sessions)
+	for class_id, class_obj in classes.items():
+		save_class(token, class_id, class_obj)
+
+def populate_data(obj, previous: dict = None) -> dict:
 	"""
-	# Mark it as full/expanded
-	class_obj['full'] = True
-	return class_obj
+		Build the data object of a profile, see profiles.populate_data().
+	"""
+	return profiles.populate_data(obj, previous, config.upstream.subject_workers)
+
+def get_class_profile(obj, class_id: int, class_obj, previous: dict = None) -> dict:
+	"""
+		Expand a class, see profiles.get_class_profile().
+	"""
+	return profiles.get_class_profile(obj, class_id, class_obj, previous, config.upstream.subject_workers)
 
 def verify_dev_request(token: str) -> bool:
 	"""
 		Verify if a given dev API token is valid.
 	"""
-	return "dev-token:" + token in [i.decode('utf-8') for i in _redis.keys('dev-token:*')]
+	return _redis.exists('dev-token:' + token) > 0
 
 def add_dev_token() -> str:
 	"""
 		Authorizes a dev API token.
 	"""
 	token = hash_password(random_string(28))
-	_redis.set('dev-token:' + token, 'ALLOWED')
+	pipe = _redis.pipeline()
+	pipe.set('dev-token:' + token, 'ALLOWED')
+	pipe.sadd(_DEV_TOKEN_INDEX, token)
+	pipe.execute()
 	return token
 
 def verify_request(token: str, class_id=None, subject_id=None) -> bool:
@@ -1071,3 +1988,31 @@ _redis = _init_db(
 	port=config.redis.port,
 	unix_socket=(config.redis.connection_type == 'unix')
 )
+if config.hash_cache.size:
+	_hash_cache = hashcache.HashCache(_redis, config.hash_cache.size, config.hash_cache.ttl)
+_codec = codec.ProfileCodec(
+	config.profile_format.serializer,
+	config.profile_format.compression,
+	config.profile_format.compress_min_size,
+	default=edap.json_default
+)
+if config.ratelimit.rate:
+	_limiter = ratelimit.RateLimiter(_redis, config.ratelimit.rate, config.ratelimit.burst or None, config.ratelimit.reserve)
+_batch = _init_batch_scraper()
+_migrated = migrate_profiles()
+if _migrated:
+	print("[eDAP] [INFO] Converted %i profiles to the new storage format" % _migrated)
+_indexed = index_tokens()
+if _indexed:
+	print("[eDAP] [INFO] Added %i tokens to the token index" % _indexed)
+if config.profile_format.migrate:
+	Thread(target=_migrate_profile_format, daemon=True).start()
+_breaker = breaker.CircuitBreaker(
+	_redis,
+	_probe_upstream,
+	threshold=config.breaker.threshold,
+	probe_delay=config.breaker.probe_delay,
+	max_probe_delay=config.breaker.max_probe_delay,
+	resume_spread=config.breaker.resume_spread,
+	on_change=_breaker_changed
+)
@@ -16,6 +16,13 @@ class Config:
 		firebase: FCM (Firebase Cloud Messaging) parameters.
 		cloudflare: Cloudflare parameters.
 		error_notifications: Parameters for notifications about critical errors.
+		upstream: Parameters for connections to e-Dnevnik.
+		breaker: Parameters for pausing syncs while e-Dnevnik is unavailable.
+		ratelimit: Parameters for limiting the rate of requests to e-Dnevnik.
+		profile_format: Parameters for storing profiles in Redis.
+		bulk: Parameters for operations on all users.
+		hash_cache: Parameters for caching profiles in every worker.
+		sessions: Parameters for reusing e-Dnevnik sessions between syncs.
 	"""
 	storage = '/data'
 
@@ -88,6 +95,100 @@ class Config:
 		telegram_token = None
 		telegram_uid = None
 
+	class upstream:
+		"""
+			Parameters for connections to e-Dnevnik.
+
+			url: e-Dnevnik URL, can be changed e.g. to use mock_server.py.
+			persistent: Whether to keep connections alive between requests.
+			pool_size: Maximum number of kept-alive connections per eDAP object.
+			connect_timeout: Seconds to wait for a connection to be established.
+			read_timeout: Seconds to wait for the server to send a response.
+			subject_workers: Number of subject pages fetched at the same time.
+			cache_size: Maximum size of pages and data cached by each eDAP object, in bytes.
+			cache_compress: Whether to compress cached pages.
+			batch_workers: Number of users synced (or scraped in bulk) at the same time, see batch.py.
+		"""
+		url = "https://ocjene.skole.hr"
+		persistent = True
+		pool_size = 10
+		connect_timeout = 10
+		read_timeout = 30
+		subject_workers = 4
+		cache_size = 2097152
+		cache_compress = False
+		batch_workers = 8
+
+	class breaker:
+		"""
+			Parameters for pausing syncs while e-Dnevnik is unavailable, see breaker.py.
+
+			threshold: Number of upstream failures in a row after which syncs are paused.
+			probe_delay: Seconds to wait before checking whether e-Dnevnik is available again (doubled after every failed check).
+			max_probe_delay: Maximum number of seconds between checks.
+			resume_spread: Paused syncs resume at random times within this many seconds after e-Dnevnik becomes available.
+		"""
+		threshold = 5
+		probe_delay = 60
+		max_probe_delay = 3600
+		resume_spread = 600
+
+	class ratelimit:
+		"""
+			Parameters for limiting the rate of requests to e-Dnevnik, shared by all workers, see ratelimit.py.
+
+			rate: Maximum number of requests per second (0 for no limit).
+			burst: Number of requests which may be sent at once (0 to use `rate`).
+			reserve: Part of the burst reserved for logins and fetching classes, which syncs can't use.
+		"""
+		rate = 0
+		burst = 0
+		reserve = 0.2
+
+	class profile_format:
+		"""
+			Parameters for storing profiles in Redis, see codec.py.
+
+			serializer: `json` or `msgpack` (needs the msgpack package).
+			compression: `none`, `zlib` or `zstd` (needs the zstandard package).
+			compress_min_size: Items smaller than this many bytes aren't compressed.
+			migrate: Whether to rewrite profiles stored in another format in the background.
+		"""
+		serializer = 'json'
+		compression = 'none'
+		compress_min_size = 512
+		migrate = True
+
+	class bulk:
+		"""
+			Parameters for operations on all users (e.g. /dev/recreate), see bulk.py.
+
+			batch_size: Number of users read and written at once.
+		"""
+		batch_size = 100
+
+	class hash_cache:
+		"""
+			Parameters for caching profiles in every worker, see hashcache.py.
+
+			size: Approximate maximum size of the cache of every worker in bytes (0 disables the cache).
+			ttl: Seconds after which cached profiles are read from Redis again.
+		"""
+		size = 33554432
+		ttl = 300
+
+	class sessions:
+		"""
+			Parameters for reusing e-Dnevnik sessions between syncs.
+
+			enabled: Whether to store sessions and resume them instead of logging in on every sync.
+			key: Fernet key used to encrypt stored sessions.
+			ttl: Seconds after which a stored session is discarded.
+		"""
+		enabled = False
+		key = None
+		ttl = 21600
+
 	class redis:
 		"""
 			Parameters for establishing a connection to the Redis DB.
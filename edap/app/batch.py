@@ -0,0 +1,247 @@
+"""
+	Batch scraping of many e-Dnevnik accounts.
+
+	BatchScraper scrapes accounts with a bounded number of workers, which
+	share one connection pool and a per-host request budget (HostBudget),
+	so scraping the whole user base (e.g. after a change of the profile
+	format) doesn't open a connection per account or flood e-Dnevnik.
+	Results are yielded as soon as each account is done, in completion
+	order, and errors are yielded instead of raised, so one failing
+	account doesn't stop the others.
+
+	The data returned for every account is the same as what eDAP-API
+	stores, see profiles.populate_data().
+
+	Usage:
+		python3 batch.py <accounts.txt> [--workers 8] [--rate 20] [--edurl URL]
+
+	`accounts.txt` contains one `username:password` per line ("-" reads
+	them from stdin). Every result is printed to stdout as a line of JSON,
+	formatted {username, data, error, elapsed}.
+
+	From Python:
+		with BatchScraper(workers=8, host_rate=20) as scraper:
+			for result in scraper.scrape([('ucenik', 'lozinka'), ...]):
+				if result.error:
+					...
+				else:
+					... result.data ...
+"""
+import json, sys
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from threading import Lock
+from time import monotonic, perf_counter, sleep
+from urllib.parse import urlparse
+import requests
+import edap, profiles
+
+# key: the account (or other item) the result belongs to
+# data: the result, or None if there was an error
+# error: the exception raised, or None
+# elapsed: seconds spent on the item
+BatchResult = namedtuple('BatchResult', ['key', 'data', 'error', 'elapsed'])
+
+class HostBudget:
+	"""
+		Request budget shared by many eDAP objects: at most `rate` requests
+		per second are sent to each host, after an initial burst of `burst`
+		requests. Pass it to eDAP as `throttle`; calls block until the
+		request may be sent.
+	"""
+	def __init__(self, rate: float, burst: int = 1):
+		"""
+			== ARGUMENTS
+			rate - Maximum number of requests per second to a host
+			burst - Number of requests which may be sent at once
+		"""
+		self.interval = 1 / rate
+		self.burst = max(burst, 1)
+		self.next_free = {}
+		self.lock = Lock()
+		self.requests = 0
+		self.throttled = 0
+		self.waited = 0.0
+
+	def __call__(self, url: str):
+		host = urlparse(url).netloc
+		with self.lock:
+			now = monotonic()
+			# Time at which the host's budget is used up
+			tat = max(self.next_free.get(host, now), now)
+			delay = tat - now - (self.burst - 1) * self.interval
+			self.next_free[host] = tat + self.interval
+			self.requests += 1
+			if delay > 0:
+				self.throttled += 1
+				self.waited += delay
+		if delay > 0:
+			sleep(delay)
+
+	def stats(self) -> dict:
+		"""
+			RETURNS: dict formatted {requests, throttled, waited}, where waited is the total delay in seconds
+		"""
+		with self.lock:
+			return {'requests': self.requests, 'throttled': self.throttled, 'waited': round(self.waited, 3)}
+
+class BatchScraper:
+	"""
+		Scrapes many accounts at once, see the module docstring.
+	"""
+	def __init__(self,
+	             workers: int = 8,
+	             subject_workers: int = 1,
+	             pool_size: int = None,
+	             host_rate: float = None,
+	             host_burst: int = None,
+	             scrape=None,
+	             throttle=None,
+	             **kwargs):
+		"""
+			== ARGUMENTS
+			workers - Number of accounts scraped at the same time
+			subject_workers - Number of subject pages fetched at the same time for every account
+			pool_size - Maximum number of connections to each host, shared by all workers (default: workers * subject_workers)
+			host_rate - Maximum number of requests per second to each host, see HostBudget (default: unlimited)
+			host_burst - Number of requests to a host which may be sent at once (default: workers)
+			scrape - Function called with an eDAP object for every account, returning its data (default: profiles.populate_data())
+			throttle - Request budget to use instead of a HostBudget, e.g. a lane of ratelimit.RateLimiter (`host_rate` is then ignored)
+			kwargs - Other arguments for eDAP, e.g. edurl or timeout
+		"""
+		self.workers = workers
+		self.subject_workers = subject_workers
+		self.scrape_func = scrape or (lambda obj: profiles.populate_data(obj, subject_workers=self.subject_workers))
+		self.kwargs = kwargs
+		# Connections are returned to the pool as soon as a response is
+		# read, so blocking for a free connection can't deadlock
+		self.adapter = requests.adapters.HTTPAdapter(
+			pool_connections=4,
+			pool_maxsize=pool_size or workers * subject_workers,
+			pool_block=True
+		)
+		self.budget = throttle or (HostBudget(host_rate, host_burst or workers) if host_rate else None)
+		self.lock = Lock()
+		self.done = 0
+		self.errors = 0
+
+	def edap_options(self) -> dict:
+		"""
+			Return the arguments which make an eDAP object use the shared
+			connection pool and request budget.
+		"""
+		return dict(self.kwargs, adapter=self.adapter, throttle=self.budget)
+
+	def scrape_account(self, username: str, password: str):
+		"""
+			Log in to an account and return its data, see `scrape` in __init__().
+		"""
+		with edap.edap(username, password, **self.edap_options()) as obj:
+			return self.scrape_func(obj)
+
+	def __run(self, func, item, key) -> BatchResult:
+		start = perf_counter()
+		try:
+			result = BatchResult(key(item), func(item), None, perf_counter() - start)
+		except Exception as e:
+			result = BatchResult(key(item), None, e, perf_counter() - start)
+		with self.lock:
+			self.done += 1
+			if result.error:
+				self.errors += 1
+		return result
+
+	def map(self, func, items, key=None):
+		"""
+			Call `func` for every item using the workers, and yield a
+			BatchResult for each of them as soon as it's done. Items are
+			taken from `items` only when a worker is about to be free, so
+			it can be a (long) generator.
+
+			== ARGUMENTS
+			func - Function called with an item, usually using edap_options() for eDAP objects
+			items - Iterable of items, e.g. tokens
+			key - Function returning the key of a result from its item (default: the item itself)
+		"""
+		items = iter(items)
+		key = key or (lambda item: item)
+		with ThreadPoolExecutor(self.workers) as executor:
+			pending = set()
+			def fill():
+				while len(pending) < self.workers * 2:
+					try:
+						item = next(items)
+					except StopIteration:
+						return
+					pending.add(executor.submit(self.__run, func, item, key))
+			fill()
+			while pending:
+				done, _ = wait(pending, return_when=FIRST_COMPLETED)
+				for future in done:
+					pending.remove(future)
+					yield future.result()
+				fill()
+
+	def scrape(self, accounts):
+		"""
+			Scrape accounts, yielding a BatchResult with the account's
+			username as its key for each of them as soon as it's done.
+
+			== ARGUMENTS
+			accounts - Iterable of (username, password)
+		"""
+		return self.map(lambda account: self.scrape_account(*account), accounts, key=lambda account: account[0])
+
+	def stats(self) -> dict:
+		"""
+			RETURNS: dict formatted {done, errors, budget}, where budget is the stats() of the request budget (or None)
+		"""
+		with self.lock:
+			return {'done': self.done, 'errors': self.errors, 'budget': self.budget.stats() if self.budget else None}
+
+	def close(self):
+		"""
+			Close the shared connection pool.
+		"""
+		self.adapter.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+def _get_arg(name: str, default=None):
+	if name in sys.argv:
+		return sys.argv[sys.argv.index(name) + 1]
+	return default
+
+def _read_accounts(f):
+	for line in f:
+		line = line.strip()
+		if line and not line.startswith('#'):
+			username, _, password = line.partition(':')
+			yield username, password
+
+if __name__ == '__main__':
+	if len(sys.argv) < 2 or sys.argv[1].startswith('--'):
+		print(__doc__)
+		sys.exit(1)
+	rate = _get_arg('--rate')
+	scraper = BatchScraper(
+		workers=int(_get_arg('--workers', 8)),
+		host_rate=float(rate) if rate else None,
+		edurl=_get_arg('--edurl', 'https://ocjene.skole.hr')
+	)
+	start = perf_counter()
+	with scraper, (sys.stdin if sys.argv[1] == '-' else open(sys.argv[1])) as f:
+		for result in scraper.scrape(_read_accounts(f)):
+			print(json.dumps({
+				'username': result.key,
+				'data': result.data,
+				'error': repr(result.error) if result.error else None,
+				'elapsed': round(result.elapsed, 3)
+			}, default=edap.json_default), flush=True)
+	stats = scraper.stats()
+	print('[batch] Scraped %i accounts (%i errors) in %.2fs, budget: %s' % (stats['done'], stats['errors'], perf_counter() - start, stats['budget']), file=sys.stderr)
+	sys.exit(1 if stats['errors'] else 0)
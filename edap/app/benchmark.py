@@ -0,0 +1,234 @@
+"""
+	Offline parser benchmarks for eDAP.
+
+	Every parser engine method is timed on the anonymised pages in
+	fixtures/, and the number of operations per second and memory used
+	per operation (peak, as traced by tracemalloc) are reported. Results
+	are compared to a stored baseline; anything slower or using more memory
+	than the baseline (beyond the tolerance) is reported as a regression
+	and the script exits with code 1.
+
+	Baselines depend on the machine they were recorded on, so record a new
+	one (--save) before comparing results on a different machine.
+
+	Usage:
+		python3 benchmark.py                  Run benchmarks and compare to the baseline
+		python3 benchmark.py --save           Run benchmarks and store the results as the baseline
+		python3 benchmark.py --check          Check that all engines return the same data for every page
+		python3 benchmark.py --filter subject Only run benchmarks containing "subject" in their name
+		python3 benchmark.py --e2e            Measure login, populate_data() and sync() against mock_server.py
+
+	Options:
+		--tolerance 0.25  Allowed difference from the baseline (default: 0.25, i.e. 25%)
+		--time 0.5        Minimum time spent on each benchmark, in seconds (default: 0.5)
+		--students 20     Number of students for --e2e (default: 20)
+		--latency 0       Latency of the mock server for --e2e, in seconds (default: 0)
+		--cassettes DIR   Also benchmark full scrapes replayed from the cassettes (see cassette.py) in DIR
+
+	The --e2e benchmark uses the Redis server configured for eDAP-API (by
+	default on localhost), which has to be running.
+"""
+import json, os, sys, tempfile, tracemalloc
+from time import perf_counter
+import edap
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+BASELINE = os.path.join(FIXTURES, 'benchmark_baseline.json')
+
+# Page type and fixture names for each benchmarked page
+PAGES = [
+	('csrf', 'login'),
+	('classes', 'class'),
+	('subjects', 'course'),
+	('tests', 'exam'),
+	('absences', 'absent'),
+	('subject', 'subject_small'),
+	('subject', 'subject_typical'),
+	('subject', 'subject_large')
+]
+
+def log(level: str, lstr: str):
+	print('[benchmark] [%s] %s' % (level, lstr))
+
+def _get_arg(name: str, default=None):
+	if name in sys.argv:
+		return sys.argv[sys.argv.index(name) + 1]
+	return default
+
+def load_fixture(name: str) -> bytes:
+	with open(os.path.join(FIXTURES, name + '.html'), 'rb') as f:
+		return f.read()
+
+def _chunks(content: bytes, size: int = 16384):
+	for i in range(0, len(content), size):
+		yield content[i:i+size]
+
+def get_cases(cassette_dir: str = None) -> dict:
+	"""
+		Return a function to benchmark for every engine and page, by name
+		(e.g. "lxml:subject_large"), and for every cassette in
+		`cassette_dir` (e.g. "replay:large_profile").
+	"""
+	cases = {}
+	for engine_name in ('bs4', 'lxml'):
+		engine = edap.get_engine(engine_name)
+		for page, fixture in PAGES:
+			html = load_fixture(fixture).decode('utf-8')
+			cases['%s:%s' % (engine_name, fixture)] = lambda engine=engine, page=page, html=html: engine.parse(page, html)
+	engine = edap.get_engine('lxml')
+	for page, fixture in PAGES:
+		if page in edap.LxmlEngine._STREAM_TARGETS:
+			content = load_fixture(fixture)
+			cases['lxml-stream:%s' % fixture] = lambda page=page, content=content: engine.parse_stream(page, _chunks(content))
+	if cassette_dir:
+		import cassette
+		for filename in sorted(os.listdir(cassette_dir)):
+			if filename.endswith('.json'):
+				def replay(interactions=cassette.load_interactions(os.path.join(cassette_dir, filename))):
+					with edap.edap('ucenik', 'lozinka', adapter=cassette.ReplayAdapter(interactions)) as obj:
+						cassette.scrape(obj)
+				cases['replay:%s' % filename[:-5]] = replay
+	return cases
+
+def measure(func, min_time: float) -> dict:
+	"""
+		Return the operations per second (best of 5 rounds, each at least
+		`min_time` / 5 seconds long) and peak memory in bytes for one call
+		of `func`.
+	"""
+	func()
+	best = 0
+	for _ in range(5):
+		ops = 0
+		start = perf_counter()
+		while True:
+			func()
+			ops += 1
+			elapsed = perf_counter() - start
+			if elapsed >= min_time / 5:
+				break
+		best = max(best, ops / elapsed)
+	tracemalloc.start()
+	func()
+	peak = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+	return {'ops': round(best, 1), 'peak': peak}
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+	"""
+		Return a list of regressions, formatted (name, reason).
+	"""
+	regressions = []
+	for name, result in results.items():
+		if name not in baseline:
+			continue
+		base = baseline[name]
+		if result['ops'] < base['ops'] * (1 - tolerance):
+			regressions.append((name, 'ops/sec %.1f -> %.1f' % (base['ops'], result['ops'])))
+		if result['peak'] > base['peak'] * (1 + tolerance):
+			regressions.append((name, 'peak memory %i -> %i bytes' % (base['peak'], result['peak'])))
+	return regressions
+
+def check() -> bool:
+	"""
+		Parse every page using DifferentialEngine, and compare streamed
+		parsing to BeautifulSoup, returning whether all results match.
+	"""
+	ok = True
+	diff = edap.get_engine('diff')
+	bs = edap.get_engine('bs4')
+	lxml = edap.get_engine('lxml')
+	for page, fixture in PAGES:
+		content = load_fixture(fixture)
+		try:
+			diff.parse(page, content.decode('utf-8'))
+			if page in edap.LxmlEngine._STREAM_TARGETS:
+				if lxml.parse_stream(page, _chunks(content, 1024)) != bs.parse(page, content.decode('utf-8')):
+					raise edap.ParseError("streamed and bs4 results differ on %s page" % page)
+			log('OK', fixture)
+		except edap.ParseError as e:
+			log('FAIL', '%s: %s' % (fixture, e))
+			ok = False
+	return ok
+
+def end_to_end(students: int, latency: float) -> int:
+	"""
+		Measure how many logins, full scrapes (populate_data()) and syncs
+		per second eDAP-API manages against mock_server.py.
+	"""
+	from mock_server import MockServer
+	server = MockServer(students=students, latency=latency)
+	os.environ['UPSTREAM_URL'] = server.start()
+	os.environ.setdefault('VAULT', 'N')
+	os.environ.setdefault('DATA_FOLDER', tempfile.mkdtemp())
+	import api_backend
+	users = [('ucenik%i' % i, 'lozinka%i' % i, api_backend.hash_string('ucenik%i:lozinka%i' % (i, i))) for i in range(students)]
+	def timed(name: str, func):
+		start = perf_counter()
+		for user in users:
+			func(*user)
+		elapsed = perf_counter() - start
+		log('INFO', '%-30s %10.1f ops/sec (%i in %.2fs, %i requests so far)' % (name, len(users) / elapsed, len(users), elapsed, server.stats['requests']))
+	def login(username: str, password: str, token: str):
+		api_backend.edap_login(username, password).close()
+	def populate(username: str, password: str, token: str):
+		api_backend.set_credentials(token, username, password)
+		with api_backend.edap_login(username, password) as obj:
+			data = api_backend.populate_data(obj)
+			api_backend.save_upstream_session(token, obj)
+		api_backend.save_data(token, {'data': data, 'devices': [], 'new': [], 'settings': {'notif': {'disable': True, 'ignore': []}}, 'messages': []})
+	def sync(username: str, password: str, token: str):
+		api_backend.sync(token)
+	def add_grade(username: str, password: str, token: str):
+		server.students[username].add_grade(grade=5)
+	try:
+		timed('login', login)
+		timed('populate_data', populate)
+		timed('sync (unchanged)', sync)
+		timed('sync (unchanged, again)', sync)
+		for user in users:
+			add_grade(*user)
+		timed('sync (new grade)', sync)
+	finally:
+		for user in users:
+			api_backend.purge_token(user[2])
+		server.stop()
+	return 0
+
+def main() -> int:
+	if '--check' in sys.argv:
+		return 0 if check() else 1
+	if '--e2e' in sys.argv:
+		return end_to_end(int(_get_arg('--students', 20)), float(_get_arg('--latency', 0)))
+	tolerance = float(_get_arg('--tolerance', 0.25))
+	min_time = float(_get_arg('--time', 0.5))
+	name_filter = _get_arg('--filter', '')
+	results = {}
+	for name, func in get_cases(_get_arg('--cassettes')).items():
+		if name_filter not in name:
+			continue
+		results[name] = measure(func, min_time)
+		log('INFO', '%-30s %10.1f ops/sec %10.1f KiB peak' % (name, results[name]['ops'], results[name]['peak'] / 1024))
+	if '--save' in sys.argv:
+		baseline = {}
+		if os.path.exists(BASELINE):
+			with open(BASELINE) as f:
+				baseline = json.load(f)
+		baseline.update(results)
+		with open(BASELINE, 'w') as f:
+			json.dump(baseline, f, indent='\t', sort_keys=True)
+		log('INFO', 'Saved baseline to %s' % BASELINE)
+		return 0
+	if not os.path.exists(BASELINE):
+		log('WARN', 'No baseline found, use --save to store one')
+		return 0
+	with open(BASELINE) as f:
+		regressions = compare(results, json.load(f), tolerance)
+	for name, reason in regressions:
+		log('REGRESSION', '%s: %s' % (name, reason))
+	if not regressions:
+		log('INFO', 'No regressions compared to the baseline')
+	return 1 if regressions else 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,154 @@
+"""
+	Circuit breaker for requests to e-Dnevnik, shared through Redis.
+
+	Every worker records upstream failures (NetworkError,
+	ServerInMaintenance) and successes. After `threshold` failures in a
+	row, the breaker opens: syncs are paused, and e-Dnevnik is probed by
+	one worker at a time, with an exponentially growing delay between
+	probes. Once a probe succeeds the breaker closes, and paused syncs
+	resume at random times spread over `resume_spread` seconds, so they
+	don't all log in at the moment the maintenance ends.
+
+	The state is kept in two Redis keys (`<prefix>:failures` and
+	`<prefix>:open`), so all uWSGI workers share it. Only the worker which
+	changes the state calls `on_change`, so notifications are sent once
+	per outage instead of once per failed sync. Errors raised by
+	`on_change` are logged, so a failing notification can't break the
+	sync which changed the state.
+"""
+import json, logging
+from random import uniform
+from time import time
+from uuid import uuid4
+
+log = logging.getLogger(__name__)
+
+class CircuitBreaker:
+	"""
+		Redis-backed circuit breaker, see the module docstring.
+	"""
+	def __init__(self,
+	             redis_conn,
+	             probe,
+	             threshold: int = 5,
+	             probe_delay: float = 60,
+	             max_probe_delay: float = 3600,
+	             resume_spread: float = 600,
+	             on_change=None,
+	             prefix: str = 'breaker'):
+		"""
+			== ARGUMENTS
+			redis_conn - Redis connection
+			probe - Function returning whether e-Dnevnik is available again
+			threshold - Number of failures in a row which open the breaker
+			probe_delay - Seconds to wait before the first probe
+			max_probe_delay - Maximum number of seconds between probes
+			resume_spread - Paused syncs resume at random times within this many seconds after the breaker closes
+			on_change - Function called with the new state ("open" or "closed") and the state from state()
+			prefix - Prefix of the Redis keys
+		"""
+		self.redis = redis_conn
+		self.probe = probe
+		self.threshold = threshold
+		self.probe_delay = probe_delay
+		self.max_probe_delay = max_probe_delay
+		self.resume_spread = resume_spread
+		self.on_change = on_change
+		self.failures_key = prefix + ':failures'
+		self.open_key = prefix + ':open'
+		self.probe_key = prefix + ':probe'
+
+	def __changed(self, state: str, info: dict):
+		if not self.on_change:
+			return
+		try:
+			self.on_change(state, info)
+		except Exception:
+			log.exception('Circuit breaker state change handler failed')
+
+	def __get_open(self):
+		state = self.redis.get(self.open_key)
+		return json.loads(state) if state else None
+
+	def state(self) -> dict:
+		"""
+			RETURNS: dict formatted {state, failures}, and {since, attempts, probe_at, reason} if the breaker is open
+		"""
+		failures = int(self.redis.get(self.failures_key) or 0)
+		opened = self.__get_open()
+		if not opened:
+			return {'state': 'closed', 'failures': failures}
+		return dict(opened, state='open', failures=failures)
+
+	def is_open(self) -> bool:
+		return self.redis.exists(self.open_key) > 0
+
+	def record_failure(self, reason: str = None):
+		"""
+			Record an upstream failure, opening the breaker if there were
+			`threshold` failures in a row.
+		"""
+		failures = self.redis.incr(self.failures_key)
+		if failures < self.threshold:
+			return
+		now = time()
+		opened = {'since': now, 'attempts': 0, 'probe_at': now + self.probe_delay, 'reason': reason}
+		# Only the first worker to get here opens the breaker
+		if self.redis.set(self.open_key, json.dumps(opened), nx=True):
+			self.__changed('open', dict(opened, state='open', failures=failures))
+
+	def record_success(self):
+		"""
+			Record a successful upstream request, resetting the failure count.
+			This doesn't close an open breaker; only a probe does.
+		"""
+		self.redis.delete(self.failures_key)
+
+	def allow(self) -> bool:
+		"""
+			Return whether a sync may be started. If the breaker is open and
+			the next probe is due, e-Dnevnik is probed first (by at most one
+			worker at a time), closing the breaker if the probe succeeds.
+		"""
+		opened = self.__get_open()
+		if not opened:
+			return True
+		if time() < opened['probe_at']:
+			return False
+		probe_id = uuid4().hex
+		if not self.redis.set(self.probe_key, probe_id, nx=True, ex=max(int(self.probe_delay), 30)):
+			return False
+		try:
+			try:
+				available = self.probe()
+			except Exception:
+				available = False
+			if available:
+				self.reset()
+				self.__changed('closed', dict(opened, state='closed', failures=0))
+				return True
+			opened['attempts'] += 1
+			delay = min(self.probe_delay * 2 ** opened['attempts'], self.max_probe_delay)
+			opened['probe_at'] = time() + delay
+			self.redis.set(self.open_key, json.dumps(opened), xx=True)
+			return False
+		finally:
+			if self.redis.get(self.probe_key) == probe_id.encode('utf-8'):
+				self.redis.delete(self.probe_key)
+
+	def retry_delay(self) -> float:
+		"""
+			Return how many seconds a paused sync should wait before trying
+			again: until the next probe, plus a random delay of up to
+			`resume_spread` seconds. Returns 0 if the breaker is closed.
+		"""
+		opened = self.__get_open()
+		if not opened:
+			return 0
+		return max(opened['probe_at'] - time(), 0) + uniform(0, self.resume_spread)
+
+	def reset(self):
+		"""
+			Close the breaker and reset the failure count.
+		"""
+		self.redis.delete(self.open_key, self.failures_key)
@@ -0,0 +1,125 @@
+"""
+	Bulk operations over all users.
+
+	scan_batches() iterates over the members of a Redis set (e.g. the
+	token index) in batches, using SSCAN, so Redis isn't blocked and a
+	batch can be read and written with one pipeline each.
+
+	BulkJob runs a function on every batch and keeps its progress in a
+	Redis hash (`<prefix>:<name>`): the SSCAN cursor after the last
+	finished batch and the number of processed items and errors. If a job
+	is interrupted (e.g. the worker running it is restarted), running it
+	again continues from the stored cursor instead of starting over. Only
+	one worker runs a job at a time.
+
+	Like SCAN, a job processes every item which is in the set for the
+	whole duration of the job at least once; items added or removed while
+	it runs may or may not be processed.
+"""
+import logging
+from time import time
+from uuid import uuid4
+
+log = logging.getLogger(__name__)
+
+def scan_batches(redis_conn, key: str, batch_size: int = 100, cursor: int = 0):
+	"""
+		Yield (cursor, members) for batches of members of a set, where
+		`cursor` continues the iteration after the batch. Members are
+		returned as strings. Batches may be smaller or (slightly) larger
+		than `batch_size`.
+	"""
+	while True:
+		cursor, members = redis_conn.sscan(key, cursor, count=batch_size)
+		if members:
+			yield cursor, [member.decode('utf-8') for member in members]
+		if not cursor:
+			return
+
+class JobRunning(Exception):
+	"""The job is already being run by another worker."""
+
+class BulkJob:
+	"""
+		Resumable operation over the members of a Redis set, see the module
+		docstring.
+	"""
+	def __init__(self, redis_conn, name: str, key: str, batch_size: int = 100, lock_timeout: int = 600, prefix: str = 'bulk'):
+		"""
+			== ARGUMENTS
+			redis_conn - Redis connection
+			name - Name of the job, used for its progress and lock keys
+			key - Set whose members (e.g. tokens) are processed
+			batch_size - Number of members processed at once
+			lock_timeout - Seconds after which the job counts as interrupted if a batch doesn't finish
+			prefix - Prefix of the Redis keys
+		"""
+		self.redis = redis_conn
+		self.name = name
+		self.key = key
+		self.batch_size = batch_size
+		self.lock_timeout = lock_timeout
+		self.progress_key = '%s:%s' % (prefix, name)
+		self.lock_key = self.progress_key + ':lock'
+
+	def progress(self) -> dict:
+		"""
+			RETURNS: dict formatted {state, cursor, done, errors, total, started, updated}, or {state: "new"} if the job never ran
+		"""
+		raw = {key.decode('utf-8'): value.decode('utf-8') for key, value in self.redis.hgetall(self.progress_key).items()}
+		if not raw:
+			return {'state': 'new'}
+		state = raw['state']
+		if state == 'running' and not self.redis.exists(self.lock_key):
+			state = 'interrupted'
+		return {
+			'state': state,
+			'cursor': int(raw['cursor']),
+			'done': int(raw['done']),
+			'errors': int(raw['errors']),
+			'total': int(raw['total']),
+			'started': float(raw['started']),
+			'updated': float(raw['updated'])
+		}
+
+	def run(self, func, restart: bool = False) -> dict:
+		"""
+			Call `func` with every batch (a list of members), continuing an
+			interrupted run unless `restart` is True. `func` returns the
+			number of members which couldn't be processed (or None).
+			Raises JobRunning if another worker is running the job.
+			RETURNS: the final progress(), see above
+		"""
+		progress = self.progress()
+		lock_id = uuid4().hex
+		if not self.redis.set(self.lock_key, lock_id, nx=True, ex=self.lock_timeout):
+			raise JobRunning(self.name)
+		try:
+			if restart or progress['state'] != 'interrupted':
+				now = time()
+				progress = {'cursor': 0, 'done': 0, 'errors': 0, 'total': self.redis.scard(self.key), 'started': now, 'updated': now}
+			elif progress['done'] and not progress['cursor']:
+				# Interrupted after the last batch
+				progress['state'] = 'finished'
+				self.redis.hset(self.progress_key, 'state', 'finished')
+				return progress
+			else:
+				log.info('Resuming %s after %i items', self.name, progress['done'])
+			progress['state'] = 'running'
+			self.redis.hset(self.progress_key, mapping=progress)
+			for cursor, batch in scan_batches(self.redis, self.key, self.batch_size, progress['cursor']):
+				progress['errors'] += func(batch) or 0
+				progress['done'] += len(batch)
+				progress['cursor'] = cursor
+				progress['updated'] = time()
+				pipe = self.redis.pipeline()
+				pipe.hset(self.progress_key, mapping=progress)
+				pipe.expire(self.lock_key, self.lock_timeout)
+				pipe.execute()
+				log.info('%s: %i/%i done (%i errors)', self.name, progress['done'], progress['total'], progress['errors'])
+			progress['state'] = 'finished'
+			self.redis.hset(self.progress_key, 'state', 'finished')
+			return progress
+		finally:
+			if self.redis.get(self.lock_key) == lock_id.encode('utf-8'):
+				self.redis.delete(self.lock_key)
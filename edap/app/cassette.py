@@ -0,0 +1,247 @@
+"""
+	Recording and replaying of e-Dnevnik sessions.
+
+	RecordingAdapter records every request/response pair sent by eDAP,
+	scrubs personal data from the pages (names, OIB, addresses, grade notes,
+	absence reasons, classmaster's notes) and saves them as a cassette (a
+	JSON file). ReplayAdapter serves a cassette in place of e-Dnevnik, so
+	unusual real-world pages (huge grade tables, many classes, ...) can be
+	used in tests and benchmarks offline, without sharing student data.
+
+	Scrubbing keeps the structure and the length of the pages, so parsing a
+	scrubbed page costs about the same as parsing the original one.
+
+	Usage:
+		python3 cassette.py record <username> <cassette.json> [--edurl URL]  Log in (the password is read from stdin), scrape all classes and save a cassette
+		python3 cassette.py replay <cassette.json>                           Scrape all classes from a cassette and print a summary
+
+	From Python:
+		adapter = RecordingAdapter()
+		with edap.edap(user, pasw, adapter=adapter) as obj:
+			...
+		adapter.save('cassette.json')
+
+		obj = edap.edap('ucenik', 'lozinka', adapter=ReplayAdapter.load('cassette.json'))
+"""
+import hashlib, io, json, re, sys
+from getpass import getpass
+from threading import Lock
+from time import perf_counter
+from urllib.parse import urlsplit
+from lxml import html as lxml_html
+from requests.adapters import HTTPAdapter
+from urllib3.response import HTTPResponse
+import edap
+
+CASSETTE_VERSION = 1
+# Response headers kept in cassettes (cookies are never stored)
+KEPT_HEADERS = ('Content-Type', 'Location')
+
+# Elements (by class) containing names, which are replaced with pseudonyms
+_NAME_CLASSES = ('user-name', 'course-info', 'school-name', 'school-city')
+# Elements (by class) whose text is replaced with placeholder characters
+_TEXT_CLASSES = ('student-details', 'sectionText')
+# Table cells whose text is replaced with placeholder characters, as
+# (table class, cell index): grade notes and absence reasons
+_TEXT_CELLS = (('notes-table', 0), ('absent-table', 3))
+_OIB = re.compile(r'\b\d{11}\b')
+_LETTERS = re.compile(r'[^\W\d_]')
+_SPACE = re.compile(r'^(\s*)(.*?)(\s*)$', re.DOTALL)
+
+def _xpath_class(name: str) -> str:
+	return "contains(concat(' ', normalize-space(@class), ' '), ' %s ')" % name
+
+def _replace_text(element, func):
+	"""
+		Replace all text inside an element (but not its tail) using `func`.
+	"""
+	if element.text:
+		element.text = func(element.text)
+	for child in element.iterdescendants():
+		if child.text:
+			child.text = func(child.text)
+		if child.tail:
+			child.tail = func(child.tail)
+
+def _pseudonym(text: str) -> str:
+	"""
+		Replace a name with a pseudonym, keeping surrounding whitespace.
+		The same name always gets the same pseudonym.
+	"""
+	space_before, name, space_after = _SPACE.match(text).groups()
+	if not name:
+		return text
+	return '%sOsoba %s%s' % (space_before, hashlib.blake2b(name.encode('utf-8'), digest_size=3).hexdigest(), space_after)
+
+def _placeholder(text: str) -> str:
+	"""
+		Replace all letters with 'x', keeping the length, digits and
+		punctuation.
+	"""
+	return _LETTERS.sub('x', text)
+
+def scrub(page: str, username: str = None) -> str:
+	"""
+		Remove personal data from a page, see the module docstring.
+
+		:param str page: Page HTML
+		:param str username: e-Dnevnik username, replaced everywhere in the page
+		:return: Scrubbed page HTML
+		:rtype: str
+	"""
+	doc = lxml_html.document_fromstring(page)
+	for name in _NAME_CLASSES:
+		for element in doc.xpath('//*[%s]' % _xpath_class(name)):
+			_replace_text(element, _pseudonym)
+	for name in _TEXT_CLASSES:
+		for element in doc.xpath('//*[%s]' % _xpath_class(name)):
+			_replace_text(element, _placeholder)
+	for table, index in _TEXT_CELLS:
+		for row in doc.xpath('//div[%s]//div[%s]' % (_xpath_class(table), _xpath_class('row'))):
+			cells = row.xpath('.//div[%s]' % _xpath_class('flex-row'))
+			if len(cells) > index:
+				_replace_text(cells[index], _placeholder)
+	doctype = doc.getroottree().docinfo.doctype
+	page = lxml_html.tostring(doc, encoding='unicode', doctype=doctype or None)
+	if username:
+		page = re.sub(re.escape(username), 'ucenik', page, flags=re.IGNORECASE)
+	return _OIB.sub('0' * 11, page)
+
+def _path(url: str) -> str:
+	parts = urlsplit(url)
+	return parts.path + ('?' + parts.query if parts.query else '')
+
+class RecordingAdapter(HTTPAdapter):
+	"""
+		Transport adapter which sends requests as usual, and records them
+		(with personal data scrubbed) for save().
+
+		Request bodies aren't recorded, as they contain credentials.
+	"""
+	def __init__(self, username: str = None, **kwargs):
+		"""
+			== ARGUMENTS
+			username - e-Dnevnik username, replaced everywhere in recorded pages
+			kwargs - Arguments for HTTPAdapter
+		"""
+		super().__init__(**kwargs)
+		self.username = username
+		self.interactions = []
+		self.lock = Lock()
+
+	def send(self, request, **kwargs):
+		response = super().send(request, **kwargs)
+		headers = {name: response.headers[name] for name in KEPT_HEADERS if name in response.headers}
+		if 'Location' in headers:
+			headers['Location'] = _path(headers['Location'])
+		body = response.content.decode('utf-8', errors='replace')
+		if 'html' in headers.get('Content-Type', 'text/html'):
+			body = scrub(body, self.username)
+		with self.lock:
+			self.interactions.append({
+				'method': request.method,
+				'path': _path(request.url),
+				'status': response.status_code,
+				'headers': headers,
+				'body': body
+			})
+		return response
+
+	def save(self, path: str):
+		with open(path, 'w', encoding='utf-8') as f:
+			json.dump({'version': CASSETTE_VERSION, 'interactions': self.interactions}, f, ensure_ascii=False, indent='\t')
+
+def load_interactions(path: str) -> list:
+	"""
+		Return the recorded interactions from a cassette file.
+	"""
+	with open(path, encoding='utf-8') as f:
+		cassette = json.load(f)
+	if cassette.get('version') != CASSETTE_VERSION:
+		raise ValueError("Unsupported cassette version %s" % cassette.get('version'))
+	return cassette['interactions']
+
+class ReplayAdapter(HTTPAdapter):
+	"""
+		Transport adapter which answers requests from a cassette instead of
+		sending them. Requests are matched by method and path (the host is
+		ignored); if the same request was recorded more than once, the
+		responses are returned in recorded order, and the last one is
+		repeated after that. Unknown requests get a 404 response.
+	"""
+	def __init__(self, interactions: list, **kwargs):
+		super().__init__(**kwargs)
+		self.responses = {}
+		for interaction in interactions:
+			self.responses.setdefault((interaction['method'], interaction['path']), []).append(interaction)
+		self.served = {}
+		self.lock = Lock()
+
+	@classmethod
+	def load(cls, path: str, **kwargs):
+		return cls(load_interactions(path), **kwargs)
+
+	def send(self, request, **kwargs):
+		key = (request.method, _path(request.url))
+		with self.lock:
+			responses = self.responses.get(key)
+			if responses:
+				index = self.served.get(key, 0)
+				self.served[key] = index + 1
+				interaction = responses[min(index, len(responses) - 1)]
+			else:
+				interaction = {'status': 404, 'headers': {}, 'body': ''}
+		raw = HTTPResponse(
+			body=io.BytesIO(interaction['body'].encode('utf-8')),
+			headers=interaction['headers'],
+			status=interaction['status'],
+			preload_content=False,
+			decode_content=False
+		)
+		return self.build_response(request, raw)
+
+def scrape(obj: edap.edap) -> dict:
+	"""
+		Fetch everything eDAP-API uses from all classes.
+
+		RETURNS: dict formatted {classes}, where every class has its subjects (with data), tests and absences
+	"""
+	classes = obj.getClasses()
+	for class_id, class_obj in enumerate(classes):
+		obj.switchActiveClass(class_id)
+		class_obj['subjects'] = obj.getSubjects()
+		obj.prefetchSubjects()
+		for subject in class_obj['subjects']:
+			subject.update(obj.getSubjectData(subject['id']))
+		class_obj['tests'] = obj.getTests()
+		class_obj['absences'] = obj.getAbsenceList()
+	return {'classes': classes}
+
+def _get_arg(name: str, default=None):
+	if name in sys.argv:
+		return sys.argv[sys.argv.index(name) + 1]
+	return default
+
+if __name__ == '__main__':
+	if len(sys.argv) >= 4 and sys.argv[1] == 'record':
+		username, path = sys.argv[2], sys.argv[3]
+		password = getpass('Password for %s: ' % username) if sys.stdin.isatty() else sys.stdin.readline().strip()
+		adapter = RecordingAdapter(username)
+		with edap.edap(username, password, edurl=_get_arg('--edurl', 'https://ocjene.skole.hr'), adapter=adapter) as obj:
+			scrape(obj)
+		adapter.save(path)
+		print('[cassette] Saved %i interactions to %s' % (len(adapter.interactions), path))
+	elif len(sys.argv) >= 3 and sys.argv[1] == 'replay':
+		start = perf_counter()
+		with edap.edap('ucenik', 'lozinka', adapter=ReplayAdapter.load(sys.argv[2])) as obj:
+			data = scrape(obj)
+		elapsed = perf_counter() - start
+		for class_obj in data['classes']:
+			print('[cassette] Class %s: %i subjects, %i grades, %i tests, %i absence days' % (
+				class_obj['class_id'], len(class_obj['subjects']),
+				sum(len(subject['grades']) for subject in class_obj['subjects']),
+				len(class_obj['tests']), len(class_obj['absences'])))
+		print('[cassette] Replayed in %.3fs' % elapsed)
+	else:
+		print(__doc__)
+		sys.exit(1)
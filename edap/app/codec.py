@@ -0,0 +1,137 @@
+"""
+	Serialization of stored profiles.
+
+	ProfileCodec turns profile items into bytes for Redis and back. Values
+	are serialized with JSON (using orjson if it's installed, which is
+	faster and works on bytes directly) or MessagePack (smaller and faster
+	to decode, needs the `msgpack` package), and compressed with zlib or
+	Zstandard (needs the `zstandard` package) if they're larger than
+	`min_size` bytes.
+
+	Every encoded value starts with a header of three bytes: the format
+	version, the serializer and the compression. The first byte can't be
+	the start of a JSON document, so values without a header (stored
+	before the codec was introduced) are read as JSON. Every value can be
+	read no matter which format the codec writes, so the format can be
+	changed at any time; is_current() tells which values should be
+	rewritten in the new one.
+"""
+import json, zlib
+
+try:
+	import orjson
+except ImportError:
+	orjson = None
+try:
+	import msgpack
+except ImportError:
+	msgpack = None
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+FORMAT_VERSION = 1
+SERIALIZERS = {'json': 1, 'msgpack': 2}
+COMPRESSIONS = {'none': 0, 'zlib': 1, 'zstd': 2}
+
+class CodecError(Exception):
+	pass
+
+class ProfileCodec:
+	"""
+		Encodes and decodes profile items, see the module docstring.
+	"""
+	def __init__(self, serializer: str = 'json', compression: str = 'none', min_size: int = 512, default=None):
+		"""
+			== ARGUMENTS
+			serializer - "json" or "msgpack"
+			compression - "none", "zlib" or "zstd"
+			min_size - Values smaller than this many bytes aren't compressed
+			default - Function converting objects which can't be serialized (e.g. edap.json_default)
+		"""
+		if serializer not in SERIALIZERS:
+			raise CodecError('Unknown serializer %s' % serializer)
+		if compression not in COMPRESSIONS:
+			raise CodecError('Unknown compression %s' % compression)
+		if serializer == 'msgpack' and not msgpack:
+			raise CodecError('The msgpack package is needed for the msgpack serializer')
+		if compression == 'zstd' and not zstandard:
+			raise CodecError('The zstandard package is needed for zstd compression')
+		self.serializer = serializer
+		self.compression = compression
+		self.min_size = min_size
+		self.default = default
+		self.header = bytes([FORMAT_VERSION, SERIALIZERS[serializer], COMPRESSIONS[compression]])
+		self.uncompressed_header = bytes([FORMAT_VERSION, SERIALIZERS[serializer], COMPRESSIONS['none']])
+		if zstandard:
+			self.zstd_compressor = zstandard.ZstdCompressor()
+			self.zstd_decompressor = zstandard.ZstdDecompressor()
+
+	def __msgpack_default(self, obj):
+		# With strict_types, subclasses (e.g. eDAP's records) and tuples
+		# are passed here instead of being packed as plain lists
+		if type(obj) is tuple:
+			return list(obj)
+		if isinstance(obj, dict):
+			return dict(obj)
+		if self.default:
+			return self.default(obj)
+		raise TypeError("Object of type %s is not serializable" % type(obj).__name__)
+
+	def __serialize(self, obj) -> bytes:
+		if self.serializer == 'msgpack':
+			return msgpack.packb(obj, default=self.__msgpack_default, use_bin_type=True, strict_types=True)
+		if orjson:
+			return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS)
+		return json.dumps(obj, default=self.default).encode('utf-8')
+
+	def dumps(self, obj) -> bytes:
+		"""
+			Encode a value, returning bytes starting with the header.
+		"""
+		data = self.__serialize(obj)
+		if self.compression == 'none' or len(data) < self.min_size:
+			return self.uncompressed_header + data
+		if self.compression == 'zlib':
+			return self.header + zlib.compress(data)
+		return self.header + self.zstd_compressor.compress(data)
+
+	def loads(self, value: bytes):
+		"""
+			Decode a value encoded in any format, including JSON values
+			without a header.
+		"""
+		if not value or value[0] != FORMAT_VERSION:
+			return _load_json(value)
+		serializer, compression = value[1], value[2]
+		data = memoryview(value)[3:]
+		if compression == COMPRESSIONS['zlib']:
+			data = zlib.decompress(data)
+		elif compression == COMPRESSIONS['zstd']:
+			if not zstandard:
+				raise CodecError('The zstandard package is needed to read this value')
+			data = self.zstd_decompressor.decompress(data)
+		elif compression != COMPRESSIONS['none']:
+			raise CodecError('Unknown compression %i' % compression)
+		if serializer == SERIALIZERS['msgpack']:
+			if not msgpack:
+				raise CodecError('The msgpack package is needed to read this value')
+			return msgpack.unpackb(data, raw=False, strict_map_key=False)
+		if serializer == SERIALIZERS['json']:
+			return _load_json(bytes(data))
+		raise CodecError('Unknown serializer %i' % serializer)
+
+	def is_current(self, value: bytes) -> bool:
+		"""
+			Return whether a value is stored in the format this codec
+			writes (values too small to be compressed count as current).
+		"""
+		if value[:3] == self.header:
+			return True
+		return value[:3] == self.uncompressed_header and len(value) - 3 < self.min_size
+
+def _load_json(data: bytes):
+	if orjson:
+		return orjson.loads(data)
+	return json.loads(data)
@@ -1,12 +1,22 @@
-"""A library for parsing CARNet's eDnevnik using BeautifulSoup."""
+"""A library for parsing CARNet's eDnevnik using lxml or BeautifulSoup."""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-import inspect, re, requests
+from functools import lru_cache
+from threading import Lock
+import hashlib, inspect, re, requests, sys, zlib
 from typing import List
+from urllib.parse import urlparse
 try:
 	from bs4 import BeautifulSoup
 except ModuleNotFoundError as e:
 	print("ERROR: BeautifulSoup isn't installed -- check the instructions and try again.")
 	raise e
+try:
+	from lxml import etree
+	from lxml import html as lxml_html
+except ModuleNotFoundError:
+	etree = None
 
 class eDAPError(Exception):
 	"""Generic eDAP error."""
@@ -32,22 +42,79 @@ class InvalidClassID(eDAPError):
 class InvalidSubjectID(eDAPError):
 	"""Non-existent subject ID"""
 
+class SessionExpired(eDAPError):
+	"""Session is no longer valid (redirected to login), log in again"""
+
 EDAP_VERSION = "2.0"
 __version__ = EDAP_VERSION
 
+# Patterns for the date formats used by e-Dnevnik, which are parsed without
+# strptime; groups are (day, month, year)
+_DATE_PATTERNS = {
+	"%d.%m.%Y.": (re.compile(r'(\d{1,2})\.(\d{1,2})\.(\d{4})\.'), (1, 2, 3)),
+	"%Y-%m-%d": (re.compile(r'(\d{4})-(\d{1,2})-(\d{1,2})'), (3, 2, 1))
+}
+
+@lru_cache(maxsize=4096)
 def _format_to_date(preformat_string: str, date_format: str = "%d.%m.%Y.") -> int:
 	"""
 		Formats a string into a UNIX timestamp.
 
+		The formats in _DATE_PATTERNS are parsed by hand, as strptime is
+		slow; other formats fall back to strptime. The same dates show up
+		very often, so results are memoized.
+
 		:param str preformat_string: Formatted date string
 		:param str date_format: The format in which preFStr is provided
 		:return: UNIX timestamp
 		:rtype: int
 	"""
+	if date_format in _DATE_PATTERNS:
+		pattern, (day, month, year) = _DATE_PATTERNS[date_format]
+		match = pattern.fullmatch(preformat_string)
+		if match:
+			return int(datetime(int(match.group(year)), int(match.group(month)), int(match.group(day))).timestamp())
 	return int(datetime.strptime(preformat_string, date_format).timestamp())
 
-def _determine_absence_status(bs_object) -> str:
-	classes = bs_object.get('class')
+_VOLATILE_TAGS = re.compile(rb'<[^>]*csrf[^>]*>', re.IGNORECASE)
+
+def _page_digest(content: bytes) -> str:
+	"""
+		Return a digest of a page body, ignoring the parts which change on
+		every request (tags containing the CSRF token).
+
+		:param bytes content: Page body
+		:return: Hex digest
+		:rtype: str
+	"""
+	return hashlib.blake2b(_VOLATILE_TAGS.sub(b'', content), digest_size=16).hexdigest()
+
+class _PageDigest:
+	"""
+		Incremental version of _page_digest(), for pages which are read in
+		chunks. Tags split between two chunks are held back until they're
+		complete, so the result is the same as _page_digest() on the whole
+		page.
+	"""
+	def __init__(self):
+		self.hash = hashlib.blake2b(digest_size=16)
+		self.pending = b''
+
+	def update(self, chunk: bytes):
+		data = self.pending + chunk
+		# Everything up to the first '<' after the last '>' only contains complete tags
+		cut = data.find(b'<', data.rfind(b'>') + 1)
+		if cut == -1:
+			cut = len(data)
+		self.hash.update(_VOLATILE_TAGS.sub(b'', data[:cut]))
+		self.pending = data[cut:]
+
+	def hexdigest(self) -> str:
+		self.hash.update(_VOLATILE_TAGS.sub(b'', self.pending))
+		self.pending = b''
+		return self.hash.hexdigest()
+
+def _determine_absence_status(classes: List[str]) -> str:
 	if 'green' in classes:
 		return 'justified'
 	elif 'red' in classes:
@@ -57,6 +124,635 @@ def _determine_absence_status(bs_object) -> str:
 	elif 'gold' in classes:
 		return 'other'
 
+class Record:
+	"""
+		Base for the compact record types returned by eDAP (grades, notes,
+		tests and absences). Fields are stored in `__slots__` instead of a
+		per-object dict, but records behave like (and compare equal to)
+		the dicts eDAP used to return, so they can be used the same way.
+
+		Fields can be left unset, in which case they're missing from the
+		mapping, like a missing dict key. Records are hashable (by their
+		values), so they can be put into sets; don't change a record while
+		it's in a set.
+
+		Use `dict(record)` or `record._asdict()` to get a plain dict, and
+		`json_default()` to serialize records using the json module.
+	"""
+	__slots__ = ()
+
+	def __init__(self, *args, **kwargs):
+		for name, value in zip(self.__slots__, args):
+			setattr(self, name, value)
+		for name, value in kwargs.items():
+			setattr(self, name, value)
+
+	def keys(self) -> List[str]:
+		return [name for name in self.__slots__ if hasattr(self, name)]
+
+	def values(self) -> list:
+		return [getattr(self, name) for name in self.keys()]
+
+	def items(self) -> list:
+		return [(name, getattr(self, name)) for name in self.keys()]
+
+	def get(self, key: str, default=None):
+		return getattr(self, key, default) if key in self.__slots__ else default
+
+	def _asdict(self) -> dict:
+		return {name: getattr(self, name) for name in self.keys()}
+
+	def __getitem__(self, key: str):
+		try:
+			return getattr(self, key)
+		except (AttributeError, TypeError):
+			raise KeyError(key)
+
+	def __setitem__(self, key: str, value):
+		if key not in self.__slots__:
+			raise KeyError(key)
+		setattr(self, key, value)
+
+	def __contains__(self, key: str) -> bool:
+		return key in self.__slots__ and hasattr(self, key)
+
+	def __iter__(self):
+		return iter(self.keys())
+
+	def __len__(self) -> int:
+		return len(self.keys())
+
+	def __eq__(self, other) -> bool:
+		if isinstance(other, (Record, dict)):
+			return self._asdict() == dict(other.items())
+		return NotImplemented
+
+	def __hash__(self) -> int:
+		return hash(tuple(sorted(self.items())))
+
+	def __repr__(self) -> str:
+		return '%s(%s)' % (type(self).__name__, ', '.join('%s=%r' % item for item in self.items()))
+
+class Grade(Record):
+	"""A grade: {note, date, grade}"""
+	__slots__ = ('note', 'date', 'grade')
+
+class Note(Record):
+	"""A note (a row without a grade): {note, date}"""
+	__slots__ = ('note', 'date')
+
+class Test(Record):
+	"""A test: {subject, exam, date}, and `id` once one is assigned"""
+	__slots__ = ('subject', 'exam', 'date', 'id')
+
+class Absence(Record):
+	"""A single absent period: {period, subject, status, reason}"""
+	__slots__ = ('period', 'subject', 'status', 'reason')
+
+def json_default(obj):
+	"""
+		Return a record as a dict, for the `default` argument of
+		json.dumps(), so that records are serialized like plain dicts.
+	"""
+	if isinstance(obj, Record):
+		return obj._asdict()
+	raise TypeError("Object of type %s is not JSON serializable" % type(obj).__name__)
+
+def _parse_csrf(html: str, parser: str) -> str:
+	"""
+		Return the CSRF token from the login page, or None if there is none.
+	"""
+	soup = BeautifulSoup(html, parser)
+	for i in soup.find_all('input'):
+		if i.get('name') == 'csrf_token':
+			return i.get('value')
+
+def _parse_classes(html: str, parser: str) -> (List[dict], List[str]):
+	"""
+		Parse the class selection page (/class).
+
+		RETURNS: list of classes, formatted {class_id, class_year, school_name, id}, and a list of their links
+	"""
+	soup = BeautifulSoup(html, parser)
+	classlist = []
+	links = []
+	for ident, i in enumerate(soup.find_all("div", class_="class-menu-vertical")):
+		id_list = i.find('div', class_='class').find_all('span')
+		class_id = id_list[0].text # e.g. 3.e
+		class_year = id_list[1].text # e.g. 20/21
+		school_name = i.find('div', class_='school-name').text.strip()
+		links.append(i.find('a', class_='school').get('href'))
+		classlist.append({
+			'class_id': class_id,
+			'class_year': class_year,
+			'school_name': school_name,
+			'id': ident
+		})
+	soup.decompose()
+	return classlist, links
+
+def _parse_subjects(html: str, parser: str) -> (List[dict], List[str]):
+	"""
+		Parse the subject list (/course).
+
+		RETURNS: list of subjects, formatted {subject, professor, id}, and a list of their links
+	"""
+	soup = BeautifulSoup(html, parser)
+	subjects = []
+	links = []
+	for ident, i in enumerate(soup.find("div", class_="content").find_all("a")):
+		subject_data = i.find_all("span")
+		links.append(i.get('href'))
+		subjects.append({'subject': subject_data[0].text, 'professor': subject_data[1].text.strip(), 'id': ident})
+	soup.decompose()
+	return subjects, links
+
+def _parse_tests(html: str, parser: str) -> List[dict]:
+	"""
+		Parse the exam list (/exam).
+
+		RETURNS: list of Test records, formatted {subject, exam, date}
+	"""
+	soup = BeautifulSoup(html, parser)
+	try:
+		x = soup.find('div', class_='content').find_all('div', class_='row')
+	except AttributeError:
+		return []
+	exams = []
+	for exam_object in x:
+		y = exam_object.find_all('div', class_="flex-row")
+		exams.append(Test(y[0].text.strip(), y[1].text.strip(), _format_to_date(y[2].text.strip() + str(datetime.now().year) + '.')))
+	soup.decompose()
+	return exams
+
+def _parse_subject_page(html: str, parser: str) -> dict:
+	"""
+		Extract grades, notes and the concluded grade from a subject page
+		using a single tree.
+
+		If the concluded grade can't be extracted, `concluded` is set to None
+		and the reason is stored in `error`, so that getConcludedGrade() can
+		raise it while getGrades() still works.
+
+		RETURNS: dict formatted {grades, notes, concluded, concluded_grade, error}
+	"""
+	soup = BeautifulSoup(html, parser)
+	data = {'grades': [], 'notes': [], 'concluded': None, 'concluded_grade': None, 'error': None}
+	grade_table = soup.find("div", class_="notes-table")
+	if grade_table:
+		# Find all table elements
+		for grade_object in grade_table.find_all("div", class_='row'):
+			y = grade_object.find_all('div', class_="flex-row")
+			grade = y[2].text.strip()
+			date = _format_to_date(y[1].text.strip())
+			note = y[0].text.strip()
+			if not grade:
+				data['notes'].append(Note(note, date))
+			else:
+				data['grades'].append(Grade(note, date, int(grade)))
+	# Search the grade table for the concluded grade
+	final_grade = soup.find("div", class_="final-grade")
+	if final_grade is None:
+		data['error'] = 'Final-grade table not found'
+		x = None
+	else:
+		x = final_grade.find_all('div', class_='flex-row')[2].text.strip()
+	if x: # If not empty/NoneType, means there's text in that table element
+		# Use some regex to extract the numerical grade between the parentheses
+		result = re.search(r'\((.*)\)', x)
+		if result:
+			data['concluded'] = True
+			data['concluded_grade'] = int(result.group(1))
+		else:
+			data['error'] = 'Regex failed to match %s' % x
+	elif not data['error']:
+		# Otherwise we have no concluded grade
+		data['concluded'] = False
+	soup.decompose()
+	return data
+
+def _parse_absences(html: str, parser: str) -> List[dict]:
+	"""
+		Parse the absence list (/absent).
+
+		RETURNS: list of days, formatted {date, absences}, where absences are formatted {period, subject, status, reason}
+	"""
+	soup = BeautifulSoup(html, parser)
+	absences = []
+	for absgroup in soup.find_all('div', class_='absent-table'):
+		date = _format_to_date(absgroup.find('div', class_='first').text.split(' - ')[1].strip())
+		abs_group_filtered = {
+			'date': date,
+			'absences': []
+		}
+		for row in absgroup.find_all('div', class_='row'):
+			data = row.find_all('div', class_='flex-row')
+			abs_group_filtered['absences'].append(Absence(
+				int(data[0].text),
+				data[1].text,
+				_determine_absence_status(data[2].find('i').get('class')),
+				data[3].text.strip()
+			))
+		absences.append(abs_group_filtered)
+	soup.decompose()
+	return absences
+
+def _deep_size(obj) -> int:
+	"""
+		Return an estimate of the memory used by an object and the
+		containers/records/strings inside of it, in bytes.
+	"""
+	size = sys.getsizeof(obj)
+	if isinstance(obj, dict):
+		size += sum(_deep_size(k) + _deep_size(v) for k, v in obj.items())
+	elif isinstance(obj, (list, tuple)):
+		size += sum(_deep_size(x) for x in obj)
+	elif isinstance(obj, Record):
+		size += sum(_deep_size(x) for x in obj.values())
+	return size
+
+class PageCache:
+	"""
+		Bounded LRU cache for pages and parsed results. When the total size
+		of stored items exceeds `max_size`, the least recently used ones
+		are evicted.
+
+		Pages (strings) are stored UTF-8 encoded and, if `compress` is
+		enabled, zlib compressed. Any other value (e.g. parsed data) is
+		stored as-is, with its size estimated using _deep_size(). Storing
+		parsed results instead of pages saves both memory and parsing.
+	"""
+	def __init__(self, max_size: int = 2 * 1024 * 1024, compress: bool = False, compress_level: int = 1):
+		"""
+			== ARGUMENTS
+			max_size - Maximum total size of stored items, in bytes
+			compress - Compress stored pages using zlib
+			compress_level - zlib compression level (1-9)
+		"""
+		self.max_size = max_size
+		self.compress = compress
+		self.compress_level = compress_level
+		self.items = OrderedDict()
+		self.size = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.lock = Lock()
+
+	def __contains__(self, key) -> bool:
+		return key in self.items
+
+	def __len__(self) -> int:
+		return len(self.items)
+
+	def get(self, key, default=None):
+		"""
+			Return a stored item (marking it as recently used), or `default`
+			if it isn't stored.
+		"""
+		with self.lock:
+			if key not in self.items:
+				self.misses += 1
+				return default
+			self.hits += 1
+			self.items.move_to_end(key)
+			value, _, kind = self.items[key]
+		if kind == 'page':
+			return (zlib.decompress(value) if self.compress else value).decode('utf-8')
+		return value
+
+	def put(self, key, value):
+		"""
+			Store an item, evicting the least recently used ones if needed.
+			Items larger than `max_size` are not stored.
+		"""
+		if isinstance(value, str):
+			kind = 'page'
+			value = value.encode('utf-8')
+			if self.compress:
+				value = zlib.compress(value, self.compress_level)
+			size = len(value)
+		else:
+			kind = 'data'
+			size = _deep_size(value)
+		with self.lock:
+			self.__remove(key)
+			if size > self.max_size:
+				return
+			self.items[key] = (value, size, kind)
+			self.size += size
+			while self.size > self.max_size:
+				self.__remove(next(iter(self.items)))
+				self.evictions += 1
+
+	def __remove(self, key):
+		if key in self.items:
+			self.size -= self.items.pop(key)[1]
+
+	def clear(self):
+		"""
+			Remove all stored items. Counters are kept.
+		"""
+		with self.lock:
+			self.items.clear()
+			self.size = 0
+
+	def stats(self) -> dict:
+		"""
+			RETURNS: dict formatted {hits, misses, evictions, items, size}
+		"""
+		return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'items': len(self.items), 'size': self.size}
+
+class BeautifulSoupEngine:
+	"""
+		Parser engine using BeautifulSoup. Slower than LxmlEngine, but
+		more forgiving; used as the fallback.
+
+		Every engine has a method for each page type (csrf, classes,
+		subjects, tests, subject, absences), which takes the page's HTML
+		and returns the extracted data.
+	"""
+	name = "bs4"
+
+	def __init__(self, parser: str = "lxml"):
+		self.parser = parser
+
+	def parse(self, page: str, html: str):
+		"""
+			Extract data from a page of type `page` (e.g. "tests").
+		"""
+		return getattr(self, page)(html)
+
+	def parse_stream(self, page: str, chunks):
+		"""
+			Extract data from a page of type `page`, given as an iterable of
+			UTF-8 encoded chunks. This engine joins and decodes them first.
+		"""
+		return self.parse(page, b''.join(chunks).decode('utf-8'))
+
+	def csrf(self, html: str) -> str:
+		return _parse_csrf(html, self.parser)
+
+	def classes(self, html: str) -> (List[dict], List[str]):
+		return _parse_classes(html, self.parser)
+
+	def subjects(self, html: str) -> (List[dict], List[str]):
+		return _parse_subjects(html, self.parser)
+
+	def tests(self, html: str) -> List[dict]:
+		return _parse_tests(html, self.parser)
+
+	def subject(self, html: str) -> dict:
+		return _parse_subject_page(html, self.parser)
+
+	def absences(self, html: str) -> List[dict]:
+		return _parse_absences(html, self.parser)
+
+def _has_class(name: str) -> str:
+	"""
+		Return an XPath predicate matching elements with a class, like
+		BeautifulSoup's `class_` argument does.
+	"""
+	return "contains(concat(' ', normalize-space(@class), ' '), ' %s ')" % name
+
+def _text(element) -> str:
+	"""
+		Return the text of an element and its descendants, like
+		BeautifulSoup's `.text`.
+	"""
+	return ''.join(element.itertext())
+
+class LxmlEngine(BeautifulSoupEngine):
+	"""
+		Parser engine using lxml directly, with XPath expressions compiled
+		once for all pages. If extraction fails for any reason, the page is
+		parsed again using BeautifulSoupEngine.
+	"""
+	name = "lxml"
+	_CSRF_RE = re.compile(r'<input[^>]*\bname="csrf_token"[^>]*>')
+	_VALUE_RE = re.compile(r'\bvalue="([^"]*)"')
+	if etree:
+		_XP_CSRF = etree.XPath('//input[@name="csrf_token"]')
+		_XP_CLASS_MENUS = etree.XPath('//div[%s]' % _has_class('class-menu-vertical'))
+		_XP_CLASS_SPANS = etree.XPath('(.//div[%s])[1]//span' % _has_class('class'))
+		_XP_SCHOOL_NAME = etree.XPath('(.//div[%s])[1]' % _has_class('school-name'))
+		_XP_SCHOOL_LINK = etree.XPath('(.//a[%s])[1]' % _has_class('school'))
+		_XP_CONTENT = etree.XPath('(//div[%s])[1]' % _has_class('content'))
+		_XP_LINKS = etree.XPath('.//a')
+		_XP_SPANS = etree.XPath('.//span')
+		_XP_ROWS = etree.XPath('.//div[%s]' % _has_class('row'))
+		_XP_CELLS = etree.XPath('.//div[%s]' % _has_class('flex-row'))
+		_XP_NOTES_TABLE = etree.XPath('(//div[%s])[1]' % _has_class('notes-table'))
+		_XP_FINAL_GRADE = etree.XPath('(//div[%s])[1]' % _has_class('final-grade'))
+		_XP_ABSENT_TABLES = etree.XPath('//div[%s]' % _has_class('absent-table'))
+		_XP_FIRST = etree.XPath('(.//div[%s])[1]' % _has_class('first'))
+		_XP_ICON = etree.XPath('(.//i)[1]')
+
+	# Subtrees needed from each page type, by class name; only the first
+	# match of each is used
+	_STREAM_TARGETS = {'subject': ('notes-table', 'final-grade')}
+
+	def parse(self, page: str, html: str):
+		"""
+			Extract data from a page of type `page` (e.g. "tests"), falling
+			back to BeautifulSoup if that fails.
+		"""
+		try:
+			return getattr(self, page)(html)
+		except Exception:
+			return getattr(BeautifulSoupEngine, page)(self, html)
+
+	def parse_stream(self, page: str, chunks):
+		"""
+			Extract data from a page of type `page`, given as an iterable of
+			UTF-8 encoded chunks. For pages in `_STREAM_TARGETS`, the chunks
+			are fed to an incremental parser which keeps only the target
+			subtrees and discards everything else as soon as it's parsed, so
+			neither the page nor its whole tree is ever held in memory.
+
+			The iterable is always consumed completely. There is no
+			BeautifulSoup fallback, as the page isn't kept.
+		"""
+		targets = self._STREAM_TARGETS.get(page)
+		if not targets:
+			return super().parse_stream(page, chunks)
+		found = dict.fromkeys(targets)
+		parser = etree.HTMLPullParser(events=('start', 'end'), encoding='utf-8')
+		state = {'target': None, 'depth': 0}
+		for chunk in chunks:
+			if None in found.values():
+				parser.feed(chunk)
+				self._collect(parser.read_events(), found, state)
+		if None in found.values():
+			parser.close()
+			self._collect(parser.read_events(), found, state)
+		return getattr(self, '_%s_from' % page)(*found.values())
+
+	@staticmethod
+	def _collect(events, found: dict, state: dict):
+		"""
+			Handle parser events for parse_stream(): keep elements inside
+			the first subtree with each target class, and drop all others.
+		"""
+		for event, element in events:
+			if state['depth']:
+				# Inside a target subtree, keep everything
+				state['depth'] += 1 if event == 'start' else -1
+				if not state['depth']:
+					found[state['target']] = element
+					element.getparent().remove(element)
+			elif event == 'start':
+				classes = (element.get('class') or '').split()
+				for name in found:
+					if found[name] is None and element.tag == 'div' and name in classes:
+						state['target'] = name
+						state['depth'] = 1
+						break
+			else:
+				element.clear()
+				while element.getprevious() is not None:
+					del element.getparent()[0]
+
+	@staticmethod
+	def _tree(html: str):
+		return lxml_html.document_fromstring(html)
+
+	def csrf(self, html: str) -> str:
+		# Most of the time, a regex finds the token without parsing the page
+		tag = self._CSRF_RE.search(html)
+		if tag:
+			value = self._VALUE_RE.search(tag.group(0))
+			if value:
+				return value.group(1)
+		inputs = self._XP_CSRF(self._tree(html))
+		return inputs[0].get('value') if inputs else None
+
+	def classes(self, html: str) -> (List[dict], List[str]):
+		classlist = []
+		links = []
+		for ident, i in enumerate(self._XP_CLASS_MENUS(self._tree(html))):
+			id_list = self._XP_CLASS_SPANS(i)
+			links.append(self._XP_SCHOOL_LINK(i)[0].get('href'))
+			classlist.append({
+				'class_id': _text(id_list[0]),
+				'class_year': _text(id_list[1]),
+				'school_name': _text(self._XP_SCHOOL_NAME(i)[0]).strip(),
+				'id': ident
+			})
+		return classlist, links
+
+	def subjects(self, html: str) -> (List[dict], List[str]):
+		subjects = []
+		links = []
+		for ident, i in enumerate(self._XP_LINKS(self._XP_CONTENT(self._tree(html))[0])):
+			subject_data = self._XP_SPANS(i)
+			links.append(i.get('href'))
+			subjects.append({'subject': _text(subject_data[0]), 'professor': _text(subject_data[1]).strip(), 'id': ident})
+		return subjects, links
+
+	def tests(self, html: str) -> List[dict]:
+		content = self._XP_CONTENT(self._tree(html))
+		if not content:
+			return []
+		exams = []
+		for exam_object in self._XP_ROWS(content[0]):
+			y = self._XP_CELLS(exam_object)
+			exams.append(Test(_text(y[0]).strip(), _text(y[1]).strip(), _format_to_date(_text(y[2]).strip() + str(datetime.now().year) + '.')))
+		return exams
+
+	def subject(self, html: str) -> dict:
+		tree = self._tree(html)
+		grade_table = self._XP_NOTES_TABLE(tree)
+		final_grade = self._XP_FINAL_GRADE(tree)
+		return self._subject_from(grade_table[0] if grade_table else None, final_grade[0] if final_grade else None)
+
+	def _subject_from(self, grade_table, final_grade) -> dict:
+		"""
+			Extract subject data from the notes-table and final-grade
+			elements of a subject page (either can be None).
+		"""
+		data = {'grades': [], 'notes': [], 'concluded': None, 'concluded_grade': None, 'error': None}
+		if grade_table is not None:
+			for grade_object in self._XP_ROWS(grade_table):
+				y = self._XP_CELLS(grade_object)
+				grade = _text(y[2]).strip()
+				date = _format_to_date(_text(y[1]).strip())
+				note = _text(y[0]).strip()
+				if not grade:
+					data['notes'].append(Note(note, date))
+				else:
+					data['grades'].append(Grade(note, date, int(grade)))
+		if final_grade is None:
+			data['error'] = 'Final-grade table not found'
+			return data
+		x = _text(self._XP_CELLS(final_grade)[2]).strip()
+		if x:
+			result = re.search(r'\((.*)\)', x)
+			if result:
+				data['concluded'] = True
+				data['concluded_grade'] = int(result.group(1))
+			else:
+				data['error'] = 'Regex failed to match %s' % x
+		else:
+			data['concluded'] = False
+		return data
+
+	def absences(self, html: str) -> List[dict]:
+		absences = []
+		for absgroup in self._XP_ABSENT_TABLES(self._tree(html)):
+			abs_group_filtered = {
+				'date': _format_to_date(_text(self._XP_FIRST(absgroup)[0]).split(' - ')[1].strip()),
+				'absences': []
+			}
+			for row in self._XP_ROWS(absgroup):
+				data = self._XP_CELLS(row)
+				abs_group_filtered['absences'].append(Absence(
+					int(_text(data[0])),
+					_text(data[1]),
+					_determine_absence_status(self._XP_ICON(data[2])[0].get('class', '').split()),
+					_text(data[3]).strip()
+				))
+			absences.append(abs_group_filtered)
+		return absences
+
+class DifferentialEngine(BeautifulSoupEngine):
+	"""
+		Parser engine which runs both LxmlEngine (without its fallback) and
+		BeautifulSoupEngine on every page and raises ParseError if their
+		results differ. Meant for testing, e.g. on a corpus of saved pages.
+	"""
+	name = "diff"
+
+	def __init__(self, parser: str = "lxml"):
+		super().__init__(parser)
+		self.fast = LxmlEngine(parser)
+
+	def parse(self, page: str, html: str):
+		expected = getattr(BeautifulSoupEngine, page)(self, html)
+		try:
+			result = getattr(self.fast, page)(html)
+		except Exception as e:
+			raise ParseError("lxml engine failed on %s page: %r" % (page, e))
+		if result != expected:
+			raise ParseError("lxml and bs4 engines differ on %s page" % page)
+		return result
+
+def get_engine(name: str = "lxml", parser: str = "lxml") -> BeautifulSoupEngine:
+	"""
+		Return a parser engine by name: "lxml" (fast, default), "bs4" or
+		"diff" (compare both). If lxml isn't installed, BeautifulSoup is
+		always used.
+
+		:param str name: Engine name
+		:param str parser: The parser that will be used for BeautifulSoup
+	"""
+	engines = {'bs4': BeautifulSoupEngine, 'lxml': LxmlEngine, 'diff': DifferentialEngine}
+	if name not in engines:
+		raise ValueError("Unknown parser engine %s" % name)
+	if not etree:
+		return BeautifulSoupEngine(parser)
+	return engines[name](parser)
+
 class edap:
 	"""
 		eDnevnik scraping library.
@@ -71,7 +767,18 @@ class edap:
 	             loglevel: int = 1,
 	             hidepriv: bool = True,
 	             hide_confidential: bool = True,
-	             headers: dict = None):
+	             headers: dict = None,
+	             persistent: bool = True,
+	             pool_size: int = 10,
+	             timeout: tuple = (10, 30),
+	             session: dict = None,
+	             digests: dict = None,
+	             engine: str = "lxml",
+	             chunk_size: int = 16384,
+	             cache_size: int = 2 * 1024 * 1024,
+	             cache_compress: bool = False,
+	             adapter: requests.adapters.HTTPAdapter = None,
+	             throttle=None):
 		"""
 			Authenticates the user to eDnevnik.
 
@@ -86,8 +793,21 @@ class edap:
 			hidepriv - Hide private info in logs
 			hide_confidential - Enables hiding confidential information, such as OIB or address
 			headers - HTTP headers to append to all requests
+			persistent - Keep connections to eDnevnik alive between requests (default: True)
+			pool_size - Maximum number of connections kept alive (default: 10)
+			timeout - Connect and read timeouts in seconds, formatted (connect, read) (default: (10, 30))
+			session - Session state from exportSession(); if given, the stored session is resumed instead of logging in
+			digests - Page digests from a previous run (`page_digests`), used to detect unchanged pages
+			engine - Parser engine, can be lxml, bs4 or diff, see get_engine() (default: lxml)
+			chunk_size - Size of chunks in which pages parsed while downloading are read, in bytes (default: 16384)
+			cache_size - Maximum size of cached pages and parsed data, in bytes, see PageCache (default: 2 MiB)
+			cache_compress - Compress cached pages (default: False)
+			adapter - Transport adapter to use instead of a new HTTPAdapter, e.g. one from cassette.py or one shared by many eDAP objects (`pool_size` and `persistent` are then ignored, and the adapter isn't closed by close())
+			throttle - Function called with the URL before every request, which may block to limit the request rate, e.g. batch.HostBudget
 		"""
 		self.parser = parser
+		self.engine = get_engine(engine, parser)
+		self.chunk_size = chunk_size
 		self.edurl = edurl
 		self.user = user
 		self.useragent = ua
@@ -97,20 +817,45 @@ class edap:
 		self.hide_confidential = hide_confidential
 		self.class_ids = []
 		self.subject_ids = []
-		self.subject_cache = {}
-		self.absence_cache = {}
+		self.cache = PageCache(cache_size, cache_compress)
+		self.subject_errors = {}
+		self.known_digests = digests or {}
+		self.page_digests = {}
+		self.persistent = persistent
+		self.timeout = timeout
+		self.request_count = 0
+		self.stats_lock = Lock()
+		self.closed_connections = 0
 		self.session = requests.Session()
+		self.adapter = adapter or requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+		self.owns_adapter = adapter is None
+		self.throttle = throttle
+		# Settings for new sessions, see openSession()
+		self.options = {
+			'parser': parser, 'edurl': edurl, 'ua': ua, 'debug': debug, 'loglevel': loglevel,
+			'hidepriv': hidepriv, 'hide_confidential': hide_confidential, 'headers': headers,
+			'persistent': persistent, 'timeout': timeout, 'engine': engine, 'chunk_size': chunk_size,
+			'cache_size': cache_size, 'cache_compress': cache_compress, 'adapter': self.adapter,
+			'throttle': throttle
+		}
+		self.session.mount("http://", self.adapter)
+		self.session.mount("https://", self.adapter)
 		self.session.headers.update({"User-Agent":self.useragent})
 		if headers:
 			self.__edlog(1, "Additional headers '%s' will be added to all requests" % ', '.join(headers))
 			self.session.headers.update(headers)
+		if session:
+			self.__edlog(1, "Resuming stored session for [{%s}]" % self.user)
+			for cookie in session['cookies']:
+				self.session.cookies.set(cookie['name'], cookie['value'], domain=cookie['domain'], path=cookie['path'])
+			return
 		self.__edlog(0, "Sending initial request to obtain CSRF")
 		try:
-			r = self.session.get("%s/login" % self.edurl)
+			r = self.__request("GET", "%s/login" % self.edurl)
 			r.raise_for_status()
 			# Get CSRF
 			self.csrf = self.__getcsrf(r.text)
-		except (requests.exceptions.HTTPError, requests.exceptions.Timeout):
+		except (requests.exceptions.HTTPError, requests.exceptions.Timeout, requests.exceptions.ConnectionError):
 			raise NetworkError("%s/login" % self.edurl)
 		except KeyError:
 			if "u nadogradnji" in r.text:
@@ -119,22 +864,71 @@ class edap:
 		self.__edlog(1, "Got CSRF: [{%s}]" % self.csrf)
 		self.__edlog(1, "Trying to authenticate %s" % self.user)
 		try:
-			r = self.session.post("%s/login" % self.edurl,
-			                      data={"csrf_token": self.csrf, "username": user, "password": pasw})
+			r = self.__request("POST", "%s/login" % self.edurl,
+			                   data={"csrf_token": self.csrf, "username": user, "password": pasw})
 			r.raise_for_status()
 			if "Neispravno korisničko ime ili lozinka." in r.text:
 				raise WrongCredentials
-		except (requests.exceptions.HTTPError, requests.exceptions.Timeout):
+		except (requests.exceptions.HTTPError, requests.exceptions.Timeout, requests.exceptions.ConnectionError):
 			raise NetworkError("%s/pocetna/posalji" % self.edurl)
 		self.__edlog(1, "Authentication successful!")
 
+	@classmethod
+	def resume(cls, session: dict, **kwargs):
+		"""
+			Create an eDAP object from a session exported using exportSession(),
+			without logging in again. If the session has expired, the first
+			request will raise SessionExpired.
+
+			== ARGUMENTS
+			session - Session state from exportSession()
+			kwargs - Other arguments, as in __init__()
+		"""
+		return cls(session['user'], None, session=session, **kwargs)
+
+	def openSession(self, pasw: str):
+		"""
+			Log in again, returning a new eDAP object with its own session on
+			e-Dnevnik. The active class is part of the session (see
+			switchActiveClass()), so classes can only be scraped at the same
+			time using a separate session for each of them.
+
+			The new object has the same settings and shares the connection
+			pool and throttle of this one; it also knows the classes from
+			getClasses(), so switchActiveClass() can be called right away.
+			The shared connections are closed when this object is closed.
+
+			== ARGUMENTS
+			pasw - Password for eDnevnik
+		"""
+		obj = type(self)(self.user, pasw, **self.options)
+		obj.class_ids = list(self.class_ids)
+		return obj
+
+	def exportSession(self) -> dict:
+		"""
+			Return the authenticated session state (cookies), which can be
+			passed to resume() later on to skip logging in.
+
+			WARNING: anyone holding this state can access the user's account
+			until the session expires, so store it encrypted.
+
+			RETURNS: dict formatted {user, cookies}
+		"""
+		return {
+			'user': self.user,
+			'cookies': [
+				{'name': c.name, 'value': c.value, 'domain': c.domain, 'path': c.path}
+				for c in self.session.cookies
+			]
+		}
+
 	def __getcsrf(self, html) -> str:
-		soup = BeautifulSoup(html, self.parser)
-		inputs = soup.find_all('input')
-		for i in inputs:
-			if i.get('name') == 'csrf_token':
-				self.__edlog(1, 'Found correct input tag')
-				return i.get('value')
+		csrf = self.engine.parse('csrf', html)
+		if csrf is None:
+			raise KeyError('csrf_token')
+		self.__edlog(1, 'Found correct input tag')
+		return csrf
 
 	def __edlog(self, loglevel: int, logs: str):
 		"""
@@ -163,22 +957,152 @@ class edap:
 			if self.debug and loglevel >= self.loglevel or loglevel == 4:
 				print(log_string)
 
-	def __fetch(self, url: str) -> str:
+	def __request(self, method: str, url: str, **kwargs) -> requests.Response:
+		"""
+			Send a request using the stored session object, after waiting for
+			`self.throttle` (if any). If persistent connections are disabled,
+			the connection pool is closed afterwards.
+
+			== ARGUMENTS
+			method - HTTP method, e.g. GET
+			url - URL to send the request to
+		"""
+		if self.throttle:
+			self.throttle(url)
+		with self.stats_lock:
+			self.request_count += 1
+		try:
+			return self.session.request(method, url, timeout=self.timeout, **kwargs)
+		finally:
+			if not self.persistent and self.owns_adapter:
+				self.__close_pool()
+
+	def __open_connections(self) -> int:
+		"""
+			Return the number of connections opened by the pools which are
+			currently held by the adapter.
+		"""
+		pools = self.adapter.poolmanager.pools
+		return sum(pools[key].num_connections for key in pools.keys())
+
+	def __close_pool(self):
+		"""
+			Close all pooled connections, keeping count of how many of them
+			were opened.
+		"""
+		self.closed_connections += self.__open_connections()
+		self.adapter.close()
+
+	def __fetch(self, url: str, track: bool = False) -> str:
 		"""
 			Simple internal function to fetch URL using stored session object
 			and also raise an exception for non 2xx codes.
 
 			== ARGUMENTS
 			url - URL to fetch using self.session object
+			track - Store a digest of the page in `self.page_digests`, see pageUnchanged()
 		"""
 		try:
-			with self.session as session:
-				o = session.get(url)
-				o.raise_for_status()
-				data = o.content.decode('utf-8')
-			return data
-		except (requests.exceptions.HTTPError, requests.exceptions.Timeout):
+			o = self.__request("GET", url)
+			o.raise_for_status()
+		except (requests.exceptions.HTTPError, requests.exceptions.Timeout, requests.exceptions.ConnectionError):
 			raise NetworkError(url)
+		if o.history and urlparse(o.url).path == '/login':
+			self.__edlog(2, "Redirected to login page, session has expired")
+			raise SessionExpired(url)
+		if track:
+			self.page_digests[url[len(self.edurl):]] = _page_digest(o.content)
+		return o.content.decode('utf-8')
+
+	def __stream(self, url: str, page: str):
+		"""
+			Fetch URL and parse it as a page of type `page` while it's being
+			downloaded, see BeautifulSoupEngine.parse_stream(). A digest of the page
+			is stored in `self.page_digests`, like __fetch() with `track`.
+
+			== ARGUMENTS
+			url - URL to fetch using self.session object
+			page - Page type, e.g. "subject"
+		"""
+		digest = _PageDigest()
+		def chunks():
+			for chunk in o.iter_content(self.chunk_size):
+				digest.update(chunk)
+				yield chunk
+		try:
+			o = self.__request("GET", url, stream=True)
+		except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+			raise NetworkError(url)
+		try:
+			o.raise_for_status()
+			if o.history and urlparse(o.url).path == '/login':
+				self.__edlog(2, "Redirected to login page, session has expired")
+				raise SessionExpired(url)
+			data = self.engine.parse_stream(page, chunks())
+		except requests.exceptions.RequestException:
+			raise NetworkError(url)
+		finally:
+			o.close()
+		self.page_digests[url[len(self.edurl):]] = digest.hexdigest()
+		return data
+
+	def pageUnchanged(self, path: str) -> bool:
+		"""
+			Return whether a page (e.g. "/exam") was fetched and is the same as
+			in the previous run, according to the digests passed to __init__().
+
+			== ARGUMENTS
+			path - Page path, relative to `self.edurl`
+		"""
+		return path in self.page_digests and self.known_digests.get(path) == self.page_digests[path]
+
+	def getPageStats(self) -> dict:
+		"""
+			Return which of the fetched pages are unchanged since the previous
+			run (hits) and which are new or changed (misses).
+
+			RETURNS: dict formatted {hits, misses, pages}, where pages maps page paths to "hit" or "miss"
+		"""
+		pages = {path: 'hit' if self.pageUnchanged(path) else 'miss' for path in list(self.page_digests)}
+		hits = sum(1 for status in pages.values() if status == 'hit')
+		return {'hits': hits, 'misses': len(pages) - hits, 'pages': pages}
+
+	def getConnectionStats(self) -> dict:
+		"""
+			Return how many requests were sent, and how many of them had to
+			open a new connection instead of reusing a kept-alive one. With an
+			adapter shared by many eDAP objects, `new` counts the connections
+			opened by all of them.
+
+			RETURNS: dict formatted {requests, new, reused}
+		"""
+		new = self.closed_connections + self.__open_connections()
+		return {'requests': self.request_count, 'new': new, 'reused': max(self.request_count - new, 0)}
+
+	def getCacheStats(self) -> dict:
+		"""
+			Return the hit, miss and eviction counters of the page cache.
+
+			RETURNS: dict formatted {hits, misses, evictions, items, size}
+		"""
+		return self.cache.stats()
+
+	def close(self):
+		"""
+			Close the session and all of its kept-alive connections. An
+			adapter passed to __init__() is left open for its other users.
+		"""
+		if self.owns_adapter:
+			self.__close_pool()
+		else:
+			self.session.adapters.clear()
+		self.session.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
 
 	def __verify(self, class_id: int, subject_id: int = None):
 		"""
@@ -211,28 +1135,9 @@ class edap:
 		"""
 		self.__edlog(1, "Listing classes for [{%s}]" % self.user)
 		self.__edlog(0, "Getting class selection HTML")
-		response = self.__fetch("%s/class" % self.edurl)
-		self.__edlog(0, "Initializing BeautifulSoup with response")
-		soup = BeautifulSoup(response, self.parser)
-		classlist_preformat = soup.find_all("div", class_="class-menu-vertical")
+		response = self.__fetch("%s/class" % self.edurl, True)
 		self.__edlog(0, "Populating class list")
-		classlist = []
-		ident = 0
-		for i in classlist_preformat:
-			#print(i)
-			id_list = i.find('div', class_='class').find_all('span')
-			class_id = id_list[0].text # e.g. 3.e
-			class_year = id_list[1].text # e.g. 20/21
-			school_name = i.find('div', class_='school-name').text.strip()
-			link = i.find('a', class_='school').get('href')
-			self.class_ids.append(link)
-			classlist.append({
-				'class_id': class_id,
-				'class_year': class_year,
-				'school_name': school_name,
-				'id': ident
-			})
-			ident += 1
+		classlist, self.class_ids = self.engine.parse('classes', response)
 		return classlist
 
 	def switchActiveClass(self, class_id):
@@ -251,33 +1156,18 @@ class edap:
 		"""
 		#self.__verify(class_id)
 		#self.__edlog(1, "Getting subject list for class id %s (remote ID [{%s}])" % (class_id, self.class_ids[class_id]))
-		response = self.__fetch("%s/course" % self.edurl)
-		self.__edlog(0, "Initializing BeautifulSoup with response")
-		soup = BeautifulSoup(response, self.parser)
-		subjectlist_preformat = soup.find("div", class_="content").find_all("a")
-		subjects = []
-		ident = 0
-		for i in subjectlist_preformat:
-			subject_data = i.find_all("span")
-			subject_name = subject_data[0].text
-			subject_professor = subject_data[1].text.strip()
-			link = i.get('href')
-			self.subject_ids.append(link)
-			subjects.append({'subject': subject_name, 'professor': subject_professor, 'id': ident})
-			ident += 1
-			#print(subject_name, subject_professor, link)
-		soup.decompose()
+		response = self.__fetch("%s/course" % self.edurl, True)
+		subjects, self.subject_ids = self.engine.parse('subjects', response)
 		return subjects
 
-	def getTests(self) -> List[dict]:
+	def getTests(self, previous: List[dict] = None) -> List[dict]:
 		"""
 			Return list of tests
 
 			== ARGUMENTS
-			class_id - Class ID to get tests for
-			alltests - Enable getting all tests instead of just ones from the current date
+			previous - Tests from the previous run; returned without parsing if the page is unchanged
 
-			RETURNS: list of tests, formatted as {subject, test name, date (Unix timestamp)}
+			RETURNS: list of Test records, formatted as {subject, test name, date (Unix timestamp)}
 		"""
 		#self.__verify(class_id)
 		#self.__edlog(1, "Getting test list for class id %s (corresponding to actual ID [{%s}])" % (class_id, self.class_ids[class_id]))
@@ -286,104 +1176,126 @@ class edap:
 		#	addon = "/all"
 		#else:
 		#	addon = ""
-		response = self.__fetch("%s/exam" % self.edurl)
-		self.__edlog(0, "Initializing BeautifulSoup with response")
-		soup = BeautifulSoup(response, self.parser)
-		try:
-			x = soup.find('div', class_='content').find_all('div', class_='row')
-			#print(x)
-		except AttributeError:
+		response = self.__fetch("%s/exam" % self.edurl, True)
+		if previous is not None and self.pageUnchanged("/exam"):
+			self.__edlog(1, "Test list unchanged, not parsing")
+			return previous
+		exams = self.engine.parse('tests', response)
+		if not exams:
 			self.__edlog(1, "No tests remaining found")
-			return []
-		exams = []
-		for exam_object in x:
-			y = exam_object.find_all('div', class_="flex-row")
-			#print(y)
-			exams.append({'subject': y[0].text.strip(), 'exam': y[1].text.strip(), 'date': _format_to_date(y[2].text.strip() + str(datetime.now().year) + '.')})
 		return exams
 
+	def __fetch_subject(self, link: str) -> dict:
+		"""
+			Fetch and parse a subject page. The page is parsed as it's being
+			downloaded, so only the parsed data is kept. If parsing fails,
+			the page is fetched again and parsed as a whole, so the engine can
+			fall back to BeautifulSoup if needed.
+
+			== ARGUMENTS
+			link - Subject page path
+		"""
+		url = "%s%s" % (self.edurl, link)
+		try:
+			return self.__stream(url, 'subject')
+		except eDAPError:
+			raise
+		except Exception as e:
+			self.__edlog(3, "Streaming parse of [{%s}] failed (%s), parsing whole page" % (link, e))
+			return self.engine.parse('subject', self.__fetch(url, True))
+
+	def prefetchSubjects(self, workers: int = 4) -> int:
+		"""
+			Fetch and parse all subject pages for the active class
+			concurrently and store the results in `self.cache`,
+			so that getSubjectData() and friends don't have to wait on the
+			server for each subject.
+
+			All requests share the session (and its authentication cookies).
+			If fetching a subject fails, the error is logged and saved, and it
+			is raised again when that subject's data is requested.
+
+			== ARGUMENTS
+			workers - Maximum number of requests sent at the same time
+
+			RETURNS: number of fetched subjects
+		"""
+		links = [link for link in self.subject_ids if link not in self.cache]
+		if not links:
+			return 0
+		self.__edlog(1, "Prefetching %i subjects using %i workers" % (len(links), workers))
+		fetched = 0
+		with ThreadPoolExecutor(max_workers=min(workers, len(links))) as executor:
+			futures = {executor.submit(self.__fetch_subject, link): link for link in links}
+			for future in as_completed(futures):
+				link = futures[future]
+				try:
+					self.cache.put(link, future.result())
+					self.subject_errors.pop(link, None)
+					fetched += 1
+				except Exception as e:
+					self.__edlog(3, "Failed to prefetch subject [{%s}]: %s" % (link, e))
+					self.subject_errors[link] = e
+		return fetched
+
+	def getSubjectData(self, subject_id: int, previous: dict = None) -> dict:
+		"""
+			Return everything on a subject page (grades, notes and the concluded
+			grade) from a single parse. Results are cached by subject URL, so
+			getGrades() and getConcludedGrade() don't parse the page again.
+
+			Subject pages are always parsed while they're downloaded (see
+			prefetchSubjects()), so `previous` doesn't save parsing them; it's
+			only returned instead of the new result if the page is unchanged,
+			so unchanged subjects stay the same objects.
+
+			== ARGUMENTS
+			subject_id - Subject ID to get data for
+			previous - Data from the previous run; returned instead of the parsed data if the page is unchanged
+
+			RETURNS: dict formatted {grades, notes, concluded, concluded_grade, error}
+		"""
+		link = self.subject_ids[subject_id]
+		if link in self.subject_errors:
+			# Prefetching this subject failed, don't try again
+			raise self.subject_errors[link]
+		data = self.cache.get(link)
+		if data is None:
+			self.__edlog(1, "Fetching subject %s from server" % subject_id)
+			data = self.__fetch_subject(link)
+			self.cache.put(link, data)
+		if previous is not None and self.pageUnchanged(link):
+			# Keep the previous data, so unchanged subjects stay the same objects
+			self.__edlog(1, "Subject %s unchanged" % subject_id)
+			data = previous
+			self.cache.put(link, data)
+		return data
+
 	def getGrades(self, subject_id: int) -> (List[dict], List[dict]):
 		"""
 			Return grade list (dict, values "date", "note" and "grade") for a subject_id
 
 			== ARGUMENTS
-			class_id - Class ID to narrow down subject selection
 			subject_id - Subject ID to get grades for
 
-			RETURNS: list of grades, formatted {date, note, grade}
+			RETURNS: list of Grade records, formatted {date, note, grade}, and list of Note records, formatted {date, note}
 		"""
-		#self.__verify(class_id, subject_id)
-		#self.__edlog(0, "Getting grade list for subject id %s, class id %s (remote IDs subject:[{%s}] and class:[{%s}])" % (subject_id, class_id, self.subject_ids[subject_id], self.class_ids[class_id]))
-		if not self.subject_ids[subject_id] in self.subject_cache:
-			self.__edlog(1, "Fetching subject %s from server" % subject_id)
-			response = self.__fetch("%s%s" % (self.edurl, self.subject_ids[subject_id]))
-			#print(response)
-			self.subject_cache[self.subject_ids[subject_id]] = response
-		else:
-			self.__edlog(1, "Fetching subject %s from cache" % subject_id)
-			response = self.subject_cache[self.subject_ids[subject_id]]
-		self.__edlog(0, "Initializing BeautifulSoup with response")
-		soup = BeautifulSoup(response, self.parser)
-		grade_table = soup.find("div", class_="notes-table")
-		if not grade_table:
-			self.__edlog(1, "No grades found for this subject")
-			return []
-		# Find all table elements
-		x = grade_table.find_all("div", class_='row')
-		grades = []
-		notes = []
-		for grade_object in x:
-			y = grade_object.find_all('div', class_="flex-row")
-			#print(y)
-			grade = y[2].text.strip()
-			date = _format_to_date(y[1].text.strip())
-			note = y[0].text.strip()
-			if not grade:
-				notes.append({'note': note, 'date': date})
-			else:
-				grades.append({'note': note, 'date': date, 'grade': int(grade)})
-		return grades, notes
+		data = self.getSubjectData(subject_id)
+		return data['grades'], data['notes']
 
 	def getConcludedGrade(self, subject_id: int):
 		"""
 			Return whether there is a concluded grade, and if there is one, return it.
 
 			== ARGUMENTS
-			class_id - Class ID to narrow down subject selection
 			subject_id - Subject ID to get concluded grade for
 
 			RETURNS: boolean indicating if there is a concluded grade for this subject, and concluded grade if it exists, formatted (bool, int)
 		"""
-		#self.__verify(subject_id)
-		#self.__edlog(0, "Getting concluded grade for subject id %s, class id %s (corresponding to actual IDs subject:[{%s}] and class:[{%s}])" % (subject_id, class_id, self.subject_ids[subject_id], self.class_ids[class_id]))
-		if not self.subject_ids[subject_id] in self.subject_cache:
-			self.__edlog(1, "Fetching subject %s from server" % subject_id)
-			response = self.__fetch("%s%s" % (self.edurl, self.subject_ids[subject_id]))
-			self.subject_cache[self.subject_ids[subject_id]] = response
-		else:
-			self.__edlog(1, "Fetching subject %s from cache" % subject_id)
-			response = self.subject_cache[self.subject_ids[subject_id]]
-		self.__edlog(0, "Initializing BeautifulSoup with response")
-		soup = BeautifulSoup(response, self.parser)
-		try:
-			# Search the grade table for the concluded grade
-			x = soup.find("div", class_="final-grade").find_all('div', class_='flex-row')[2].text.strip()
-		except AttributeError as e:
-			raise ParseError(e)
-		if x: # If not empty/NoneType, means there's text in that table element
-			self.__edlog(0, "Got unformatted string: [{%s}]" % x)
-			# Use some regex to extract the numerical grade between the parentheses
-			result = re.search(r'\((.*)\)', x)
-			if not result:
-				raise ParseError('Regex failed to match %s' % x)
-			self.__edlog(0, "Formatted string: [{%s}]" % result.group(1))
-			self.__edlog(0, "Found concluded grade for this subject")
-			return True, int(result.group(1))
-		# Otherwise we have no concluded grade
-		self.__edlog(0, "No concluded grade found for this subject")
-		self.__edlog(0, "Decomposing tree")
-		soup.decompose()
-		return False, None
+		data = self.getSubjectData(subject_id)
+		if data['concluded'] is None:
+			raise ParseError(data['error'])
+		return data['concluded'], data['concluded_grade']
 
 	def getInfo(self, class_id: int) -> dict:
 		"""
@@ -481,13 +1393,14 @@ class edap:
 		"""
 		self.__verify(class_id)
 		self.__edlog(0, "Getting absent overview for class id %s" % class_id)
-		if not self.class_ids[class_id] in self.absence_cache:
+		url = "%s/pregled/izostanci/%s" % (self.edurl, self.class_ids[class_id])
+		response = self.cache.get(url)
+		if response is None:
 			self.__edlog(1, "Fetching absences from server")
-			response = self.__fetch("%s/pregled/izostanci/%s" % (self.edurl, self.class_ids[class_id]))
-			self.absence_cache[self.class_ids[class_id]] = response
+			response = self.__fetch(url)
+			self.cache.put(url, response)
 		else:
 			self.__edlog(1, "Fetching absences from cache")
-			response = self.absence_cache[self.class_ids[class_id]]
 		self.__edlog(0, "Initializing BeautifulSoup with response")
 		soup = BeautifulSoup(response, self.parser)
 		try:
@@ -509,49 +1422,25 @@ class edap:
 		soup.decompose()
 		return final_returnable
 
-	def getAbsenceList(self) -> List[dict]:
+	def getAbsenceList(self, previous: List[dict] = None) -> List[dict]:
 		"""
 			Return a full list of all marked absences for a given class ID.
 
 			== ARGUMENTS
-			class_id - Class ID to get absence list for
+			previous - Absences from the previous run; returned without parsing if the page is unchanged
 
-			RETURNS: list of dictionaries (sorted by day), dicts formatted {period, subject, reason, justified, absences}
+			RETURNS: list of dicts (one for each day), formatted {date, absences}, where absences is a list of Absence records, formatted {period, subject, status, reason}
 		"""
 		#self.__verify(class_id)
 		#self.__edlog(0, "Getting absent list for class id %s" % class_id)
 		#if not self.class_ids[class_id] in self.absence_cache:
 		#	self.__edlog(1, "Fetching absences from server")
-		response = self.__fetch("%s/absent" % self.edurl)
+		response = self.__fetch("%s/absent" % self.edurl, True)
+		if previous is not None and self.pageUnchanged("/absent"):
+			self.__edlog(1, "Absence list unchanged, not parsing")
+			return previous
 		#	self.absence_cache[self.class_ids[class_id]] = response
 		#else:
 		#	self.__edlog(1, "Fetching absences from cache")
 		#	response = self.absence_cache[self.class_ids[class_id]]
-		self.__edlog(0, "Initializing BeautifulSoup with response")
-		soup = BeautifulSoup(response, self.parser)
-		x = soup.find_all('div', class_='absent-table')
-		absences = []
-		if not x:
-			return absences
-		for absgroup in x:
-			#print(absgroup)
-			date = _format_to_date(absgroup.find('div', class_='first').text.split(' - ')[1].strip())
-			abs_group_filtered = {
-				'date': date,
-				'absences': []
-			}
-			rows = absgroup.find_all('div', class_='row')
-			for row in rows:
-				data = row.find_all('div', class_='flex-row')
-				period = int(data[0].text)
-				subject = data[1].text
-				status = _determine_absence_status(data[2].find('i'))
-				reason = data[3].text.strip()
-				abs_group_filtered['absences'].append({
-					'period': period,
-					'subject': subject,
-					'status': status,
-					'reason': reason
-				})
-			absences.append(abs_group_filtered)
-		return absences
+		return self.engine.parse('absences', response)
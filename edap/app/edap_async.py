@@ -0,0 +1,189 @@
+"""An asyncio version of eDAP, using HTTPX for non-blocking requests."""
+import asyncio, logging
+from typing import List
+import httpx
+from edap import (EDAP_VERSION, eDAPError, WrongCredentials, ServerInMaintenance,
+                  NetworkError, InvalidResponse, ParseError, InvalidClassID,
+                  InvalidSubjectID, SessionExpired, PageCache, get_engine)
+
+log = logging.getLogger(__name__)
+
+class edap_async:
+	"""
+		eDnevnik scraping library, asyncio version.
+
+		Requests don't block the event loop, and parsing is done in an
+		executor (the default thread pool, unless specified otherwise). The
+		same exceptions as in eDAP are raised.
+
+		Usage:
+			async with edap_async(user, pasw) as obj:
+				classes = await obj.getClasses()
+	"""
+	def __init__(self,
+	             user: str,
+	             pasw: str,
+	             parser: str = "lxml",
+	             edurl: str = "https://ocjene.skole.hr",
+	             ua: str = "Mozilla/5.0 eDAP/%s" % EDAP_VERSION,
+	             headers: dict = None,
+	             pool_size: int = 10,
+	             timeout: tuple = (10, 30),
+	             executor=None,
+	             engine: str = "lxml",
+	             cache_size: int = 2 * 1024 * 1024):
+		"""
+			Set up the client; nothing is sent until login() is awaited.
+
+			== ARGUMENTS
+			user - Username for eDnevnik
+			pasw - Password for eDnevnik
+			parser - The parser that will be used for BeautifulSoup (default: lxml)
+			edurl - eDnevnik URL (default: https://ocjene.skole.hr)
+			ua - User-Agent header
+			headers - HTTP headers to append to all requests
+			pool_size - Maximum number of connections kept alive (default: 10)
+			timeout - Connect and read timeouts in seconds, formatted (connect, read) (default: (10, 30))
+			executor - concurrent.futures executor used for parsing (default: the event loop's default executor)
+			engine - Parser engine, can be lxml, bs4 or diff, see edap.get_engine() (default: lxml)
+			cache_size - Maximum size of cached subject data, in bytes, see edap.PageCache (default: 2 MiB)
+		"""
+		self.user = user
+		self.__pasw = pasw
+		self.parser = parser
+		self.engine = get_engine(engine, parser)
+		self.edurl = edurl
+		self.executor = executor
+		self.class_ids = []
+		self.subject_ids = []
+		self.cache = PageCache(cache_size)
+		client_headers = {"User-Agent": ua}
+		if headers:
+			client_headers.update(headers)
+		self.client = httpx.AsyncClient(
+			headers=client_headers,
+			timeout=httpx.Timeout(timeout[1], connect=timeout[0]),
+			limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+			follow_redirects=True
+		)
+
+	async def __aenter__(self):
+		await self.login()
+		return self
+
+	async def __aexit__(self, *args):
+		await self.close()
+
+	async def close(self):
+		"""
+			Close the client and all of its kept-alive connections.
+		"""
+		await self.client.aclose()
+
+	async def __request(self, method: str, url: str, **kwargs) -> httpx.Response:
+		"""
+			Send a request and raise NetworkError for non 2xx codes or
+			connection failures.
+		"""
+		try:
+			response = await self.client.request(method, url, **kwargs)
+			response.raise_for_status()
+			return response
+		except (httpx.HTTPStatusError, httpx.TransportError):
+			raise NetworkError(url)
+
+	async def __fetch(self, url: str) -> str:
+		response = await self.__request("GET", url)
+		if response.history and response.url.path == '/login':
+			raise SessionExpired(url)
+		return response.content.decode('utf-8')
+
+	async def __parse(self, page: str, html: str):
+		"""
+			Parse a page of type `page` in the executor, so parsing doesn't
+			block the event loop.
+		"""
+		return await asyncio.get_running_loop().run_in_executor(self.executor, self.engine.parse, page, html)
+
+	async def login(self):
+		"""
+			Authenticate the user to eDnevnik.
+		"""
+		log.debug("Sending initial request to obtain CSRF")
+		response = await self.__request("GET", "%s/login" % self.edurl)
+		csrf = await self.__parse('csrf', response.text)
+		if csrf is None:
+			if "u nadogradnji" in response.text:
+				raise ServerInMaintenance
+			raise InvalidResponse("Can't get CSRF from initial request")
+		response = await self.__request("POST", "%s/login" % self.edurl,
+		                                data={"csrf_token": csrf, "username": self.user, "password": self.__pasw})
+		if "Neispravno korisničko ime ili lozinka." in response.text:
+			raise WrongCredentials
+		log.debug("Authentication successful")
+
+	async def getClasses(self) -> List[dict]:
+		"""
+			Returns all classes offered by the post-login screen, see edap.getClasses().
+		"""
+		classlist, self.class_ids = await self.__parse('classes', await self.__fetch("%s/class" % self.edurl))
+		return classlist
+
+	async def switchActiveClass(self, class_id: int):
+		"""
+			Make `class_id` the active class for getSubjects(), getTests(), etc.
+		"""
+		if not 0 <= class_id < len(self.class_ids):
+			raise InvalidClassID("Class ID %s not found; did you forget to run getClasses()?" % class_id)
+		await self.__fetch('%s%s' % (self.edurl, self.class_ids[class_id]))
+		self.subject_ids = []
+
+	async def getSubjects(self) -> List[dict]:
+		"""
+			Return list of subjects and professors for the active class.
+		"""
+		subjects, self.subject_ids = await self.__parse('subjects', await self.__fetch("%s/course" % self.edurl))
+		return subjects
+
+	async def getTests(self) -> List[dict]:
+		"""
+			Return list of tests for the active class.
+		"""
+		return await self.__parse('tests', await self.__fetch("%s/exam" % self.edurl))
+
+	async def getSubjectData(self, subject_id: int) -> dict:
+		"""
+			Return grades, notes and the concluded grade for a subject, see
+			edap.getSubjectData(). Results are cached by subject URL.
+		"""
+		if not 0 <= subject_id < len(self.subject_ids):
+			raise InvalidSubjectID("Subject ID %s not found; did you forget to run getSubjects()?" % subject_id)
+		link = self.subject_ids[subject_id]
+		data = self.cache.get(link)
+		if data is None:
+			html = await self.__fetch("%s%s" % (self.edurl, link))
+			data = await self.__parse('subject', html)
+			self.cache.put(link, data)
+		return data
+
+	async def getGrades(self, subject_id: int) -> (List[dict], List[dict]):
+		"""
+			Return grade and note lists for a subject, see edap.getGrades().
+		"""
+		data = await self.getSubjectData(subject_id)
+		return data['grades'], data['notes']
+
+	async def getConcludedGrade(self, subject_id: int):
+		"""
+			Return whether there is a concluded grade, and if there is one, return it.
+		"""
+		data = await self.getSubjectData(subject_id)
+		if data['concluded'] is None:
+			raise ParseError(data['error'])
+		return data['concluded'], data['concluded_grade']
+
+	async def getAbsenceList(self) -> List[dict]:
+		"""
+			Return a full list of all marked absences for the active class.
+		"""
+		return await self.__parse('absences', await self.__fetch("%s/absent" % self.edurl))
@@ -0,0 +1,183 @@
+"""
+	Per-process cache of Redis hashes, invalidated through Redis pub/sub.
+
+	Every uWSGI worker keeps the hashes it read recently (e.g. a profile's
+	classes, see api_backend.profile_cache()) in a HashCache, so a user
+	opening several screens in a row only reads them from Redis once. The
+	decoded values of fields are cached along with them.
+
+	Whoever changes a hash calls invalidate() after writing it, which
+	drops it from the local cache and publishes its key on a channel; a
+	thread in every process listens on the channel and drops the key from
+	its cache. Hashes read while an invalidation arrives aren't cached, so
+	a stale value can't be stored after its invalidation. If the listener
+	loses its connection to Redis, the whole cache is cleared (messages
+	may have been missed), and every entry expires after `ttl` seconds in
+	any case.
+
+	The cache is an LRU bounded by `max_bytes`, estimated from the size of
+	the stored (encoded) fields. Cached values are shared between
+	requests, so they must not be changed by their users.
+"""
+import json, logging, os
+from collections import OrderedDict
+from threading import Lock, Thread
+from time import monotonic, sleep
+import redis
+
+log = logging.getLogger(__name__)
+
+# Decoded values take several times more memory than encoded ones
+_DECODED_OVERHEAD = 3
+
+class _Entry:
+	__slots__ = ('fields', 'decoded', 'size', 'expires')
+
+	def __init__(self, fields: dict, expires: float):
+		self.fields = fields
+		self.decoded = {}
+		self.size = sum(len(field) + len(value) for field, value in fields.items())
+		self.expires = expires
+
+class HashCache:
+	"""
+		LRU cache of Redis hashes, see the module docstring.
+	"""
+	def __init__(self, redis_conn, max_bytes: int, ttl: float = 300, channel: str = 'hashcache:invalidate'):
+		"""
+			== ARGUMENTS
+			redis_conn - Redis connection
+			max_bytes - Approximate maximum size of the cache in bytes
+			ttl - Seconds after which a cached hash is read again
+			channel - Pub/sub channel on which changed keys are published
+		"""
+		self.redis = redis_conn
+		self.max_bytes = max_bytes
+		self.ttl = ttl
+		self.channel = channel
+		self.entries = OrderedDict()
+		self.size = 0
+		self.lock = Lock()
+		# Incremented by every invalidation, see load()
+		self.generation = 0
+		self.listener_pid = None
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.invalidations = 0
+
+	def __remove(self, key: str):
+		entry = self.entries.pop(key, None)
+		if entry:
+			self.size -= entry.size * (1 + _DECODED_OVERHEAD)
+
+	def load(self, key: str, loader) -> dict:
+		"""
+			Return the fields of a hash (as a dict formatted {str: bytes}),
+			calling `loader` to read them from Redis if they aren't cached.
+		"""
+		self.__ensure_listener()
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry and entry.expires > monotonic():
+				self.entries.move_to_end(key)
+				self.hits += 1
+				return entry.fields
+			self.misses += 1
+			generation = self.generation
+		fields = loader()
+		with self.lock:
+			# Don't store what was read while something was invalidated
+			if generation == self.generation:
+				self.__remove(key)
+				entry = _Entry(fields, monotonic() + self.ttl)
+				self.entries[key] = entry
+				self.size += entry.size * (1 + _DECODED_OVERHEAD)
+				while self.size > self.max_bytes and self.entries:
+					self.__remove(next(iter(self.entries)))
+					self.evictions += 1
+		return fields
+
+	def decode(self, key: str, field: str, value: bytes, decoder):
+		"""
+			Return `decoder(value)`, caching the result if `value` is the
+			cached value of the field.
+		"""
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is None or entry.fields.get(field) is not value:
+				entry = None
+			elif field in entry.decoded:
+				return entry.decoded[field]
+		decoded = decoder(value)
+		if entry is not None:
+			with self.lock:
+				entry.decoded[field] = decoded
+		return decoded
+
+	def __drop(self, keys):
+		with self.lock:
+			self.generation += 1
+			for key in keys:
+				if key in self.entries:
+					self.__remove(key)
+					self.invalidations += 1
+
+	def invalidate(self, *keys):
+		"""
+			Drop hashes from the cache of every process. Call this after
+			changing them in Redis.
+		"""
+		if not keys:
+			return
+		self.__drop(keys)
+		try:
+			self.redis.publish(self.channel, json.dumps(keys))
+		except redis.exceptions.RedisError as e:
+			log.warning('Failed to publish cache invalidation: %s', e)
+
+	def clear(self):
+		with self.lock:
+			self.generation += 1
+			self.entries.clear()
+			self.size = 0
+
+	def __ensure_listener(self):
+		# Threads don't survive forking (e.g. by uWSGI), so every process
+		# starts its own listener
+		if self.listener_pid != os.getpid():
+			self.listener_pid = os.getpid()
+			self.clear()
+			Thread(target=self.__listen, daemon=True).start()
+
+	def __listen(self):
+		while True:
+			try:
+				pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+				pubsub.subscribe(self.channel)
+				for message in pubsub.listen():
+					if message['type'] == 'message':
+						self.__drop(json.loads(message['data']))
+			except redis.exceptions.RedisError as e:
+				log.warning('Cache invalidation listener failed, clearing cache: %s', e)
+			# Invalidations could have been missed
+			self.clear()
+			sleep(1)
+
+	def stats(self) -> dict:
+		"""
+			RETURNS: dict formatted {pid, entries, size, max_size, hits, misses, hit_ratio, evictions, invalidations}
+		"""
+		with self.lock:
+			requests = self.hits + self.misses
+			return {
+				'pid': os.getpid(),
+				'entries': len(self.entries),
+				'size': self.size,
+				'max_size': self.max_bytes,
+				'hits': self.hits,
+				'misses': self.misses,
+				'hit_ratio': round(self.hits / requests, 3) if requests else 0,
+				'evictions': self.evictions,
+				'invalidations': self.invalidations
+			}
@@ -0,0 +1,348 @@
+"""
+	Local stand-in for e-Dnevnik (ocjene.skole.hr), used for testing and
+	benchmarking eDAP without a network connection or real accounts.
+
+	The server mimics the CSRF/login flow and the pages eDAP reads (/class,
+	/course, /exam, /absent and subject pages), and serves synthetic
+	students with a configurable number of classes, subjects and grades.
+	Latency can be added to every request, and maintenance mode (the
+	"u nadogradnji" page) can be turned on and off while running.
+
+	Students are named `ucenik0`, `ucenik1`, ..., with passwords `lozinka0`,
+	`lozinka1`, ...
+
+	Usage:
+		python3 mock_server.py [--port 8080] [--students 10] [--classes 2] [--subjects 12] [--grades 10] [--latency 0.05] [--maintenance]
+
+	From Python:
+		server = MockServer(students=10)
+		url = server.start()
+		obj = edap.edap('ucenik0', 'lozinka0', edurl=url)
+		...
+		server.stop()
+
+	eDAP-API can be pointed at the server using the UPSTREAM_URL variable.
+"""
+import random, sys
+from html import escape
+from secrets import token_hex
+from threading import Lock, Thread
+from time import sleep
+from flask import Flask, request, redirect, make_response
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+SUBJECT_NAMES = ['Hrvatski jezik', 'Engleski jezik', 'Matematika', 'Fizika', 'Kemija', 'Biologija', 'Povijest',
+                 'Geografija', 'Informatika', 'Tjelesna i zdravstvena kultura', 'Glazbena umjetnost',
+                 'Likovna umjetnost', 'Njemački jezik', 'Etika', 'Politika i gospodarstvo', 'Sociologija',
+                 'Psihologija', 'Filozofija', 'Logika', 'Latinski jezik']
+NOTES = ['Usmeno ispitivanje', 'Pisana provjera znanja', 'Domaća zadaća', 'Referat', 'Aktivnost na satu',
+         'Kontrolni ispit', 'Praktični rad', 'Projektni zadatak', 'Esej na zadanu temu', 'Laboratorijska vježba']
+GRADE_NAMES = ['nedovoljan', 'dovoljan', 'dobar', 'vrlo dobar', 'odličan']
+DAYS = ['Ponedjeljak', 'Utorak', 'Srijeda', 'Četvrtak', 'Petak']
+STATUSES = ['green', 'red', 'black', 'gold']
+
+PAGE = '''<!DOCTYPE html>
+<html lang="hr">
+<head>
+	<meta charset="utf-8">
+	<title>e-Dnevnik</title>
+	<link rel="stylesheet" href="/static/css/main.css">
+</head>
+<body>
+%s
+<main>
+%s
+</main>
+<footer><span>&copy; CARNET</span></footer>
+</body>
+</html>
+'''
+HEADER = '''<header>
+	<div class="logged-in-user">
+		<div class="user-name">%s</div>
+		<form class="logout" method="post" action="/logout">
+			<input type="hidden" name="csrf_token" value="%s">
+			<button type="submit">Odjava</button>
+		</form>
+	</div>
+</header>'''
+MAINTENANCE = PAGE % ('', '<div class="maintenance"><h1>e-Dnevnik je trenutno u nadogradnji.</h1><p>Molimo pokušajte kasnije.</p></div>')
+
+class _RequestHandler(WSGIRequestHandler):
+	# Keep connections alive, like the real server
+	protocol_version = 'HTTP/1.1'
+
+	def log_request(self, *args):
+		pass
+
+def _date(rng: random.Random, with_year: bool = True) -> str:
+	if with_year:
+		return '%d.%d.2020.' % (rng.randint(1, 28), rng.randint(9, 12))
+	return '%d.%d.' % (rng.randint(1, 28), rng.randint(1, 12))
+
+class Student:
+	"""
+		A synthetic e-Dnevnik user, with randomly generated (but repeatable,
+		given the same seed) classes, subjects, grades, exams and absences.
+	"""
+	def __init__(self, username: str, password: str, classes: int = 2, subjects: int = 12, grades: int = 10, seed: int = 0):
+		self.username = username
+		self.password = password
+		self.rng = random.Random(seed)
+		self.name = 'Učenik %s' % username
+		self.classes = []
+		for i in range(classes):
+			class_subjects = []
+			for j in range(subjects):
+				class_subjects.append({
+					'name': SUBJECT_NAMES[j % len(SUBJECT_NAMES)],
+					'professor': 'Nastavnik %i' % j,
+					'grades': [self.__random_grade() for _ in range(grades)],
+					# Past classes have concluded grades
+					'concluded': self.rng.randint(1, 5) if i else None
+				})
+			self.classes.append({
+				'class_id': '%i.a' % (4 - i),
+				'year': '%i./%i.' % (2020 - i, 2021 - i),
+				'school': 'Gimnazija Primjer',
+				'subjects': class_subjects,
+				'exams': [{'subject': self.rng.choice(class_subjects)['name'], 'exam': self.rng.choice(NOTES),
+				           'date': _date(self.rng, False)} for _ in range(self.rng.randint(0, 8))],
+				'absences': [{'date': _date(self.rng), 'periods': [{
+					'subject': self.rng.choice(class_subjects)['name'],
+					'status': self.rng.choice(STATUSES),
+					'reason': self.rng.choice(['Bolest', 'Opravdao roditelj', ''])
+				} for _ in range(self.rng.randint(1, 6))]} for _ in range(self.rng.randint(0, 10))]
+			})
+
+	def __random_grade(self) -> dict:
+		return {
+			'note': self.rng.choice(NOTES),
+			'date': _date(self.rng),
+			# Some rows are notes without a grade
+			'grade': None if self.rng.random() < 0.2 else self.rng.randint(1, 5)
+		}
+
+	def add_grade(self, class_id: int = 0, subject_id: int = 0, grade: int = None, note: str = None, date: str = None):
+		"""
+			Add a grade (or a note, if `grade` is None) to a subject, e.g. to
+			make a sync find something new.
+		"""
+		self.classes[class_id]['subjects'][subject_id]['grades'].append({
+			'note': note or self.rng.choice(NOTES),
+			'date': date or _date(self.rng),
+			'grade': grade
+		})
+
+class MockServer:
+	"""
+		Stand-in e-Dnevnik server, see the module docstring.
+
+		`latency` (seconds, or a (min, max) tuple for random latency) and
+		`maintenance` can be changed while the server is running. Counters
+		of requests and logins are in `stats`.
+	"""
+	def __init__(self,
+	             students: int = 10,
+	             classes: int = 2,
+	             subjects: int = 12,
+	             grades: int = 10,
+	             latency=0,
+	             maintenance: bool = False,
+	             seed: int = 0):
+		self.students = {}
+		for i in range(students):
+			self.add_student(Student('ucenik%i' % i, 'lozinka%i' % i, classes, subjects, grades, seed + i))
+		self.latency = latency
+		self.maintenance = maintenance
+		self.sessions = {}
+		self.csrf_tokens = set()
+		self.stats = {'requests': 0, 'logins': 0}
+		self.lock = Lock()
+		self.server = None
+		self.app = self.__make_app()
+
+	def add_student(self, student: Student):
+		self.students[student.username] = student
+
+	def expire_sessions(self):
+		"""
+			Log everyone out, so that the next request of every client is
+			redirected to the login page.
+		"""
+		with self.lock:
+			self.sessions.clear()
+
+	def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+		"""
+			Start serving in a background thread and return the server's URL,
+			to be used as `edurl`. If `port` is 0, a free port is used.
+		"""
+		self.server = make_server(host, port, self.app, threaded=True, request_handler=_RequestHandler)
+		Thread(target=self.server.serve_forever, daemon=True).start()
+		return 'http://%s:%i' % (host, self.server.server_port)
+
+	def stop(self):
+		if self.server:
+			self.server.shutdown()
+			self.server = None
+
+	def __new_csrf(self) -> str:
+		token = token_hex(16)
+		with self.lock:
+			self.csrf_tokens.add(token)
+		return token
+
+	def __get_session(self):
+		with self.lock:
+			return self.sessions.get(request.cookies.get('session'))
+
+	def __page(self, session: dict, content: str) -> str:
+		return PAGE % (HEADER % (escape(session['student'].name), session['csrf']), content)
+
+	def __make_app(self) -> Flask:
+		app = Flask(__name__)
+
+		@app.before_request
+		def before_request():
+			with self.lock:
+				self.stats['requests'] += 1
+			latency = self.latency
+			if isinstance(latency, (tuple, list)):
+				latency = random.uniform(*latency)
+			if latency:
+				sleep(latency)
+			if self.maintenance:
+				return MAINTENANCE
+			if request.endpoint not in ('login', 'login_post'):
+				session = self.__get_session()
+				if not session:
+					return redirect('/login')
+				request.session = session
+
+		@app.route('/login', methods=['GET'])
+		def login():
+			return self.__login_page()
+
+		@app.route('/login', methods=['POST'])
+		def login_post():
+			with self.lock:
+				csrf_valid = request.form.get('csrf_token') in self.csrf_tokens
+				self.csrf_tokens.discard(request.form.get('csrf_token'))
+			if not csrf_valid:
+				return redirect('/login')
+			student = self.students.get(request.form.get('username'))
+			if not student or student.password != request.form.get('password'):
+				return self.__login_page('<div class="error">Neispravno korisničko ime ili lozinka.</div>')
+			session_id = token_hex(16)
+			with self.lock:
+				self.sessions[session_id] = {'student': student, 'class': 0, 'csrf': token_hex(16)}
+				self.stats['logins'] += 1
+			response = redirect('/class')
+			response.set_cookie('session', session_id, httponly=True)
+			return response
+
+		@app.route('/logout', methods=['POST'])
+		def logout():
+			with self.lock:
+				self.sessions.pop(request.cookies.get('session'), None)
+			return redirect('/login')
+
+		@app.route('/class')
+		def classes():
+			content = '<div class="classes">\n'
+			for i, class_obj in enumerate(request.session['student'].classes):
+				content += '''<div class="class-menu-vertical">
+	<div class="class"><span class="bold">%s</span><span class="class-schoolyear">%s</span></div>
+	<div class="school"><div class="school-name"> %s </div></div>
+	<a class="school" href="/class_action/%i/course"></a>
+</div>
+''' % (class_obj['class_id'], class_obj['year'], escape(class_obj['school']), i)
+			return self.__page(request.session, content + '</div>')
+
+		@app.route('/class_action/<int:class_id>/course')
+		def class_action(class_id):
+			if not 0 <= class_id < len(request.session['student'].classes):
+				return make_response('Not found', 404)
+			request.session['class'] = class_id
+			return redirect('/course')
+
+		@app.route('/course')
+		def course():
+			content = '<div class="content">\n'
+			for i, subject in enumerate(self.__active_class()['subjects']):
+				# Like on e-Dnevnik, every class has its own subject links
+				content += '<a href="/grade/%i"><div class="course"><span class="course-name">%s</span> <span class="course-info"> %s </span></div></a>\n' % (
+					request.session['class'] * 1000 + i, escape(subject['name']), escape(subject['professor']))
+			return self.__page(request.session, content + '</div>')
+
+		@app.route('/grade/<int:link_id>')
+		def grade(link_id):
+			subjects = self.__active_class()['subjects']
+			subject_id = link_id - request.session['class'] * 1000
+			if not 0 <= subject_id < len(subjects):
+				return make_response('Not found', 404)
+			subject = subjects[subject_id]
+			content = '<div class="content">\n<div class="notes-table">\n<div class="table-header"><div class="flex-row">Bilješka</div><div class="flex-row">Datum</div><div class="flex-row">Ocjena</div></div>\n'
+			for row in subject['grades']:
+				content += '<div class="row"><div class="flex-row">%s</div><div class="flex-row">%s</div><div class="flex-row">%s</div></div>\n' % (
+					escape(row['note']), row['date'], row['grade'] or '')
+			concluded = '%s (%i)' % (GRADE_NAMES[subject['concluded'] - 1], subject['concluded']) if subject['concluded'] else ''
+			content += '</div>\n<div class="final-grade"><div class="flex-row">Zaključna ocjena</div><div class="flex-row"></div><div class="flex-row">%s</div></div>\n</div>' % concluded
+			return self.__page(request.session, content)
+
+		@app.route('/exam')
+		def exam():
+			content = '<div class="content">\n'
+			for row in self.__active_class()['exams']:
+				content += '<div class="row"><div class="flex-row">%s</div><div class="flex-row">%s</div><div class="flex-row">%s</div></div>\n' % (
+					escape(row['subject']), escape(row['exam']), row['date'])
+			return self.__page(request.session, content + '</div>')
+
+		@app.route('/absent')
+		def absent():
+			content = '<div class="content">\n'
+			for i, day in enumerate(self.__active_class()['absences']):
+				content += '<div class="absent-table"><div class="first">%s - %s</div>\n' % (DAYS[i % len(DAYS)], day['date'])
+				for period, row in enumerate(day['periods']):
+					content += '<div class="row"><div class="flex-row">%i</div><div class="flex-row">%s</div><div class="flex-row"><i class="icon %s"></i></div><div class="flex-row">%s</div></div>\n' % (
+						period + 1, escape(row['subject']), row['status'], escape(row['reason']))
+				content += '</div>\n'
+			return self.__page(request.session, content + '</div>')
+
+		return app
+
+	def __active_class(self) -> dict:
+		return request.session['student'].classes[request.session['class']]
+
+	def __login_page(self, error: str = '') -> str:
+		return PAGE % ('', '''<div class="login-box">%s
+	<form method="post" action="/login">
+		<input type="hidden" name="csrf_token" value="%s">
+		<input type="text" name="username">
+		<input type="password" name="password">
+		<button type="submit">Prijava</button>
+	</form>
+</div>''' % (error, self.__new_csrf()))
+
+def _get_arg(name: str, default=None):
+	if name in sys.argv:
+		return sys.argv[sys.argv.index(name) + 1]
+	return default
+
+if __name__ == '__main__':
+	server = MockServer(
+		students=int(_get_arg('--students', 10)),
+		classes=int(_get_arg('--classes', 2)),
+		subjects=int(_get_arg('--subjects', 12)),
+		grades=int(_get_arg('--grades', 10)),
+		latency=float(_get_arg('--latency', 0)),
+		maintenance='--maintenance' in sys.argv
+	)
+	url = server.start(port=int(_get_arg('--port', 8080)))
+	print('[mock] Serving %i students at %s' % (len(server.students), url))
+	try:
+		while True:
+			sleep(3600)
+	except KeyboardInterrupt:
+		server.stop()
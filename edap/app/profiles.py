@@ -0,0 +1,211 @@
+"""
+eDAP profile functions
+====
+
+This module builds the data objects ("profiles") stored by eDAP-API from
+an eDAP object. It has no side effects (no configuration, database or
+network access other than through the given eDAP object), so it can be
+used both by the backend and by batch.py.
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from math import floor as _math_floor
+from math import ceil as _math_ceil
+
+log = logging.getLogger(__name__)
+
+def _round(n, decimals=0):
+	"""
+		Improved round function. Rounds .5 upwards instead of builtin
+		round()'s downwards rounding.
+		Taken from this StackOverflow answer: https://stackoverflow.com/a/52617883
+	"""
+	expoN = n * 10 ** decimals
+	if abs(expoN) - abs(_math_floor(expoN)) < 0.5:
+		return _math_floor(expoN) / 10 ** decimals
+	return _math_ceil(expoN) / 10 ** decimals
+
+def populate_data(obj, previous: dict = None, subject_workers: int = 4) -> dict:
+	"""
+		Call get_class_profile() to initialize the data object in
+		a newly-created profile.
+
+		If the data object from the previous sync is given as `previous`,
+		data from pages which haven't changed since then is reused
+		instead of parsing them again (except for subject pages, which
+		are parsed while they're downloaded; see get_class_profile()).
+		`subject_workers` subject pages are fetched at the same time.
+	"""
+	# TODO: Should probably be merged with `get_class_profile()`.
+	data_dict = {'classes':None}
+	try:
+		output = obj.getClasses()
+	except Exception as e:
+		log.error("Error getting classes: %s", e)
+		raise e
+
+	output[0] = get_class_profile(obj, 0, output[0], previous['classes'][0] if previous else None, subject_workers)
+	data_dict['classes'] = output
+	return data_dict
+
+def _previous_subject_data(previous_class, subject_id: int, name: str):
+	"""
+		Convert a subject from the previous class profile back into the
+		format returned by edap.getSubjectData(), so eDAP can return it
+		instead of the new result if the subject's page hasn't changed. Returns None if the subject
+		can't be reused.
+	"""
+	try:
+		subject = previous_class['subjects'][subject_id]
+	except (KeyError, IndexError, TypeError):
+		return None
+	if subject['subject'] != name or 'concluded' not in subject:
+		return None
+	return {
+		'grades': subject['grades'],
+		'notes': subject['notes'],
+		'concluded': subject['concluded'],
+		'concluded_grade': subject['average'] if subject['concluded'] else None,
+		'error': None
+	}
+
+def get_class_profile(obj, class_id: int, class_obj, previous: dict = None, subject_workers: int = 4) -> dict:
+	"""
+		Add/modify a list of classes from eDAP. `class_id` is the
+		class ID that will be "expanded" (add grades, exams, etc.)
+		and class_obj is the class object to which the data will
+		be assigned to.
+
+		`previous` is the same class from the previous sync, if any; data
+		from pages which haven't changed is taken from it. Unchanged test
+		and absence pages aren't parsed at all, while subject pages are
+		always parsed as they're prefetched and only their previous
+		results are kept. Data from pages which couldn't be fetched or
+		parsed is also taken from it, so a temporary failure doesn't look
+		like removed grades (and the grades like new ones once it's over).
+		`subject_workers` is passed on to eDAP's prefetchSubjects().
+	"""
+	if previous is None:
+		previous = {}
+	# TODO: Rewrite a lot of this and the invoking code, makes very little sense right now; handle exceptions properly.
+	obj.switchActiveClass(class_id)
+	try:
+		# Get a list of current tests and all tests
+		tests = obj.getTests(previous.get('tests'))
+		# Init a testId var so we can assign an ID to the tests
+		testId = 0
+		for x in tests:
+			x['id'] = testId
+			testId += 1
+		# Create a new 'tests' item in the dictionary
+		class_obj['tests'] = tests
+	except Exception as e:
+		log.error("Error getting tests for class: %s", e)
+		class_obj['tests'] = previous.get('tests')
+
+	"""
+	try:
+		# Get an overview of absences (counters)
+		absences_overview = obj.getAbsenceOverview(class_id)
+		class_obj['absences'] = {'overview':absences_overview, 'full': []}
+	except Exception as e:
+		log.error("Error getting absence overview for class: %s", e)
+		class_obj['absences'] = {'overview': None, 'full': []}
+	"""
+	# The absence overview is not available at the moment
+	class_obj.setdefault('absences', {'overview': None, 'full': []})
+	try:
+		# If we have an overview, we can continue with making a full
+		# list of absences, sorted by day.
+		if class_obj['absences']['overview']:
+			absences_full = obj.getAbsenceList(previous.get('absences', {}).get('full'))
+			class_obj['absences']['full'] = absences_full
+	except Exception as e:
+		log.error("Error getting absence full list for class: %s", e)
+		class_obj['absences']['full'] = previous.get('absences', {}).get('full') or []
+
+	try:
+		# Get a list of subjects
+		class_obj['subjects'] = obj.getSubjects()
+	except Exception as e:
+		log.error("Error getting subjects for class: %s", e)
+		class_obj['subjects'] = None
+	else:
+		# Fetch all subject pages at once; failed subjects are handled below
+		obj.prefetchSubjects(subject_workers)
+	# Init a list of average grades for all subjects (for calculating
+	# the general average)
+	allSubjAverageGrades = []
+	for z in range(len(class_obj['subjects'])):
+		class_obj['subjects'][z]['id'] = z
+		previous_subject = _previous_subject_data(previous, z, class_obj['subjects'][z]['subject'])
+		try:
+			try:
+				# Get the parsed subject page, or the previous data if it's unchanged
+				obj.getSubjectData(z, previous_subject)
+				# Get a list of all grades
+				class_obj['subjects'][z]['grades'], class_obj['subjects'][z]['notes'] = obj.getGrades(z)
+				# Check if we have a concluded grade
+				isconcl, concluded = obj.getConcludedGrade(z)
+			except Exception as e:
+				if previous_subject is None:
+					raise
+				log.error("Error getting grades for subject %s, keeping previous data: %s", z, e)
+				class_obj['subjects'][z]['grades'], class_obj['subjects'][z]['notes'] = previous_subject['grades'], previous_subject['notes']
+				isconcl, concluded = previous_subject['concluded'], previous_subject['concluded_grade']
+			# Store the boolean for use in the UI
+			class_obj['subjects'][z]['concluded'] = isconcl
+			if isconcl:
+				# Skip calculating grade if it's already concluded
+				class_obj['subjects'][z]['average'] = concluded
+				allSubjAverageGrades.append(concluded)
+			elif class_obj['subjects'][z]['grades']:
+				# Otherwise do the standard calculating (sum(grades)/len(grades))
+				lgrades = []
+				for i in class_obj['subjects'][z]['grades']:
+					lgrades.append(i['grade'])
+				class_obj['subjects'][z]['average'] = _round(sum(lgrades)/len(lgrades), 2)
+				allSubjAverageGrades.append(_round(sum(lgrades)/len(lgrades), 0))
+			else:
+				log.debug('No grades for sID %s', z)
+		except Exception as e:
+			log.error("Error getting grades for subject %s: %s", z, e)
+			class_obj['subjects'][z]['grades'] = []
+	try:
+		# Calculate the general average
+		class_obj['complete_avg'] = _round(sum(allSubjAverageGrades)/len(allSubjAverageGrades), 2)
+	except ZeroDivisionError:
+		# Avoid division by zero/no grades
+		class_obj['complete_avg'] = 0
+	"""
+	try:
+		# Finally, get user information
+		class_obj['info'] = obj.getInfo(0)
+	except Exception as e:
+		log.error("Error getting info: %s", str(e))
+		class_obj['info'] = None
+	"""
+	# Mark it as full/expanded
+	class_obj['full'] = True
+	return class_obj
+
+def expand_classes(sessions: dict, classes: list, previous: list = None, subject_workers: int = 4) -> list:
+	"""
+		Expand several classes at the same time (see get_class_profile()).
+		`sessions` maps class IDs to eDAP objects, each with its own
+		e-Dnevnik session (see edap.openSession()), as the active class
+		is part of the session. The expanded classes are replaced in
+		`classes` (a list, or a dict of classes by class ID), which is
+		returned.
+
+		`previous` is the list of classes from the previous sync, if any.
+	"""
+	def expand(class_id: int) -> dict:
+		previous_class = previous[class_id] if previous and class_id < len(previous) else None
+		return get_class_profile(sessions[class_id], class_id, classes[class_id], previous_class, subject_workers)
+	with ThreadPoolExecutor(max_workers=max(len(sessions), 1)) as executor:
+		futures = {executor.submit(expand, class_id): class_id for class_id in sessions}
+		for future in as_completed(futures):
+			classes[futures[future]] = future.result()
+	return classes
@@ -0,0 +1,130 @@
+"""
+	Rate limiting of requests to e-Dnevnik, shared through Redis.
+
+	RateLimiter is a token bucket kept in Redis and updated by a Lua
+	script, so all uWSGI workers (and all of their sync threads) share one
+	limit of `rate` requests per second to e-Dnevnik, with bursts of up to
+	`burst` requests.
+
+	Requests go through lanes: a lane's throttle function is passed to eDAP
+	(as `throttle`) and blocks until the request may be sent. Requests
+	from the background lane (syncs) can't use the last `reserve` part of
+	the bucket, which is left for the interactive lane (logins, fetching
+	classes), so users waiting for a response are throttled last.
+
+	Requests, throttled requests and time spent waiting are counted for
+	every lane, see stats().
+"""
+import logging
+from time import sleep, time
+from urllib.parse import urlparse
+import redis
+
+log = logging.getLogger(__name__)
+
+# Takes a token from the bucket if there are more than ARGV[4] (the lane's
+# floor) left, returning 0; otherwise returns the number of milliseconds
+# until there will be.
+# KEYS: bucket, stats; ARGV: now (s), rate (tokens/s), burst, floor, lane
+_ACQUIRE = """
+local now = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local burst = tonumber(ARGV[3])
+local floor = tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(now - ts, 0) * rate)
+local wait = 0
+if tokens - 1 >= floor then
+	tokens = tokens - 1
+	redis.call('HINCRBY', KEYS[2], ARGV[5] .. ':requests', 1)
+else
+	wait = math.ceil((floor + 1 - tokens) / rate * 1000)
+end
+-- Clocks of callers can be slightly behind, never move the refill time back
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(math.max(now, ts)))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 60)
+return wait
+"""
+
+class RateLimiter:
+	"""
+		Redis-backed token bucket, see the module docstring.
+	"""
+	LANES = ('interactive', 'background')
+
+	def __init__(self, redis_conn, rate: float, burst: int = None, reserve: float = 0.2, prefix: str = 'ratelimit'):
+		"""
+			== ARGUMENTS
+			redis_conn - Redis connection
+			rate - Maximum number of requests per second to each host
+			burst - Number of requests which may be sent at once (default: `rate`, at least 1)
+			reserve - Part of the bucket only the interactive lane may use (0-1)
+			prefix - Prefix of the Redis keys
+		"""
+		self.redis = redis_conn
+		self.rate = rate
+		self.burst = burst or max(int(rate), 1)
+		self.floors = {'interactive': 0, 'background': self.burst * reserve}
+		self.prefix = prefix
+		self.stats_key = prefix + ':stats'
+		self.script = redis_conn.register_script(_ACQUIRE)
+
+	def acquire(self, lane: str, host: str = '') -> float:
+		"""
+			Wait until a request may be sent through a lane, returning the
+			number of seconds waited. If Redis can't be reached, requests
+			aren't limited.
+		"""
+		waited = 0.0
+		try:
+			while True:
+				wait = self.script(
+					keys=['%s:%s' % (self.prefix, host), self.stats_key],
+					args=[time(), self.rate, self.burst, self.floors[lane], lane]
+				)
+				if not wait:
+					break
+				# Check again after at most a second, in case the bucket
+				# is shared with a faster lane
+				delay = min(int(wait) / 1000, 1.0)
+				sleep(delay)
+				waited += delay
+			if waited:
+				pipe = self.redis.pipeline()
+				pipe.hincrby(self.stats_key, lane + ':throttled', 1)
+				pipe.hincrbyfloat(self.stats_key, lane + ':waited', waited)
+				pipe.execute()
+		except redis.exceptions.RedisError as e:
+			log.warning('Rate limiter unavailable, not limiting requests: %s', e)
+		return waited
+
+	def lane(self, lane: str):
+		"""
+			Return a function which can be passed to eDAP as `throttle`,
+			limiting its requests using this lane.
+		"""
+		if lane not in self.floors:
+			raise ValueError('Unknown lane %s' % lane)
+		def throttle(url: str):
+			self.acquire(lane, urlparse(url).netloc)
+		throttle.stats = lambda: self.stats()[lane]
+		return throttle
+
+	def stats(self) -> dict:
+		"""
+			RETURNS: dict formatted {<lane>: {requests, throttled, waited, avg_wait}}, where waited is the total wait in seconds
+		"""
+		raw = {key.decode('utf-8'): float(value) for key, value in self.redis.hgetall(self.stats_key).items()}
+		result = {}
+		for lane in self.LANES:
+			throttled = int(raw.get(lane + ':throttled', 0))
+			waited = raw.get(lane + ':waited', 0.0)
+			result[lane] = {
+				'requests': int(raw.get(lane + ':requests', 0)),
+				'throttled': throttled,
+				'waited': round(waited, 3),
+				'avg_wait': round(waited / throttled, 3) if throttled else 0
+			}
+		return result
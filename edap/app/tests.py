@@ -1,4 +1,4 @@
-import httpx, os, tempfile, subprocess, threading, redis, sys, json
+import httpx, os, tempfile, subprocess, threading, redis, sys
 from time import sleep
 from hashlib import md5
 
@@ -15,6 +15,15 @@ if "--remote" in sys.argv:
 	REMOTE_URL = sys.argv[sys.argv.index("--remote")+1]
 	log('INFO', 'Targeting remote server @ %s instead of locally' % REMOTE_URL)
 
+if "--mock" in sys.argv:
+	# Use a local stand-in for e-Dnevnik instead of the real server
+	from mock_server import MockServer
+	mock = MockServer(students=1)
+	os.environ["UPSTREAM_URL"] = mock.start()
+	os.environ.setdefault("ED_USERNAME", "ucenik0")
+	os.environ.setdefault("ED_PASSWORD", "lozinka0")
+	log('INFO', 'Using mock e-Dnevnik server @ %s' % os.environ["UPSTREAM_URL"])
+
 username = os.environ.get('ED_USERNAME')
 password = os.environ.get('ED_PASSWORD')
 if not username or not password:
@@ -43,14 +52,16 @@ if not REMOTE:
 		log('ERROR', 'Failed to connect to Redis')
 		sys.exit(1)
 
-def get_data():
-	return json.loads(r.get('token:%s' % token))
-
 if not REMOTE:
 	# Configure eDAP-API
 	os.environ["VAULT"] = "N"
 	os.environ["DATA_FOLDER"] = directory
 	from api import app
+	import api_backend
+
+def get_data():
+	# Profiles are stored as Redis hashes, see api_backend.get_data()
+	return api_backend.get_data(token)
 
 try:
 	with httpx.Client(base_url='http://app/' if not REMOTE else REMOTE_URL, app=app if not REMOTE else None) as client: